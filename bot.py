@@ -1,10 +1,10 @@
 import os
 import logging
-import re
+import tempfile
+import threading
 from datetime import datetime, date
 from typing import Optional
 from urllib.parse import urlparse
-from uuid import uuid4
 from telegram import Update, BotCommand, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram import InlineQueryResultArticle, InputTextMessageContent
@@ -23,17 +23,12 @@ from telegram.ext.filters import MessageFilter
 from dotenv import load_dotenv
 import database
 import scheduler
+import congratulations
+import formats
+import persistence
+import search
 from scheduler import years_word
 
-# OpenAI для генерации поздравлений (опционально)
-try:
-    import openai
-    import httpx
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
-    httpx = None
-
 # Загружаем переменные окружения: общий .env и отдельные файлы для секретов
 # Путь к папке с ботом — чтобы openai.env находился при любом текущем каталоге
 _BOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -54,6 +49,20 @@ WAITING_DELETE_ID, WAITING_EDIT_ID, WAITING_EDIT_NAME, WAITING_EDIT_DATE, WAITIN
 WAITING_EDIT_EVENT_TYPE, WAITING_EDIT_EVENT_NAME = range(12, 14)
 WAITING_IMPORT_TEXT, WAITING_IMPORT_CONFIRMATION = range(100, 102)
 
+# Импорт из файла: записи сохраняются пачками; Bot API отдаёт боту файлы до 20 МБ
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+# /list: событий на странице (страница целиком помещается в сообщение до 4096 символов)
+LIST_PAGE_SIZE = 10
+LIST_EMPTY_TEXT = "📋 Список пуст.\n\nДобавьте первую запись командой /add или кнопкой «➕ Добавить»."
+
+# /find: сколько найденных событий показывать в одном сообщении; inline: результатов на страницу (максимум Telegram — 50)
+FIND_MAX_RESULTS = 20
+INLINE_PAGE_SIZE = 50
+# Сколько секунд Telegram кеширует найденные inline-результаты у пользователя
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+
 
 def _parse_remind_days(text: str):
     """Парсит строку дней напоминаний (например '0,1,3,7') в отсортированный список int. 0 = в день события."""
@@ -62,7 +71,7 @@ def _parse_remind_days(text: str):
     for p in parts:
         if p.isdigit():
             d = int(p)
-            if 0 <= d <= 365 and d not in result:
+            if 0 <= d <= database.MAX_REMIND_DAYS and d not in result:
                 result.append(d)
     result.sort()
     return result if result else [0]
@@ -97,7 +106,9 @@ def start(update: Update, context: CallbackContext) -> None:
 /list - Показать все события
 /delete - Удалить запись
 /edit - Редактировать запись
-/check - Проверить уведомления вручную
+/check - Показать сегодняшние напоминания
+/export - Выгрузить события в файл (календарь или таблица)
+/find - Найти событие по имени или username
 /cancel - Отменить текущую операцию
 
 🎉 Что я умею:
@@ -117,103 +128,6 @@ def start(update: Update, context: CallbackContext) -> None:
     logger.info(f"Пользователь {user.id} ({user.username}) запустил бота")
 
 
-def parse_bulk_import(text: str):
-    """
-    Парсинг текста для массового импорта событий.
-    
-    Формат ожидаемого текста:
-    1. 🎂 Имя (@username)
-       📅 ДД.ММ.ГГГГ (дополнительный текст)
-    
-    Returns:
-        tuple: (parsed_events, errors)
-            - parsed_events: список кортежей (full_name, date_str, username, event_type, event_name)
-            - errors: список строк с ошибками парсинга
-    """
-    parsed_events = []
-    errors = []
-    
-    # Разбиваем текст на блоки по записям (по номерам)
-    # Паттерн: номер с точкой, эмодзи, имя, опционально username, перевод строки, дата
-    pattern = r'^\s*\d+\.\s*(🎂|🎊|📅)\s*(.+?)(?:\s*\((@[^)]+)\))?\s*\n\s*📅\s*(\d{2}\.\d{2}(?:\.\d{4})?)'
-    
-    lines = text.split('\n')
-    i = 0
-    
-    while i < len(lines):
-        line = lines[i].strip()
-        
-        # Ищем начало записи (номер с точкой и эмодзи)
-        if re.match(r'^\d+\.\s*[🎂🎊📅]', line):
-            # Собираем текущую запись и следующую строку (с датой)
-            current_block = line
-            if i + 1 < len(lines):
-                current_block += '\n' + lines[i + 1]
-                i += 1  # Пропускаем следующую строку, т.к. уже обработали
-            
-            # Пытаемся распарсить блок
-            match = re.search(pattern, current_block, re.MULTILINE)
-            
-            if match:
-                emoji = match.group(1)
-                name_part = match.group(2).strip()
-                username = match.group(3).strip() if match.group(3) else None
-                date_str = match.group(4).strip()
-                
-                # Убираем @ из username если есть
-                if username and username.startswith('@'):
-                    username = username[1:]
-                
-                # Определяем тип события по эмодзи
-                if emoji == '🎂':
-                    event_type = 'birthday'
-                    event_name = None
-                    full_name = name_part
-                elif emoji == '🎊':
-                    event_type = 'holiday'
-                    event_name = name_part
-                    full_name = name_part
-                elif emoji == '📅':
-                    event_type = 'other'
-                    event_name = name_part
-                    full_name = name_part
-                else:
-                    event_type = 'birthday'
-                    event_name = None
-                    full_name = name_part
-                
-                # Проверяем и нормализуем дату
-                try:
-                    if len(date_str.split('.')) == 3:
-                        # Формат ДД.ММ.ГГГГ
-                        day, month, year = date_str.split('.')
-                        parsed_date = datetime.strptime(date_str, '%d.%m.%Y').date()
-                        normalized_date = parsed_date.strftime('%Y-%m-%d')
-                    else:
-                        # Формат ДД.ММ (для праздников/других событий)
-                        day, month = date_str.split('.')
-                        # Используем год 1900 для обозначения что год не указан
-                        normalized_date = f"1900-{month.zfill(2)}-{day.zfill(2)}"
-                        # Проверяем валидность даты
-                        datetime.strptime(normalized_date, '%Y-%m-%d')
-                    
-                    parsed_events.append((full_name, normalized_date, username, event_type, event_name))
-                    logger.info(f"Распарсено: {full_name}, {normalized_date}, @{username}, {event_type}")
-                    
-                except ValueError as e:
-                    error_msg = f"Неверный формат даты '{date_str}' для записи: {name_part}"
-                    errors.append(error_msg)
-                    logger.warning(error_msg)
-            else:
-                error_msg = f"Не удалось распарсить запись: {current_block[:50]}..."
-                errors.append(error_msg)
-                logger.warning(error_msg)
-        
-        i += 1
-    
-    return parsed_events, errors
-
-
 ADD_PROMPT_TEXT = (
     "📝 Добавление нового события.\n\n"
     "Выберите тип события:"
@@ -540,47 +454,29 @@ def _send_to_chat(update: Update, context: CallbackContext, text: str, reply_mar
         context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
 
 
-def list_birthdays(update: Update, context: CallbackContext) -> None:
-    """Показать все события, отсортированные по дням до наступления."""
-    user_id = update.effective_user.id
-    logger.info(f"Список от пользователя {user_id}")
-    birthdays = database.get_all_birthdays(user_id)
-    logger.info(f"Получено записей из БД: {len(birthdays)}")
-    
-    if not birthdays:
-        _send_to_chat(update, context,
-            "📋 Список пуст.\n\nДобавьте первую запись командой /add или кнопкой «➕ Добавить».",
-            reply_markup=_menu_keyboard()
-        )
-        return
-    
-    # Сортируем по дням до события
-    today = date.today()
-    birthdays_with_days = []
-    
-    for birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _ in birthdays:
-        days_until = scheduler.calculate_days_until_birthday(birth_date)
-        birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d').date()
-        
-        # Вычисляем возраст для дней рождения
-        age = None
-        if event_type == 'birthday' and birth_date_obj.year != 1900:
-            next_birthday_year = today.year if birth_date_obj.replace(year=today.year) >= today else today.year + 1
-            age = next_birthday_year - birth_date_obj.year
-        
-        birthdays_with_days.append((
-            birthday_id, full_name, birth_date_obj, telegram_username, 
-            days_until, event_type, event_name, age
-        ))
-    
-    # Сортируем по количеству дней до события
-    birthdays_with_days.sort(key=lambda x: x[4])
+def _list_page(user_id: int, after=None, before=None, start: int = 1):
+    """
+    Текст и клавиатура одной страницы /list.
+
+    Курсоры after/before — (next_occurrence, id) крайней строки соседней страницы,
+    start — номер первой записи на странице (нумерация сквозная между страницами).
+    Возвращает (текст, клавиатура) или None, если событий нет.
+    """
+    rows, has_prev, has_next = database.get_birthdays_page(user_id, after=after, before=before, limit=LIST_PAGE_SIZE)
+    if not rows and (after is not None or before is not None):
+        # Соседние записи удалили, пока страница была открыта, — начинаем сначала
+        rows, has_prev, has_next = database.get_birthdays_page(user_id, limit=LIST_PAGE_SIZE)
+        start = 1
+    if not rows:
+        return None
+    if not has_prev:
+        start = 1
     
-    # Формируем сообщение
     message = "📋 Ваши события:\n\n"
     
-    for idx, (birthday_id, full_name, birth_date, telegram_username, 
-              days_until, event_type, event_name, age) in enumerate(birthdays_with_days, 1):
+    for idx, (birthday_id, full_name, birth_date, telegram_username,
+              event_type, event_name, days_until, next_occurrence) in enumerate(rows, start):
+        birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d').date()
         
         # Выбираем эмодзи в зависимости от типа события
         if event_type == 'holiday':
@@ -597,9 +493,9 @@ def list_birthdays(update: Update, context: CallbackContext) -> None:
         
         # Форматируем дату
         if event_type == 'birthday':
-            formatted_date = birth_date.strftime('%d.%m.%Y')
+            formatted_date = birth_date_obj.strftime('%d.%m.%Y')
         else:
-            formatted_date = birth_date.strftime('%d.%m')
+            formatted_date = birth_date_obj.strftime('%d.%m')
         
         # Текст о днях до события
         if days_until == 0:
@@ -609,21 +505,80 @@ def list_birthdays(update: Update, context: CallbackContext) -> None:
         else:
             days_text = f"через {days_until} дн."
         
-        # Добавляем информацию о возрасте для дней рождения
+        # Возраст для дней рождения — в год ближайшего наступления
         age_text = ""
-        if age is not None and event_type == 'birthday':
+        if event_type == 'birthday' and birth_date_obj.year != 1900:
+            age = date.fromordinal(next_occurrence).year - birth_date_obj.year
             age_text = f", исполнится {age} {years_word(age)}"
         
         message += f"{idx}. {emoji} {name_display}\n   📅 {formatted_date} ({days_text}{age_text})\n\n"
     
     message += "Управление:"
-    _send_to_chat(update, context, message, reply_markup=_menu_keyboard())
+    
+    # В callback_data — направление, номер первой записи целевой страницы и курсор
+    navigation = []
+    if has_prev:
+        first = rows[0]
+        navigation.append(InlineKeyboardButton(
+            "◀️", callback_data=f"list:p:{max(start - LIST_PAGE_SIZE, 1)}:{first[7]}:{first[0]}"
+        ))
+    if has_next:
+        last = rows[-1]
+        navigation.append(InlineKeyboardButton(
+            "▶️", callback_data=f"list:n:{start + len(rows)}:{last[7]}:{last[0]}"
+        ))
+    keyboard = ([navigation] if navigation else []) + list(_menu_keyboard().inline_keyboard)
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+def list_birthdays(update: Update, context: CallbackContext) -> None:
+    """Показать первую страницу событий, отсортированных по дням до наступления."""
+    user_id = update.effective_user.id
+    logger.info(f"Список от пользователя {user_id}")
+    page = _list_page(user_id)
+    
+    if page is None:
+        _send_to_chat(update, context,
+            LIST_EMPTY_TEXT,
+            reply_markup=_menu_keyboard()
+        )
+        return
+    
+    message, reply_markup = page
+    _send_to_chat(update, context, message, reply_markup=reply_markup)
+
+
+def list_page_callback(update: Update, context: CallbackContext) -> None:
+    """Кнопки ◀️/▶️ списка: перелистывание с редактированием того же сообщения."""
+    query = update.callback_query
+    query.answer()
+    try:
+        _, direction, start, occurrence, birthday_id = (query.data or "").split(":")
+        cursor = (int(occurrence), int(birthday_id))
+        start = int(start)
+    except ValueError:
+        return
+    
+    if direction == "p":
+        page = _list_page(update.effective_user.id, before=cursor, start=start)
+    else:
+        page = _list_page(update.effective_user.id, after=cursor, start=start)
+    
+    if page is None:
+        query.edit_message_text(LIST_EMPTY_TEXT, reply_markup=_menu_keyboard())
+        return
+    message, reply_markup = page
+    try:
+        query.edit_message_text(message, reply_markup=reply_markup)
+    except Exception as e:
+        # Например, страница не изменилась после повторного нажатия
+        logger.debug(f"Не удалось перелистнуть список пользователя {update.effective_user.id}: {e}")
 
 
 def _build_delete_list_message(birthdays):
     """Сформировать текст списка для удаления."""
     message = "🗑 Удаление записи\n\nВыберите номер записи для удаления:\n\n"
-    for idx, (birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _) in enumerate(birthdays, 1):
+    for idx, (birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _, _) in enumerate(birthdays, 1):
         birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
         if event_type == 'holiday':
             emoji, formatted_date = "🎊", birth_date_obj.strftime('%d.%m')
@@ -648,7 +603,8 @@ def delete_start(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
     message = _build_delete_list_message(birthdays)
     update.message.reply_text(message)
-    context.user_data['birthdays'] = birthdays
+    # Храним только id: номер из списка сопоставляется с записью при ответе
+    context.user_data['birthday_ids'] = [row[0] for row in birthdays]
     return WAITING_DELETE_ID
 
 
@@ -661,7 +617,8 @@ def menu_delete_entry(update: Update, context: CallbackContext) -> int:
         context.bot.send_message(chat_id=update.effective_chat.id, text="📋 Список пуст. Нечего удалять.")
         return ConversationHandler.END
     context.bot.send_message(chat_id=update.effective_chat.id, text=_build_delete_list_message(birthdays))
-    context.user_data['birthdays'] = birthdays
+    # Храним только id: номер из списка сопоставляется с записью при ответе
+    context.user_data['birthday_ids'] = [row[0] for row in birthdays]
     return WAITING_DELETE_ID
 
 
@@ -669,11 +626,14 @@ def delete_execute(update: Update, context: CallbackContext) -> int:
     """Удаление выбранной записи."""
     try:
         index = int(update.message.text.strip()) - 1
-        birthdays = context.user_data.get('birthdays', [])
+        birthday_ids = context.user_data.get('birthday_ids', [])
+        user_id = update.effective_user.id
+        record = None
+        if 0 <= index < len(birthday_ids):
+            record = database.get_birthday_by_id(birthday_ids[index], user_id)
         
-        if 0 <= index < len(birthdays):
-            birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _ = birthdays[index]
-            user_id = update.effective_user.id
+        if record:
+            birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _ = record
             
             # Определяем что именно удаляем для отображения
             display_name = event_name if (event_type in ['holiday', 'other'] and event_name) else full_name
@@ -696,7 +656,7 @@ def delete_execute(update: Update, context: CallbackContext) -> int:
 def _build_edit_list_message(birthdays):
     """Сформировать текст списка для редактирования."""
     message = "✏️ Редактирование записи\n\nВыберите номер записи для редактирования:\n\n"
-    for idx, (birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _) in enumerate(birthdays, 1):
+    for idx, (birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _, _) in enumerate(birthdays, 1):
         birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
         if event_type == 'holiday':
             emoji, formatted_date = "🎊", birth_date_obj.strftime('%d.%m')
@@ -720,7 +680,8 @@ def edit_start(update: Update, context: CallbackContext) -> int:
         update.message.reply_text("📋 Список пуст. Нечего редактировать.")
         return ConversationHandler.END
     update.message.reply_text(_build_edit_list_message(birthdays))
-    context.user_data['birthdays'] = birthdays
+    # Храним только id: номер из списка сопоставляется с записью при ответе
+    context.user_data['birthday_ids'] = [row[0] for row in birthdays]
     return WAITING_EDIT_ID
 
 
@@ -733,7 +694,8 @@ def menu_edit_entry(update: Update, context: CallbackContext) -> int:
         context.bot.send_message(chat_id=update.effective_chat.id, text="📋 Список пуст. Нечего редактировать.")
         return ConversationHandler.END
     context.bot.send_message(chat_id=update.effective_chat.id, text=_build_edit_list_message(birthdays))
-    context.user_data['birthdays'] = birthdays
+    # Храним только id: номер из списка сопоставляется с записью при ответе
+    context.user_data['birthday_ids'] = [row[0] for row in birthdays]
     return WAITING_EDIT_ID
 
 
@@ -741,10 +703,13 @@ def edit_id(update: Update, context: CallbackContext) -> int:
     """Получение ID записи и запрос нового имени/названия."""
     try:
         index = int(update.message.text.strip()) - 1
-        birthdays = context.user_data.get('birthdays', [])
+        birthday_ids = context.user_data.get('birthday_ids', [])
+        record = None
+        if 0 <= index < len(birthday_ids):
+            record = database.get_birthday_by_id(birthday_ids[index], update.effective_user.id)
         
-        if 0 <= index < len(birthdays):
-            birthday_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days = birthdays[index]
+        if record:
+            birthday_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days = record
             context.user_data['edit_id'] = birthday_id
             context.user_data['old_name'] = full_name
             context.user_data['old_date'] = birth_date
@@ -992,99 +957,6 @@ def edit_username(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
-def parse_bulk_import(text: str):
-    """
-    Парсинг списка событий из форматированного текста.
-    
-    Формат:
-    1. 🎂 Имя (@username)
-       📅 ДД.ММ.ГГГГ (описание...)
-    
-    Returns:
-        Tuple[List, List]: (успешно распарсенные записи, ошибки)
-        Запись: (full_name, date_str, username, event_type, event_name)
-    """
-    records = []
-    errors = []
-    
-    # Паттерн для парсинга каждой записи
-    # Ищем строки вида: "N. 🎂 Имя (@username)" и следующую строку "📅 дата"
-    pattern = r'^\d+\.\s*(🎂|🎊|📅)\s*(.+?)(?:\s*\(@([^)]+)\))?\s*$\s*^\s*📅\s*(\d{2}\.\d{2}(?:\.\d{4})?)'
-    
-    # Разбиваем текст на строки для обработки
-    lines = text.split('\n')
-    i = 0
-    
-    while i < len(lines):
-        line = lines[i].strip()
-        
-        # Проверяем, начинается ли строка с номера и эмодзи
-        if re.match(r'^\d+\.\s*(🎂|🎊|📅)', line):
-            # Извлекаем эмодзи
-            emoji_match = re.search(r'(🎂|🎊|📅)', line)
-            if not emoji_match:
-                i += 1
-                continue
-            
-            emoji = emoji_match.group(1)
-            
-            # Определяем тип события
-            if emoji == '🎂':
-                event_type = 'birthday'
-            elif emoji == '🎊':
-                event_type = 'holiday'
-            else:  # 📅
-                event_type = 'other'
-            
-            # Извлекаем имя и username
-            name_part = re.sub(r'^\d+\.\s*(🎂|🎊|📅)\s*', '', line)
-            
-            # Проверяем наличие @username
-            username_match = re.search(r'\(@([^)]+)\)', name_part)
-            username = username_match.group(1) if username_match else None
-            
-            # Удаляем @username из имени
-            full_name = re.sub(r'\s*\(@[^)]+\)', '', name_part).strip()
-            
-            # Следующая строка должна содержать дату
-            if i + 1 < len(lines):
-                date_line = lines[i + 1].strip()
-                date_match = re.search(r'📅\s*(\d{2}\.\d{2}(?:\.\d{4})?)', date_line)
-                
-                if date_match:
-                    date_str = date_match.group(1)
-                    
-                    # Конвертируем дату в формат YYYY-MM-DD
-                    try:
-                        if len(date_str) == 10:  # ДД.ММ.ГГГГ
-                            date_obj = datetime.strptime(date_str, '%d.%m.%Y')
-                        else:  # ДД.ММ
-                            # Для праздников и других событий используем год 1900
-                            date_obj = datetime.strptime(date_str + '.1900', '%d.%m.%Y')
-                        
-                        db_date = date_obj.strftime('%Y-%m-%d')
-                        
-                        # Для праздников и других событий event_name = full_name
-                        event_name = full_name if event_type in ['holiday', 'other'] else None
-                        
-                        records.append((full_name, db_date, username, event_type, event_name))
-                        logger.info(f"Распарсена запись: {full_name} - {db_date} [{event_type}]")
-                    except Exception as e:
-                        errors.append(f"Ошибка парсинга даты для '{full_name}': {e}")
-                        logger.warning(f"Ошибка парсинга даты: {date_str} - {e}")
-                else:
-                    errors.append(f"Не найдена дата для '{full_name}'")
-                
-                i += 2  # Пропускаем обе строки (имя и дата)
-            else:
-                errors.append(f"Не найдена строка с датой для '{full_name}'")
-                i += 1
-        else:
-            i += 1
-    
-    return records, errors
-
-
 def cancel(update: Update, context: CallbackContext) -> int:
     """Отмена текущей операции."""
     update.message.reply_text("❌ Операция отменена.", reply_markup=ReplyKeyboardRemove())
@@ -1108,7 +980,9 @@ def import_start(update: Update, context: CallbackContext) -> int:
         "   📅 15.03.1990 (через 125 дн., исполнится 35 лет)\n\n"
         "2. 🎊 Новый Год\n"
         "   📅 01.01\n\n"
-        "Просто скопируйте и отправьте весь список одним сообщением.\n\n"
+        "Просто скопируйте и отправьте весь список одним сообщением.\n"
+        "Длинный список можно прислать файлом .txt — он импортируется сразу целиком.\n"
+        "Также можно загрузить контакты телефона (.vcf), календарь (.ics) или таблицу (.csv с колонками «Имя» и «Дата»).\n\n"
         "Отменить: /cancel"
     )
     return WAITING_IMPORT_TEXT
@@ -1122,7 +996,7 @@ def import_receive_text(update: Update, context: CallbackContext) -> int:
     logger.info(f"Пользователь {user_id} отправил текст для импорта, длина: {len(text)}")
     
     # Парсим текст
-    parsed_events, errors = parse_bulk_import(text)
+    parsed_events, errors = formats.parse_bulk_import(text)
     
     if not parsed_events and not errors:
         update.message.reply_text(
@@ -1179,6 +1053,100 @@ def import_receive_text(update: Update, context: CallbackContext) -> int:
     return WAITING_IMPORT_CONFIRMATION
 
 
+def _import_result_message(added: int, duplicates: int, failed: int) -> str:
+    """Итог импорта для пользователя."""
+    result_message = f"✅ Импорт завершен!\n\n"
+    result_message += f"📊 Успешно добавлено: {added}\n"
+    if duplicates > 0:
+        result_message += f"🔁 Уже были в списке: {duplicates}\n"
+    if failed > 0:
+        result_message += f"❌ Ошибок: {failed}\n"
+    result_message += f"\nИспользуйте /list чтобы посмотреть все события."
+    return result_message
+
+
+def _import_stream(user_id: int, results) -> dict:
+    """
+    Сохранить поток результатов разбора (запись, ошибка) пачками по IMPORT_BATCH_SIZE.
+    
+    Записи не накапливаются целиком: каждая пачка сразу уходит в add_birthdays_bulk.
+    
+    Returns:
+        Словарь со счётчиками added, duplicates, failed, parse_errors и первыми ошибками errors
+    """
+    stats = {'added': 0, 'duplicates': 0, 'failed': 0, 'parse_errors': 0, 'errors': []}
+    batch = []
+    
+    def flush():
+        outcomes = database.add_birthdays_bulk(user_id, batch, dedupe=True)
+        added = outcomes.count(database.BULK_ADDED)
+        duplicates = outcomes.count(database.BULK_DUPLICATE)
+        stats['added'] += added
+        stats['duplicates'] += duplicates
+        stats['failed'] += len(batch) - added - duplicates
+        batch.clear()
+    
+    for record, error in results:
+        if record is not None:
+            batch.append(record)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        else:
+            stats['parse_errors'] += 1
+            if len(stats['errors']) < 3:
+                stats['errors'].append(error)
+    if batch:
+        flush()
+    return stats
+
+
+def import_receive_document(update: Update, context: CallbackContext) -> int:
+    """Импорт из загруженного файла: файл разбирается потоково и сохраняется пачками, без превью."""
+    user_id = update.effective_user.id
+    document = update.message.document
+    file_name = document.file_name or ""
+    
+    if not formats.is_supported_import_file(file_name):
+        update.message.reply_text(
+            f"❌ Поддерживаются файлы: {', '.join(formats.IMPORT_FILE_EXTENSIONS)}\n\n"
+            "Отправьте другой файл или используйте /cancel для отмены."
+        )
+        return WAITING_IMPORT_TEXT
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        update.message.reply_text("❌ Файл слишком большой: Telegram позволяет боту скачивать файлы до 20 МБ.")
+        return WAITING_IMPORT_TEXT
+    
+    logger.info(f"Пользователь {user_id} отправил файл для импорта: {file_name} ({document.file_size} байт)")
+    update.message.reply_text("⏳ Импортирую файл...")
+    try:
+        with tempfile.TemporaryFile() as buffer:
+            document.get_file().download(out=buffer)
+            buffer.seek(0)
+            stats = _import_stream(user_id, formats.iter_import_file(file_name, buffer))
+    except Exception as e:
+        logger.error(f"Ошибка при импорте файла {file_name}: {e}")
+        update.message.reply_text("❌ Не удалось прочитать файл. Проверьте формат и попробуйте снова, или используйте /cancel.")
+        return WAITING_IMPORT_TEXT
+    
+    total = stats['added'] + stats['duplicates'] + stats['failed']
+    if not total and not stats['parse_errors']:
+        update.message.reply_text(
+            "❌ Не удалось найти ни одной записи в нужном формате.\n\n"
+            "Проверьте формат и попробуйте снова, или используйте /cancel для отмены."
+        )
+        return WAITING_IMPORT_TEXT
+    
+    message = _import_result_message(stats['added'], stats['duplicates'], stats['failed'])
+    if stats['parse_errors']:
+        message += f"\n\n⚠️ Не удалось распарсить: {stats['parse_errors']} записей\n"
+        message += "".join(f"  • {error}\n" for error in stats['errors'])
+    update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    logger.info(f"Пользователь {user_id} импортировал из файла {stats['added']} записей")
+    
+    context.user_data.clear()
+    return ConversationHandler.END
+
+
 def import_confirm(update: Update, context: CallbackContext) -> int:
     """Подтверждение и сохранение импортированных записей."""
     user_id = update.effective_user.id
@@ -1209,27 +1177,14 @@ def import_confirm(update: Update, context: CallbackContext) -> int:
         context.user_data.clear()
         return ConversationHandler.END
     
-    # Импортируем записи
-    success_count = 0
-    failed_count = 0
-    
-    for full_name, date_str, username, event_type, event_name in import_candidates:
-        try:
-            if database.add_birthday(user_id, full_name, date_str, username, event_type, event_name):
-                success_count += 1
-            else:
-                failed_count += 1
-        except Exception as e:
-            logger.error(f"Ошибка при импорте записи {full_name}: {e}")
-            failed_count += 1
+    # Импортируем записи одной транзакцией, пропуская уже существующие
+    outcomes = database.add_birthdays_bulk(user_id, import_candidates, dedupe=True)
+    success_count = outcomes.count(database.BULK_ADDED)
+    duplicate_count = outcomes.count(database.BULK_DUPLICATE)
+    failed_count = len(import_candidates) - success_count - duplicate_count
     
     # Показываем результат
-    result_message = f"✅ Импорт завершен!\n\n"
-    result_message += f"📊 Успешно добавлено: {success_count}\n"
-    if failed_count > 0:
-        result_message += f"❌ Ошибок: {failed_count}\n"
-    result_message += f"\nИспользуйте /list чтобы посмотреть все события."
-    
+    result_message = _import_result_message(success_count, duplicate_count, failed_count)
     update.message.reply_text(result_message, reply_markup=ReplyKeyboardRemove())
     
     logger.info(f"Пользователь {user_id} импортировал {success_count} записей")
@@ -1239,22 +1194,94 @@ def import_confirm(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
+def _send_export(bot, chat_id: int, user_id: int, export_format: str) -> None:
+    """Выгрузить события пользователя во временный файл (потоково из БД) и отправить документом."""
+    try:
+        with tempfile.TemporaryFile() as buffer:
+            count = formats.write_export(database.iter_user_birthdays(user_id), export_format, buffer)
+            if not count:
+                bot.send_message(chat_id=chat_id, text="📭 У вас пока нет событий. Используйте /add чтобы добавить первое событие.")
+                return
+            buffer.seek(0)
+            bot.send_document(
+                chat_id=chat_id,
+                document=buffer,
+                filename=f"birthdays.{export_format}",
+                caption=f"📤 Экспортировано событий: {count}",
+            )
+        logger.info(f"Пользователь {user_id} экспортировал {count} событий в {export_format}")
+    except Exception as e:
+        logger.error(f"Ошибка при экспорте событий пользователя {user_id}: {e}")
+        bot.send_message(chat_id=chat_id, text="❌ Не удалось сформировать файл. Попробуйте позже.")
+
+
+def export_command(update: Update, context: CallbackContext) -> None:
+    """
+    Команда /export [ics|csv] — выгрузка событий файлом.
+    
+    ics — календарь с ежегодными событиями и напоминаниями, csv — таблица (можно загрузить обратно через /import).
+    """
+    export_format = context.args[0].lower().lstrip('.') if context.args else ""
+    if export_format not in formats.EXPORT_FORMATS:
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("📅 Календарь (.ics)", callback_data="export:ics"),
+            InlineKeyboardButton("📊 Таблица (.csv)", callback_data="export:csv"),
+        ]])
+        update.message.reply_text("📤 В каком формате выгрузить события?", reply_markup=keyboard)
+        return
+    _send_export(context.bot, update.effective_chat.id, update.effective_user.id, export_format)
+
+
+def export_callback(update: Update, context: CallbackContext) -> None:
+    """Кнопки выбора формата /export."""
+    query = update.callback_query
+    query.answer()
+    export_format = (query.data or "").split(":", 1)[-1]
+    if export_format in formats.EXPORT_FORMATS:
+        _send_export(context.bot, query.message.chat_id, update.effective_user.id, export_format)
+
+
+def find_command(update: Update, context: CallbackContext) -> None:
+    """Команда /find текст — поиск событий по имени, названию или username (тот же поиск, что у inline-режима)."""
+    query = " ".join(context.args or []).strip()
+    if not query:
+        update.message.reply_text(
+            "🔎 Поиск событий\n\n"
+            "Напишите, что искать: /find Иван\n"
+            "Ищет по имени, названию события и username; можно латиницей (ivan) и без «ё»."
+        )
+        return
+    
+    found, next_offset = search.search_page(update.effective_user.id, query, limit=FIND_MAX_RESULTS)
+    if not found:
+        update.message.reply_text(f"🔎 По запросу «{query}» ничего не найдено.")
+        return
+    
+    message = f"🔎 Найдено по запросу «{query}»:\n\n"
+    for idx, entry in enumerate(found, 1):
+        username_text = f" (@{entry.telegram_username})" if entry.telegram_username else ""
+        message += f"{idx}. {entry.emoji} {entry.display_name}{username_text}\n   📅 {entry.formatted_date}\n"
+    if next_offset:
+        message += f"\nПоказаны первые {FIND_MAX_RESULTS}. Уточните запрос, чтобы найти остальные."
+    update.message.reply_text(message)
+
+
 def check_notifications(update: Update, context: CallbackContext) -> None:
-    """Ручная проверка и отправка уведомлений (для тестирования)."""
+    """Проверка уведомлений: показать пользователю его сегодняшние напоминания (другим ничего не отправляется)."""
     user = update.effective_user
     logger.info(f"Пользователь {user.id} запустил ручную проверку уведомлений")
     chat_id = update.effective_chat.id
     bot = context.bot
-    if update.message:
-        update.message.reply_text("🔍 Проверяю уведомления...")
-    else:
+    if update.callback_query:
         update.callback_query.answer()
-        bot.send_message(chat_id=chat_id, text="🔍 Проверяю уведомления...")
-    scheduler.check_and_send_notifications(bot)
-    if update.message:
-        update.message.reply_text("✅ Проверка завершена! Уведомления отправлены если есть подходящие даты.")
-    else:
-        bot.send_message(chat_id=chat_id, text="✅ Проверка завершена! Уведомления отправлены если есть подходящие даты.")
+    
+    previews = scheduler.preview_user_notifications(user.id)
+    if not previews:
+        bot.send_message(chat_id=chat_id, text="✅ Проверка завершена! На сегодня напоминаний нет.")
+        return
+    
+    for message, reply_markup in previews:
+        bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup)
 
 
 def menu_callback(update: Update, context: CallbackContext) -> None:
@@ -1268,79 +1295,69 @@ def menu_callback(update: Update, context: CallbackContext) -> None:
 
 # --- Генерация поздравлений через OpenAI ---
 
-def _openai_client():
-    """Создать клиент OpenAI если есть ключ. Для запросов из неподдерживаемых регионов задайте OPENAI_HTTPS_PROXY."""
-    if not OPENAI_AVAILABLE:
-        return None
-    key = (os.getenv('OPENAI_API_KEY') or '').strip()
-    if not key:
-        return None
-    # Плейсхолдер из примера или слишком короткий ключ
-    if key.startswith('sk-your-') or len(key) < 40:
-        logger.warning("OpenAI: ключ похож на плейсхолдер или слишком короткий (длина %s)", len(key))
-        return None
-    logger.info("OpenAI: ключ загружен, длина %s символов", len(key))
-    proxy_url = (os.getenv("OPENAI_HTTPS_PROXY") or os.getenv("OPENAI_PROXY") or "").strip()
-    if proxy_url and httpx is not None:
-        try:
-            http_client = httpx.Client(proxy=proxy_url, timeout=60.0)
-            logger.info("OpenAI: запросы идут через прокси")
-            return openai.OpenAI(api_key=key, http_client=http_client)
-        except Exception as e:
-            logger.warning("OpenAI: не удалось создать клиент с прокси %s: %s", proxy_url[:50], e)
-    return openai.OpenAI(api_key=key)
+def _again_keyboard(context: CallbackContext, user_id: int, birthday_id: int, custom_prompt: Optional[str]):
+    """Кнопка «Другой вариант»: та же генерация в обход кеша. Свой промпт запоминается в bot_data."""
+    if not custom_prompt:
+        data = f"congratulate_again:{birthday_id}"
+    else:
+        preset_key = next((key for key, text in congratulations.PROMPT_PRESETS.items() if text == custom_prompt), None)
+        if preset_key:
+            data = f"congratulate_again:{birthday_id}:{preset_key}"
+        else:
+            # Свой текст не помещается в callback_data (64 байта) — храним последний промпт пользователя
+            context.bot_data.setdefault("last_custom_prompt", {})[user_id] = (birthday_id, custom_prompt)
+            data = f"congratulate_again:{birthday_id}:custom"
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Другой вариант", callback_data=data)]])
 
 
-def generate_congratulation(full_name: str, custom_prompt: Optional[str] = None) -> str:
+def _start_generation(context: CallbackContext, chat_id: int, user_id: int, birthday_id: int, full_name: str,
+                      custom_prompt: Optional[str], reply, progress: str = "⏳ Генерирую поздравление...",
+                      use_cache: bool = True) -> None:
     """
-    Сгенерировать текст поздравления с днём рождения через OpenAI.
-    
-    Args:
-        full_name: Имя именинника
-        custom_prompt: Дополнительные пожелания (стиль, тон и т.д.), опционально
-    
-    Returns:
-        Текст поздравления или сообщение об ошибке
+    Поставить генерацию поздравления в пул и сразу вернуться. reply — функция ответа пользователю
+    (reply_text сообщения): она отправляет заглушку «⏳ Генерирую…», которую затем редактируем —
+    сначала промежуточным текстом по мере генерации, потом готовым поздравлением.
     """
-    client = _openai_client()
-    if not client:
-        return "Сервис генерации недоступен. Задайте OPENAI_API_KEY в openai.env (локально) или в переменных окружения (на сервере)."
-    
-    system = (
-        "Ты помогаешь писать короткие тёплые поздравления с днём рождения. "
-        "Пиши от первого лица, как будто пользователь сам поздравляет. "
-        "Без обрамления в кавычки и без подписи в конце. Один короткий абзац."
-    )
-    user_msg = f"Напиши поздравление с днём рождения для {full_name}."
-    if custom_prompt and custom_prompt.strip():
-        user_msg += f" Дополнительные пожелания: {custom_prompt.strip()}"
-    
-    model = (os.getenv("OPENAI_MODEL") or "gpt-4o-mini").strip()
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user_msg},
-            ],
-            max_tokens=300,
-        )
-        text = (response.choices[0].message.content or "").strip()
-        return text if text else "Не удалось сгенерировать поздравление."
-    except Exception as e:
-        logger.exception("Ошибка OpenAI при генерации поздравления")
-        err_str = str(e).lower()
-        if "401" in err_str or "invalid_api_key" in err_str or "incorrect api key" in err_str:
-            return "Проверьте OPENAI_API_KEY в файле openai.env — ключ неверный или не задан."
-        return "Ошибка при генерации. Попробуйте позже или проверьте openai.env."
+    placeholder = {}
+    placeholder_ready = threading.Event()
+    title = f"🎂 Поздравление для {full_name}:\n\n"
 
+    def on_partial(text: str) -> None:
+        message = placeholder.get("message")
+        if not placeholder_ready.is_set() or message is None:
+            return
+        try:
+            context.bot.edit_message_text(chat_id=chat_id, message_id=message.message_id, text=f"{title}{text} ✍️")
+        except Exception as e:
+            # Промежуточное обновление можно пропустить (flood control, текст не изменился)
+            logger.debug(f"Не удалось обновить поздравление в чате {chat_id}: {e}")
+
+    def deliver(text: str) -> None:
+        reply_markup = _again_keyboard(context, user_id, birthday_id, custom_prompt)
+        placeholder_ready.wait(timeout=10)
+        message = placeholder.get("message")
+        if message is not None:
+            try:
+                context.bot.edit_message_text(
+                    chat_id=chat_id, message_id=message.message_id, text=f"{title}{text}", reply_markup=reply_markup
+                )
+                return
+            except Exception as e:
+                logger.warning(f"Не удалось отредактировать сообщение с поздравлением в чате {chat_id}: {e}")
+        context.bot.send_message(chat_id=chat_id, text=f"{title}{text}", reply_markup=reply_markup)
 
-# Пресеты промптов для кнопок «Свой промпт»
-PROMPT_PRESETS = {
-    "humor": "короткое и с юмором",
-    "touching": "трогательное и душевное",
-    "family": "для близкого человека, тёплое",
-}
+    status = congratulations.generation_pool.submit(
+        user_id, full_name, custom_prompt, deliver, use_cache=use_cache, on_partial=on_partial
+    )
+    if status == congratulations.USER_BUSY:
+        reply("⏳ Предыдущее поздравление ещё генерируется, подождите немного.")
+    elif status == congratulations.QUEUE_FULL:
+        reply("😔 Сейчас слишком много запросов на генерацию. Попробуйте через минуту.")
+    else:
+        try:
+            placeholder["message"] = reply(progress)
+        finally:
+            placeholder_ready.set()
 
 
 def congratulate_callback(update: Update, context: CallbackContext) -> None:
@@ -1390,7 +1407,7 @@ def congratulate_callback(update: Update, context: CallbackContext) -> None:
         except ValueError:
             return
         preset_key = parts[2]
-        preset_text = PROMPT_PRESETS.get(preset_key)
+        preset_text = congratulations.PROMPT_PRESETS.get(preset_key)
         if not preset_text:
             return
         record = database.get_birthday_by_id(birthday_id, user_id)
@@ -1398,9 +1415,7 @@ def congratulate_callback(update: Update, context: CallbackContext) -> None:
             query.message.reply_text("Запись не найдена или у вас нет доступа к ней.")
             return
         full_name = record[1]
-        query.message.reply_text("⏳ Генерирую поздравление...")
-        text = generate_congratulation(full_name, custom_prompt=preset_text)
-        query.message.reply_text(f"🎂 Поздравление для {full_name}:\n\n{text}")
+        _start_generation(context, query.message.chat_id, user_id, birthday_id, full_name, preset_text, query.message.reply_text)
         return
     
     # «Свой текст» — ждём следующее сообщение пользователя (reply не обязателен)
@@ -1421,6 +1436,34 @@ def congratulate_callback(update: Update, context: CallbackContext) -> None:
         )
         return
     
+    # «Другой вариант» — та же генерация (по умолчанию, пресет или свой текст) в обход кеша
+    if data.startswith("congratulate_again:"):
+        parts = data.split(":", 2)
+        try:
+            birthday_id = int(parts[1])
+        except (IndexError, ValueError):
+            query.message.reply_text("Ошибка: неверные данные.")
+            return
+        record = database.get_birthday_by_id(birthday_id, user_id)
+        if not record:
+            query.message.reply_text("Запись не найдена или у вас нет доступа к ней.")
+            return
+        variant = parts[2] if len(parts) > 2 else ""
+        custom_prompt = None
+        if variant == "custom":
+            stored = (context.bot_data.get("last_custom_prompt") or {}).get(user_id)
+            if not stored or stored[0] != birthday_id:
+                query.message.reply_text("Промпт не сохранился. Отправьте его заново: /prompt <номер_записи> ваш промпт")
+                return
+            custom_prompt = stored[1]
+        elif variant:
+            custom_prompt = congratulations.PROMPT_PRESETS.get(variant)
+            if not custom_prompt:
+                return
+        _start_generation(context, query.message.chat_id, user_id, birthday_id, record[1], custom_prompt,
+                          query.message.reply_text, progress="⏳ Генерирую другой вариант...", use_cache=False)
+        return
+    
     if not data.startswith("congratulate:"):
         return
     
@@ -1437,10 +1480,7 @@ def congratulate_callback(update: Update, context: CallbackContext) -> None:
         return
     
     full_name = record[1]
-    query.message.reply_text("⏳ Генерирую поздравление...")
-    
-    text = generate_congratulation(full_name, custom_prompt=None)
-    query.message.reply_text(f"🎂 Поздравление для {full_name}:\n\n{text}")
+    _start_generation(context, query.message.chat_id, user_id, birthday_id, full_name, None, query.message.reply_text)
 
 
 class PromptWaitFilter(MessageFilter):
@@ -1507,9 +1547,9 @@ def prompt_reply_handler(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Запись не найдена.")
         return
     full_name = record[1]
-    update.message.reply_text("⏳ Генерирую поздравление по вашему промпту...")
-    text = generate_congratulation(full_name, custom_prompt=prompt_text)
-    update.message.reply_text(f"🎂 Поздравление для {full_name}:\n\n{text}")
+    _start_generation(
+        context, chat_id, user_id, birthday_id, full_name, prompt_text, update.message.reply_text,
+        progress="⏳ Генерирую поздравление по вашему промпту...")
 
 
 def prompt_command(update: Update, context: CallbackContext) -> None:
@@ -1541,92 +1581,63 @@ def prompt_command(update: Update, context: CallbackContext) -> None:
         return
     
     full_name = record[1]
-    update.message.reply_text("⏳ Генерирую поздравление по вашему промпту...")
-    
-    text = generate_congratulation(full_name, custom_prompt=custom_prompt)
-    update.message.reply_text(f"🎂 Поздравление для {full_name}:\n\n{text}")
+    _start_generation(
+        context, update.effective_chat.id, user_id, birthday_id, full_name, custom_prompt, update.message.reply_text,
+        progress="⏳ Генерирую поздравление по вашему промпту...")
 
 
 def inline_query(update: Update, context: CallbackContext) -> None:
     """
     Обработка inline запросов для поиска username из уже добавленных контактов.
     Пользователь вводит: @botname имя
-    Бот показывает список контактов с username.
+    Бот показывает список контактов с username (поиск — search.search_page,
+    следующие страницы Telegram запрашивает по next_offset).
+    
+    Ответы личные (is_personal) и кешируются клиентом Telegram на INLINE_CACHE_TIME секунд;
+    id результата строится из id и версии записи, поэтому одинаковые ответы совпадают,
+    а исправленная запись приходит как новый результат. Подсказки кешируются на 1 секунду,
+    чтобы только что добавленные события появлялись сразу.
     """
-    query = update.inline_query.query.strip().lower()
+    query = update.inline_query.query.strip()
+    offset = update.inline_query.offset or ""
     user_id = update.inline_query.from_user.id
     
-    logger.info(f"Inline запрос от пользователя {user_id}: '{query}'")
-    
-    # Получаем все записи пользователя
-    birthdays = database.get_all_birthdays(user_id)
-    
-    if not birthdays:
-        # Если нет записей, показываем подсказку
-        results = [
-            InlineQueryResultArticle(
-                id=str(uuid4()),
-                title="У вас нет добавленных событий",
-                description="Используйте /add чтобы добавить первое событие",
-                input_message_content=InputTextMessageContent(
-                    "Используйте /add чтобы добавить событие"
-                )
-            )
-        ]
-        update.inline_query.answer(results, cache_time=1)
-        return
-    
-    # Фильтруем и ищем контакты с username
-    results = []
-    
-    for birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _ in birthdays:
-        # Пропускаем записи без username
-        if not telegram_username:
-            continue
-        
-        # Определяем имя для отображения
-        if event_type == 'birthday':
-            display_name = full_name
-        else:
-            display_name = event_name if event_name else full_name
-        
-        # Поиск (если query пустой, показываем все)
-        if query and query not in display_name.lower() and query not in telegram_username.lower():
-            continue
-        
-        # Форматируем дату
-        birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
-        if event_type == 'birthday':
-            formatted_date = birth_date_obj.strftime('%d.%m.%Y')
-        else:
-            formatted_date = birth_date_obj.strftime('%d.%m')
-        
-        # Определяем эмодзи
-        if event_type == 'holiday':
-            emoji = "🎊"
-        elif event_type == 'other':
-            emoji = "📅"
-        else:
-            emoji = "🎂"
-        
-        # Создаем результат
-        results.append(
-            InlineQueryResultArticle(
-                id=str(uuid4()),
-                title=f"{emoji} {display_name}",
-                description=f"@{telegram_username} • {formatted_date}",
-                input_message_content=InputTextMessageContent(
-                    f"@{telegram_username}"
-                )
+    logger.info(f"Inline запрос от пользователя {user_id}: '{query}' (offset '{offset}')")
+    
+    # Ищем только контакты с username (если query пустой, показываем все)
+    contacts, next_offset = search.search_page(user_id, query, offset, limit=INLINE_PAGE_SIZE, with_username=True)
+    results = [
+        InlineQueryResultArticle(
+            id=entry.result_id,
+            title=f"{entry.emoji} {entry.display_name}",
+            description=f"@{entry.telegram_username} • {entry.formatted_date}",
+            input_message_content=InputTextMessageContent(
+                f"@{entry.telegram_username}"
             )
         )
+        for entry in contacts
+    ]
     
-    # Если ничего не найдено
-    if not results:
+    # Если ничего не найдено (на первой странице)
+    if not results and not offset:
+        if not database.get_all_birthdays(user_id):
+            # Если нет записей, показываем подсказку
+            results = [
+                InlineQueryResultArticle(
+                    id="no-events",
+                    title="У вас нет добавленных событий",
+                    description="Используйте /add чтобы добавить первое событие",
+                    input_message_content=InputTextMessageContent(
+                        "Используйте /add чтобы добавить событие"
+                    )
+                )
+            ]
+            update.inline_query.answer(results, cache_time=1, is_personal=True)
+            return
         if query:
             results = [
                 InlineQueryResultArticle(
-                    id=str(uuid4()),
+                    id="not-found",
                     title=f"Не найдено контактов по запросу '{query}'",
                     description="Попробуйте другой запрос",
                     input_message_content=InputTextMessageContent(
@@ -1637,7 +1648,7 @@ def inline_query(update: Update, context: CallbackContext) -> None:
         else:
             results = [
                 InlineQueryResultArticle(
-                    id=str(uuid4()),
+                    id="no-usernames",
                     title="У вас нет контактов с username",
                     description="Добавьте username при создании события",
                     input_message_content=InputTextMessageContent(
@@ -1646,11 +1657,9 @@ def inline_query(update: Update, context: CallbackContext) -> None:
                 )
             ]
     
-    # Ограничиваем результаты (Telegram позволяет максимум 50)
-    results = results[:50]
-    
     # Отправляем результаты
-    update.inline_query.answer(results, cache_time=10)
+    cache_time = INLINE_CACHE_TIME if contacts else 1
+    update.inline_query.answer(results, cache_time=cache_time, is_personal=True, next_offset=next_offset)
     logger.info(f"Отправлено {len(results)} результатов inline запроса")
 
 
@@ -1663,6 +1672,8 @@ def setup_commands(bot):
         BotCommand("delete", "Удалить событие"),
         BotCommand("edit", "Редактировать событие"),
         BotCommand("import", "Массовый импорт событий из списка"),
+        BotCommand("export", "Выгрузить события в файл (.ics / .csv)"),
+        BotCommand("find", "Найти событие по имени"),
         BotCommand("check", "Проверить уведомления вручную"),
         BotCommand("cancel", "Отменить текущую операцию"),
     ]
@@ -1689,8 +1700,9 @@ def main() -> None:
     
     logger.info("Запуск бота...")
     
-    # Создаём updater и dispatcher
-    updater = Updater(token=bot_token, use_context=True)
+    # Создаём updater и dispatcher; диалоги, user_data и bot_data хранятся в БД (persistence.py)
+    bot_persistence = persistence.SQLitePersistence()
+    updater = Updater(token=bot_token, use_context=True, persistence=bot_persistence)
     dispatcher = updater.dispatcher
     bot = updater.bot
 
@@ -1733,6 +1745,12 @@ def main() -> None:
     
     # Обработчик команды /list
     dispatcher.add_handler(CommandHandler('list', list_birthdays))
+    dispatcher.add_handler(CallbackQueryHandler(list_page_callback, pattern=r'^list:[np]:'))
+    
+    # Экспорт событий в файл
+    dispatcher.add_handler(CommandHandler('export', export_command))
+    dispatcher.add_handler(CommandHandler('find', find_command))
+    dispatcher.add_handler(CallbackQueryHandler(export_callback, pattern=r'^export:'))
     
     # Обработчик команды /check (ручная проверка уведомлений)
     dispatcher.add_handler(CommandHandler('check', check_notifications))
@@ -1762,7 +1780,9 @@ def main() -> None:
             WAITING_REMIND_DAYS: [MessageHandler(Filters.text & ~Filters.command, add_remind_days)],
             WAITING_USERNAME: [MessageHandler((Filters.text | Filters.contact) & ~Filters.command, add_username)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='add',
+        persistent=True,
     )
     dispatcher.add_handler(add_handler)
     
@@ -1775,7 +1795,9 @@ def main() -> None:
         states={
             WAITING_DELETE_ID: [MessageHandler(Filters.text & ~Filters.command, delete_execute)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='delete',
+        persistent=True,
     )
     dispatcher.add_handler(delete_handler)
     
@@ -1792,7 +1814,9 @@ def main() -> None:
             WAITING_EDIT_REMIND_DAYS: [MessageHandler(Filters.text & ~Filters.command, edit_remind_days)],
             WAITING_EDIT_USERNAME: [MessageHandler((Filters.text | Filters.contact) & ~Filters.command, edit_username)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='edit',
+        persistent=True,
     )
     dispatcher.add_handler(edit_handler)
     
@@ -1800,10 +1824,15 @@ def main() -> None:
     import_handler = ConversationHandler(
         entry_points=[CommandHandler('import', import_start)],
         states={
-            WAITING_IMPORT_TEXT: [MessageHandler(Filters.text & ~Filters.command, import_receive_text)],
+            WAITING_IMPORT_TEXT: [
+                MessageHandler(Filters.text & ~Filters.command, import_receive_text),
+                MessageHandler(Filters.document, import_receive_document),
+            ],
             WAITING_IMPORT_CONFIRMATION: [MessageHandler(Filters.regex('^(✅ Подтвердить|❌ Отменить)$'), import_confirm)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='import',
+        persistent=True,
     )
     dispatcher.add_handler(import_handler)
     
@@ -1822,6 +1851,14 @@ def main() -> None:
 
     dispatcher.add_error_handler(on_error)
 
+    # Брошенные диалоги и данные пользователей удаляются из БД и памяти через PERSISTENCE_TTL_HOURS
+    updater.job_queue.run_repeating(
+        lambda context: bot_persistence.expire_idle(context.dispatcher),
+        interval=persistence.PERSISTENCE_EXPIRE_INTERVAL,
+        first=persistence.PERSISTENCE_EXPIRE_INTERVAL,
+        name='persistence_expire',
+    )
+
     # Запускаем бота: webhook на проде или polling локально
     if use_webhook:
         path = urlparse(webhook_url).path.strip("/") or ""
@@ -1836,6 +1873,9 @@ def main() -> None:
         logger.info("Бот запущен и готов к работе (long polling)")
         updater.start_polling()
     updater.idle()
+    congratulations.generation_pool.shutdown()
+    congratulations.client_manager.close()
+    database.close_all_connections()
 
 
 if __name__ == '__main__':
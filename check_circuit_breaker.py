@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Проверка предохранителя OpenAI на локальной заглушке API (без ключа и без сети).
+
+Поднимает HTTP-сервер, который отвечает как /v1/chat/completions: нормально, ошибкой 500
+или слишком медленно. Бот направляется на него через OPENAI_BASE_URL. Код выхода 1,
+если предохранитель ведёт себя не так, как ожидается.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Настройки до импорта модулей бота: они читаются при импорте
+os.environ["OPENAI_API_KEY"] = "sk-test-" + "x" * 40
+os.environ["CONGRATS_STREAMING"] = "0"
+os.environ.pop("OPENAI_HTTPS_PROXY", None)
+os.environ.pop("OPENAI_PROXY", None)
+
+import congratulations
+import database
+
+# Режим заглушки: ok, error (500), slow (ответ дольше бюджета), unauthorized (401)
+# или trickle (поток, каждый фрагмент быстрее бюджета, а весь ответ — дольше)
+MODE = {"value": "ok"}
+LATENCY_BUDGET = 0.5
+COOLDOWN = 1.0
+
+
+class StubOpenAI(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        mode = MODE["value"]
+        if mode == "error":
+            self._reply(500, {"error": {"message": "stub failure", "type": "server_error"}})
+            return
+        if mode == "unauthorized":
+            self._reply(401, {"error": {"message": "Incorrect API key provided", "type": "invalid_request_error",
+                                        "code": "invalid_api_key"}})
+            return
+        if mode == "trickle" and request.get("stream"):
+            self._trickle()
+            return
+        if mode == "slow":
+            time.sleep(LATENCY_BUDGET * 2)
+        self._reply(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "stub",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "С днём рождения!"}}],
+        })
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент уже ушёл по таймауту
+            pass
+
+    def _trickle(self):
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for word in ["С ", "днём ", "рождения", "!"] * 3:
+                chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": "stub", "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(LATENCY_BUDGET / 4)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def generate() -> str:
+    return congratulations.generate_congratulation("Тест", use_cache=False)
+
+
+def main() -> int:
+    if not congratulations.OPENAI_AVAILABLE:
+        print("Пакет openai не установлен")
+        return 1
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    congratulations.breaker = congratulations.CircuitBreaker(
+        failure_threshold=3, window=5, cooldown=COOLDOWN, latency_budget=LATENCY_BUDGET
+    )
+    breaker = congratulations.breaker
+
+    failed = 0
+
+    def check(name: str, condition: bool):
+        nonlocal failed
+        print(f"[{'OK' if condition else 'FAIL'}] {name}: {breaker.snapshot()}")
+        if not condition:
+            failed += 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.DB_NAME = os.path.join(tmp_dir, "birthdays.db")
+        database.init_db()
+
+        check("сервис отвечает", generate() == "С днём рождения!" and breaker.state == congratulations.BREAKER_CLOSED)
+
+        MODE["value"] = "error"
+        for _ in range(3):
+            generate()
+        check("после 3 ошибок 500 предохранитель разомкнут", breaker.state == congratulations.BREAKER_OPEN)
+
+        started = time.monotonic()
+        text = generate()
+        check("пока разомкнут, ответ сразу", text == congratulations.UNAVAILABLE_TEXT and time.monotonic() - started < 0.1)
+
+        time.sleep(COOLDOWN)
+        check("после паузы — полуоткрыт", breaker.state == congratulations.BREAKER_HALF_OPEN)
+        generate()
+        check("неудачная проба снова размыкает", breaker.state == congratulations.BREAKER_OPEN)
+
+        time.sleep(COOLDOWN)
+        MODE["value"] = "ok"
+        check("удачная проба замыкает", generate() == "С днём рождения!" and breaker.state == congratulations.BREAKER_CLOSED)
+
+        MODE["value"] = "slow"
+        started = time.monotonic()
+        for _ in range(3):
+            generate()
+        elapsed = time.monotonic() - started
+        check("медленные ответы обрываются по бюджету и размыкают",
+              breaker.state == congratulations.BREAKER_OPEN and elapsed < LATENCY_BUDGET * 3 + 1)
+
+        time.sleep(COOLDOWN)
+        MODE["value"] = "unauthorized"
+        generate()
+        check("ошибка ключа в пробном запросе не замыкает", breaker.state == congratulations.BREAKER_HALF_OPEN)
+        MODE["value"] = "ok"
+        check("следующая проба проходит и замыкает",
+              generate() == "С днём рождения!" and breaker.state == congratulations.BREAKER_CLOSED)
+
+        MODE["value"] = "trickle"
+        congratulations.CONGRATS_STREAMING = True
+        partial = []
+        started = time.monotonic()
+        congratulations.generate_congratulation("Тест", use_cache=False, on_partial=partial.append)
+        elapsed = time.monotonic() - started
+        check("медленный поток обрывается по общему бюджету",
+              bool(partial) and elapsed < LATENCY_BUDGET + LATENCY_BUDGET / 4 + 0.2 and breaker.snapshot()["failures"] == 1)
+        congratulations.CONGRATS_STREAMING = False
+
+        congratulations.client_manager.close()
+        database.close_all_connections()
+
+    server.shutdown()
+    if failed:
+        print(f"Проверок не пройдено: {failed}")
+        return 1
+    print("Предохранитель работает.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
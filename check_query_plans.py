@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Проверка планов запросов database.py: ни один запрос не должен читать всю таблицу.
+
+Создаёт временную БД, вызывает функции database.py, перехватывает выполненные SQL-запросы
+и прогоняет каждый через EXPLAIN QUERY PLAN. Код выхода 1, если найден полный проход по таблице.
+"""
+import os
+import sys
+import tempfile
+from datetime import date
+
+import database
+
+# Служебные запросы (транзакции, PRAGMA) и отметки срабатывания триггеров ("-- TRIGGER ...") не проверяем
+SKIP_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "CREATE", "DROP", "ALTER", "EXPLAIN", "--")
+
+# Алиасы CTE из констант (WITH targets ... VALUES), проход по ним допустим
+CTE_ALIASES = ("t",)
+
+# Известные допустимые проходы целиком: (начало запроса, строка плана). SCAN по покрывающему
+# индексу — тоже полный проход, поэтому каждый такой запрос разрешается здесь отдельно
+ALLOWED_SCANS = (
+    # Различные маски дней напоминаний: в remind_masks строка на набор дней, их единицы
+    ("SELECT remind_mask_0, remind_mask_1, remind_mask_2, remind_mask_3, remind_mask_4, remind_mask_5 FROM remind_masks",
+     "SCAN remind_masks"),
+    # Размер кеша поздравлений: таблица ограничена CONGRATS_CACHE_MAX_ENTRIES записями
+    ("SELECT COUNT(*) FROM congratulation_cache",
+     "SCAN congratulation_cache USING COVERING INDEX idx_congratulation_cache_last_used"),
+    # Вытеснение из кеша: ORDER BY last_used_at LIMIT N читает только первые N записей индекса
+    ("DELETE FROM congratulation_cache WHERE rowid IN",
+     "SCAN congratulation_cache USING COVERING INDEX idx_congratulation_cache_last_used"),
+)
+
+
+def is_full_scan(sql: str, detail: str) -> bool:
+    """SCAN по таблице или индексу, кроме CTE, констант, FTS5 (MATCH) и запросов из ALLOWED_SCANS."""
+    if not detail.startswith("SCAN "):
+        return False
+    if "VIRTUAL TABLE INDEX" in detail or detail.endswith("CONSTANT ROWS"):
+        return False
+    if any(sql.startswith(prefix) and detail == allowed for prefix, allowed in ALLOWED_SCANS):
+        return False
+    return detail.split()[1] not in CTE_ALIASES
+
+
+def run_queries(user_id: int) -> None:
+    """Вызвать функции database.py, чьи запросы нужно проверить."""
+    today = date.today()
+    database.add_birthday(user_id, "Иван Петров", "1990-03-15", "ivan")
+    database.add_birthday(user_id, "Новый Год", "1900-01-01", None, "holiday", "Новый Год", "0,7")
+    database.add_birthdays_bulk(user_id, [("Анна", "1985-07-01", None, "birthday", None)], dedupe=True)
+    birthday_id = database.get_all_birthdays(user_id)[0][0]
+    database.get_birthday_by_id(birthday_id, user_id)
+    database.update_birthday(birthday_id, user_id, "Иван Петров", "1990-03-16", "ivan", remind_days="0,1")
+    database.update_birthday(birthday_id, user_id, "Иван Петров", "1990-03-16", "ivan")
+    list(database.iter_user_birthdays(user_id, batch_size=1))
+    rows, _, _ = database.get_birthdays_page(user_id, limit=1)
+    database.get_birthdays_page(user_id, after=(rows[0][7], rows[0][0]), limit=1)
+    database.get_birthdays_page(user_id, before=(rows[0][7], rows[0][0]), limit=1)
+    database.search_birthdays(user_id, "иван пет")
+    database.search_birthdays(user_id, "ivan", with_username=True)
+    database.get_active_remind_offsets()
+    database.get_notification_candidates(today)
+    database.get_notification_candidates(today, user_id=user_id)
+    database.get_notification_candidates(today, days_ahead=1)
+    database._next_occurrence_rolled_on = None
+    database.roll_next_occurrences(today)
+    database.enqueue_notifications([(birthday_id, user_id, 0, "🎉", True)], today)
+    outbox_ids = [row[0] for row in database.get_pending_notifications(today)]
+    database.get_pending_notifications_for_users(database.get_pending_notification_users(today), today)
+    database.mark_notifications_failed(outbox_ids)
+    database.mark_notifications_sent(outbox_ids)
+    database.purge_notification_outbox(today)
+    database.put_cached_congratulation("key", "model", "🎂", max_entries=1)
+    database.put_cached_congratulation("other", "model", "🎂", max_entries=1)
+    database.get_cached_congratulation("other", max_age=3600)
+    database.purge_congratulation_cache(max_age=3600)
+    database.save_bot_state([("user", "", "1", "{}"), ("bot", "prompt_wait_user", "1", "[1, 1]")],
+                            [("conversation", "edit", "[1, 1]")])
+    database.load_bot_state("user")
+    database.load_bot_state("conversation", "edit")
+    database.get_idle_bot_state(0)
+    database.delete_birthday(birthday_id, user_id)
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.DB_NAME = os.path.join(tmp_dir, "birthdays.db")
+        database.init_db()
+
+        statements = []
+        conn = database.get_connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            run_queries(user_id=1)
+        finally:
+            conn.set_trace_callback(None)
+
+        failed = 0
+        seen = set()
+        for sql in statements:
+            sql = " ".join(sql.split())
+            if sql.upper().startswith(SKIP_PREFIXES) or sql in seen:
+                continue
+            seen.add(sql)
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+            scans = [detail for detail in plan if is_full_scan(sql, detail)]
+            status = "FULL SCAN" if scans else "OK"
+            print(f"[{status}] {sql[:120]}")
+            for detail in plan:
+                print("    ", detail)
+            if scans:
+                failed += 1
+
+        database.close_all_connections()
+
+    if failed:
+        print(f"Запросов с полным проходом по таблице: {failed}")
+        return 1
+    print("Все запросы используют индексы.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Проверка рассылки sender.NotificationSender на фейковом боте (без Telegram и без сети).
+
+Фейковый бот записывает время каждой отправки и по заданию отвечает RetryAfter. Проверяется
+общий лимит сообщений в секунду, минимальный интервал между сообщениями в один чат и то,
+что после RetryAfter рассылка ждёт указанное время и повторяет сообщение. Код выхода 1,
+если рассылка ведёт себя не так, как ожидается.
+"""
+import sys
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+from sender import NOTIFY_GLOBAL_RATE, NOTIFY_PER_CHAT_INTERVAL, NotificationSender, OutgoingMessage
+
+# Лимиты проверяются с теми же значениями, с которыми идёт рассылка (NOTIFY_* из окружения)
+GLOBAL_RATE = NOTIFY_GLOBAL_RATE
+PER_CHAT_INTERVAL = NOTIFY_PER_CHAT_INTERVAL
+RETRY_AFTER = 1
+# Погрешность таймеров и планировщика потоков
+TOLERANCE = 0.02
+
+
+class FakeBot:
+    """send_message записывает (chat_id, text, время); сообщения из flood отвечают RetryAfter."""
+
+    def __init__(self, flood=None):
+        self.sent = []
+        self.floods = []
+        # text -> сколько раз подряд ответить RetryAfter
+        self._flood = dict(flood or {})
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        now = time.monotonic()
+        with self._lock:
+            if self._flood.get(text, 0) > 0:
+                self._flood[text] -= 1
+                self.floods.append((chat_id, text, now))
+                raise RetryAfter(RETRY_AFTER)
+            self.sent.append((chat_id, text, now))
+
+
+def messages(chats: int, per_chat: int):
+    return [OutgoingMessage(chat_id, f"{chat_id}:{n}", key=(chat_id, n))
+            for n in range(per_chat) for chat_id in range(chats)]
+
+
+def max_burst(times, rate: float) -> float:
+    """Насколько число отправок в каком-либо промежутке превышает rate * длина + 1 (запас bucket)."""
+    times = sorted(times)
+    worst = 0.0
+    for i in range(len(times)):
+        for j in range(i + 1, len(times)):
+            worst = max(worst, (j - i + 1) - (rate * (times[j] - times[i]) + 1))
+    return worst
+
+
+def min_chat_gap(sent) -> float:
+    last = {}
+    gap = float('inf')
+    for chat_id, _, at in sorted(sent, key=lambda item: item[2]):
+        if chat_id in last:
+            gap = min(gap, at - last[chat_id])
+        last[chat_id] = at
+    return gap
+
+
+def chat_order_kept(sent) -> bool:
+    texts = {}
+    for chat_id, text, _ in sorted(sent, key=lambda item: item[2]):
+        texts.setdefault(chat_id, []).append(int(text.split(':')[1]))
+    return all(numbers == sorted(numbers) for numbers in texts.values())
+
+
+def main() -> int:
+    failed = 0
+
+    def check(name: str, condition: bool, details: str = ""):
+        nonlocal failed
+        print(f"[{'OK' if condition else 'FAIL'}] {name}{': ' + details if details else ''}")
+        if not condition:
+            failed += 1
+
+    # Общий лимит: по сообщению в 2 * GLOBAL_RATE чатов (интервал в чат не мешает), потоков хватает с запасом
+    chats = int(GLOBAL_RATE * 2)
+    bot = FakeBot()
+    sender = NotificationSender(bot, workers=16, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL)
+    stats = sender.send_all(messages(chats=chats, per_chat=1))
+    times = [at for _, _, at in bot.sent]
+    burst = max_burst(times, GLOBAL_RATE)
+    check("все сообщения отправлены", stats.sent == chats and stats.failed == 0, repr(stats))
+    check(f"не больше {GLOBAL_RATE} сообщений в секунду", burst <= 0.5, f"превышение {burst:.2f} сообщения")
+    check("скорость близка к лимиту", stats.throughput >= GLOBAL_RATE * 0.7, f"{stats.throughput:.1f} msg/s")
+
+    # Интервал в чат: 2 чата по 3 сообщения
+    bot = FakeBot()
+    sender = NotificationSender(bot, workers=4, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL)
+    sender.send_all(messages(chats=2, per_chat=3))
+    gap = min_chat_gap(bot.sent)
+    check(f"между сообщениями в чат не меньше {PER_CHAT_INTERVAL} с", gap >= PER_CHAT_INTERVAL - TOLERANCE,
+          f"минимум {gap:.3f} с")
+    check("порядок сообщений в чате сохранён", chat_order_kept(bot.sent))
+
+    # RetryAfter: первое сообщение чата 0 получает flood control, рассылка ждёт и повторяет его
+    bot = FakeBot(flood={"0:0": 1})
+    sender = NotificationSender(bot, workers=4, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL)
+    stats = sender.send_all(messages(chats=4, per_chat=2))
+    flood_at = bot.floods[0][2] if bot.floods else None
+    retried = [at for chat_id, text, at in bot.sent if text == "0:0"]
+    check("сообщение после RetryAfter отправлено повторно",
+          stats.sent == 8 and stats.failed == 0 and stats.retries == 1 and len(retried) == 1, repr(stats))
+    if flood_at is not None and retried:
+        waited = retried[0] - flood_at
+        check(f"повтор не раньше чем через {RETRY_AFTER} с", waited >= RETRY_AFTER - TOLERANCE, f"через {waited:.3f} с")
+        # Пауза общая: другие чаты тоже ждут (кроме уже получивших токен до паузы)
+        during_pause = [at for _, _, at in bot.sent if flood_at + 0.1 < at < flood_at + RETRY_AFTER - TOLERANCE]
+        check("во время паузы рассылка стоит", not during_pause, f"отправлено во время паузы: {len(during_pause)}")
+
+    # Повторы ограничены max_retries: после них сообщение считается неотправленным, остальные идут дальше
+    bot = FakeBot(flood={"0:0": 10})
+    sender = NotificationSender(bot, workers=2, global_rate=1000, per_chat_interval=0, max_retries=2)
+    sender.bucket.pause = lambda seconds: None
+    stats = sender.send_all(messages(chats=2, per_chat=2))
+    check("после max_retries сообщение не отправлено",
+          stats.failed == 1 and stats.failed_keys == [(0, 0)] and stats.retries == 2 and stats.sent == 3, repr(stats))
+
+    if failed:
+        print(f"Проверок не пройдено: {failed}")
+        return 1
+    print("Рассылка соблюдает лимиты.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,603 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+# OpenAI для генерации поздравлений (опционально)
+try:
+    import openai
+    import httpx
+    OPENAI_AVAILABLE = True
+except ImportError:
+    OPENAI_AVAILABLE = False
+    httpx = None
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Пул генерации: сколько запросов к OpenAI идут одновременно, сколько ждут в очереди
+# и сколько генераций может быть в работе у одного пользователя
+OPENAI_WORKERS = int(os.getenv('OPENAI_WORKERS', '4'))
+OPENAI_QUEUE_SIZE = int(os.getenv('OPENAI_QUEUE_SIZE', '32'))
+OPENAI_PER_USER_LIMIT = int(os.getenv('OPENAI_PER_USER_LIMIT', '1'))
+
+# Сколько подряд сетевых ошибок терпим, прежде чем пересоздать клиент (и пул соединений)
+OPENAI_CLIENT_MAX_FAILURES = int(os.getenv('OPENAI_CLIENT_MAX_FAILURES', '3'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+
+# Предохранитель: если из последних OPENAI_BREAKER_WINDOW запросов OPENAI_BREAKER_FAILURES неудачны
+# (ошибка сети, 5xx/429 или ответ дольше OPENAI_LATENCY_BUDGET секунд), запросы к OpenAI не делаются
+# OPENAI_BREAKER_COOLDOWN секунд, затем пропускается один пробный запрос
+OPENAI_LATENCY_BUDGET = float(os.getenv('OPENAI_LATENCY_BUDGET', '20'))
+OPENAI_BREAKER_WINDOW = int(os.getenv('OPENAI_BREAKER_WINDOW', '10'))
+OPENAI_BREAKER_FAILURES = int(os.getenv('OPENAI_BREAKER_FAILURES', '5'))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv('OPENAI_BREAKER_COOLDOWN', '30'))
+
+# Кеш поздравлений в БД: срок жизни записи и максимальное число записей (лишние вытесняются LRU)
+CONGRATS_CACHE_TTL = int(float(os.getenv('CONGRATS_CACHE_TTL_HOURS', '168')) * 3600)
+CONGRATS_CACHE_MAX_ENTRIES = int(os.getenv('CONGRATS_CACHE_MAX_ENTRIES', '10000'))
+
+# Потоковая генерация: текст появляется в сообщении по мере генерации. Сообщение редактируется
+# не чаще раза в CONGRATS_STREAM_EDIT_INTERVAL секунд (лимиты Telegram на редактирование)
+CONGRATS_STREAMING = os.getenv('CONGRATS_STREAMING', '1').strip().lower() in ('1', 'true', 'yes')
+CONGRATS_STREAM_EDIT_INTERVAL = float(os.getenv('CONGRATS_STREAM_EDIT_INTERVAL', '1.0'))
+
+# Ночная предгенерация: сколько запросов к OpenAI идут одновременно
+CONGRATS_PREGENERATE_CONCURRENCY = int(os.getenv('CONGRATS_PREGENERATE_CONCURRENCY', '2'))
+
+# Результат постановки задачи в пул
+ACCEPTED = 'accepted'
+USER_BUSY = 'user_busy'
+QUEUE_FULL = 'queue_full'
+
+# Пресеты промптов для кнопок «Свой промпт»
+PROMPT_PRESETS = {
+    "humor": "короткое и с юмором",
+    "touching": "трогательное и душевное",
+    "family": "для близкого человека, тёплое",
+}
+
+
+def _client_config():
+    """Текущие настройки клиента из окружения: (ключ, прокси, адрес API)."""
+    key = (os.getenv('OPENAI_API_KEY') or '').strip()
+    proxy_url = (os.getenv("OPENAI_HTTPS_PROXY") or os.getenv("OPENAI_PROXY") or "").strip()
+    # Другой адрес API (совместимый сервис или локальная заглушка для проверки)
+    base_url = (os.getenv("OPENAI_BASE_URL") or "").strip()
+    return key, proxy_url, base_url
+
+
+class OpenAIClientManager:
+    """
+    Один клиент OpenAI на процесс.
+
+    Клиент создаётся при первом запросе и переиспользуется: httpx держит keep-alive соединения
+    (в том числе через прокси), так что TLS-рукопожатие не повторяется на каждое поздравление.
+    Пул соединений рассчитан на pool_size одновременных запросов. Клиент пересоздаётся, если
+    изменились OPENAI_API_KEY / OPENAI_HTTPS_PROXY / OPENAI_BASE_URL или подряд случилось max_failures сетевых ошибок.
+    """
+
+    def __init__(self, pool_size: int = OPENAI_WORKERS, max_failures: int = OPENAI_CLIENT_MAX_FAILURES,
+                 timeout: float = OPENAI_TIMEOUT):
+        self.pool_size = max(1, pool_size)
+        self.max_failures = max(1, max_failures)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._client = None
+        self._http_client = None
+        self._config = None
+        self._failures = 0
+
+    def get(self):
+        """Клиент OpenAI или None, если ключ не задан. Для неподдерживаемых регионов задайте OPENAI_HTTPS_PROXY."""
+        if not OPENAI_AVAILABLE:
+            return None
+        config = _client_config()
+        with self._lock:
+            # Клиент (или None при неверном ключе) уже собран для этих настроек
+            if self._config is not None and config == self._config:
+                return self._client
+            self._close_locked()
+            self._config = config
+            self._client = self._build(*config)
+            return self._client
+
+    def _build(self, key: str, proxy_url: str, base_url: str):
+        if not key:
+            return None
+        # Плейсхолдер из примера или слишком короткий ключ
+        if key.startswith('sk-your-') or len(key) < 40:
+            logger.warning("OpenAI: ключ похож на плейсхолдер или слишком короткий (длина %s)", len(key))
+            return None
+        logger.info("OpenAI: ключ загружен, длина %s символов", len(key))
+        # Без повторов внутри SDK: иначе одна генерация может длиться (1 + max_retries) бюджетов.
+        # Неудачный запрос учитывает предохранитель, повторяет пользователь кнопкой
+        options = {"api_key": key, "max_retries": 0}
+        if base_url:
+            options["base_url"] = base_url
+            logger.info("OpenAI: адрес API %s", base_url)
+        if httpx is None:
+            return openai.OpenAI(**options)
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        if proxy_url:
+            try:
+                self._http_client = httpx.Client(proxy=proxy_url, timeout=self.timeout, limits=limits)
+                logger.info("OpenAI: запросы идут через прокси")
+                return openai.OpenAI(http_client=self._http_client, **options)
+            except Exception as e:
+                logger.warning("OpenAI: не удалось создать клиент с прокси %s: %s", proxy_url[:50], e)
+        self._http_client = httpx.Client(timeout=self.timeout, limits=limits)
+        return openai.OpenAI(http_client=self._http_client, **options)
+
+    def report_success(self) -> None:
+        """Запрос прошёл — сбросить счётчик сетевых ошибок."""
+        with self._lock:
+            self._failures = 0
+
+    def report_transport_failure(self) -> None:
+        """Сетевая ошибка; после max_failures подряд клиент будет пересоздан при следующем запросе."""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                logger.warning(f"OpenAI: {self._failures} сетевых ошибок подряд, клиент будет пересоздан")
+                self._close_locked()
+
+    def close(self) -> None:
+        """Закрыть клиент и его соединения."""
+        with self._lock:
+            self._close_locked()
+
+    def _close_locked(self) -> None:
+        if self._http_client is not None:
+            try:
+                self._http_client.close()
+            except Exception as e:
+                logger.warning(f"OpenAI: ошибка при закрытии HTTP-клиента: {e}")
+        self._client = None
+        self._http_client = None
+        self._config = None
+        self._failures = 0
+
+
+# Общий клиент бота; соединений в пуле столько же, сколько потоков генерации
+client_manager = OpenAIClientManager()
+
+
+def _is_transport_error(e: Exception) -> bool:
+    """Ошибка соединения или таймаут (а не ответ API с кодом ошибки)."""
+    if OPENAI_AVAILABLE and isinstance(e, openai.APIConnectionError):
+        return True
+    return httpx is not None and isinstance(e, httpx.TransportError)
+
+
+def _is_service_failure(e: Exception) -> bool:
+    """Сбой на стороне сервиса (сеть, таймаут, 5xx, 429) — учитывается предохранителем."""
+    if _is_transport_error(e):
+        return True
+    if OPENAI_AVAILABLE and isinstance(e, openai.APIStatusError):
+        return e.status_code >= 500 or e.status_code == 429
+    return False
+
+
+# Состояния предохранителя
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для запросов к OpenAI.
+
+    closed — запросы идут, результаты последних window запросов запоминаются. Неудача — сбой сервиса
+    или ответ дольше latency_budget секунд. Когда неудач в окне failure_threshold, предохранитель
+    размыкается (open): cooldown секунд запросы не делаются, пользователь сразу получает ответ
+    «сервис недоступен». Затем half_open — пропускается один пробный запрос: успех замыкает
+    предохранитель, неудача снова размыкает.
+
+    Каждый allow(), вернувший True, должен завершаться record_success(), record_failure()
+    или record_neutral().
+    """
+
+    def __init__(self, failure_threshold: int = OPENAI_BREAKER_FAILURES, window: int = OPENAI_BREAKER_WINDOW,
+                 cooldown: float = OPENAI_BREAKER_COOLDOWN, latency_budget: float = OPENAI_LATENCY_BUDGET,
+                 clock=time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.window = max(self.failure_threshold, window)
+        self.cooldown = cooldown
+        self.latency_budget = latency_budget
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = BREAKER_CLOSED
+        self._results = deque(maxlen=self.window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._last_latency = None
+
+    def allow(self) -> bool:
+        """Можно ли сейчас делать запрос."""
+        with self._lock:
+            if self._state == BREAKER_CLOSED:
+                return True
+            if self._state == BREAKER_OPEN:
+                if self._clock() - self._opened_at < self.cooldown:
+                    return False
+                self._state = BREAKER_HALF_OPEN
+                logger.info("OpenAI: предохранитель полуоткрыт, пробный запрос")
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self, latency: float) -> None:
+        """Запрос завершился ответом сервиса за latency секунд (медленный ответ считается неудачей)."""
+        if latency > self.latency_budget:
+            logger.warning(f"OpenAI: ответ за {latency:.1f} с — дольше бюджета {self.latency_budget:.0f} с")
+            self.record_failure()
+            return
+        with self._lock:
+            self._last_latency = latency
+            self._probe_in_flight = False
+            if self._state != BREAKER_CLOSED:
+                logger.info("OpenAI: предохранитель замкнут, сервис снова отвечает")
+                self._state = BREAKER_CLOSED
+                self._results.clear()
+            self._results.append(True)
+
+    def record_neutral(self) -> None:
+        """Запрос не удался не по вине сервиса (неверный ключ, 400): пробный запрос освобождается,
+        но состояние не меняется — такая ошибка не говорит, что сервис восстановился."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Запрос не удался по вине сервиса."""
+        with self._lock:
+            self._probe_in_flight = False
+            if self._state == BREAKER_HALF_OPEN:
+                self._open_locked()
+                return
+            if self._state == BREAKER_OPEN:
+                return
+            self._results.append(False)
+            if self._results.count(False) >= self.failure_threshold:
+                self._open_locked()
+
+    def _open_locked(self) -> None:
+        self._state = BREAKER_OPEN
+        self._opened_at = self._clock()
+        logger.warning(f"OpenAI: предохранитель разомкнут на {self.cooldown:.0f} с")
+
+    @property
+    def state(self) -> str:
+        """closed, open или half_open (open по истечении cooldown показывается как half_open)."""
+        with self._lock:
+            if self._state == BREAKER_OPEN and self._clock() - self._opened_at >= self.cooldown:
+                return BREAKER_HALF_OPEN
+            return self._state
+
+    def snapshot(self) -> dict:
+        """Состояние для логов и диагностики."""
+        state = self.state
+        with self._lock:
+            retry_in = 0.0
+            if state == BREAKER_OPEN:
+                retry_in = max(0.0, self.cooldown - (self._clock() - self._opened_at))
+            return {
+                "state": state,
+                "failures": self._results.count(False),
+                "calls": len(self._results),
+                "retry_in": round(retry_in, 1),
+                "last_latency": self._last_latency,
+            }
+
+
+# Общий предохранитель бота
+breaker = CircuitBreaker()
+
+UNAVAILABLE_TEXT = "Сервис генерации временно недоступен. Попробуйте через пару минут."
+
+
+def _model() -> str:
+    return (os.getenv("OPENAI_MODEL") or "gpt-4o-mini").strip()
+
+
+def congratulation_cache_key(model: str, full_name: str, custom_prompt: Optional[str] = None) -> str:
+    """Ключ кеша: хеш модели, имени и промпта (пресета или своего текста)."""
+    prompt = (custom_prompt or "").strip()
+    return hashlib.sha256(f"{model}\0{full_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def _messages(full_name: str, custom_prompt: Optional[str]):
+    """Сообщения чата для запроса поздравления."""
+    system = (
+        "Ты помогаешь писать короткие тёплые поздравления с днём рождения. "
+        "Пиши от первого лица, как будто пользователь сам поздравляет. "
+        "Без обрамления в кавычки и без подписи в конце. Один короткий абзац."
+    )
+    user_msg = f"Напиши поздравление с днём рождения для {full_name}."
+    if custom_prompt and custom_prompt.strip():
+        user_msg += f" Дополнительные пожелания: {custom_prompt.strip()}"
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user_msg},
+    ]
+
+
+def _request_congratulation(client, model: str, full_name: str, custom_prompt: Optional[str], timeout: float):
+    """Запрос к OpenAI не дольше timeout секунд. Возвращает (текст, успех); при ошибке текст — сообщение для пользователя."""
+    started = time.monotonic()
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            messages=_messages(full_name, custom_prompt),
+            max_tokens=300,
+            timeout=timeout,
+        )
+        client_manager.report_success()
+        breaker.record_success(time.monotonic() - started)
+        text = (response.choices[0].message.content or "").strip()
+        if not text:
+            return "Не удалось сгенерировать поздравление.", False
+        return text, True
+    except Exception as e:
+        if _is_service_failure(e):
+            # Ожидаемый сбой сервиса: без трейсбека, предохранитель учтёт его
+            logger.warning(f"OpenAI недоступен при генерации поздравления: {e}")
+            breaker.record_failure()
+        else:
+            logger.exception("Ошибка OpenAI при генерации поздравления")
+            breaker.record_neutral()
+        if _is_transport_error(e):
+            client_manager.report_transport_failure()
+        err_str = str(e).lower()
+        if "401" in err_str or "invalid_api_key" in err_str or "incorrect api key" in err_str:
+            return "Проверьте OPENAI_API_KEY в файле openai.env — ключ неверный или не задан.", False
+        return "Ошибка при генерации. Попробуйте позже или проверьте openai.env.", False
+
+
+def _stream_congratulation(client, model: str, full_name: str, custom_prompt: Optional[str],
+                           on_partial: Callable[[str], None], min_interval: float, timeout: float):
+    """
+    Потоковый запрос к OpenAI (не дольше timeout секунд): по мере прихода текста вызывает
+    on_partial(текст_на_данный_момент), не чаще раза в min_interval секунд (первый фрагмент — сразу).
+
+    Returns:
+        (текст, успех); при ошибке или пустом ответе успех False — вызывающий делает обычный запрос
+    """
+    started = time.monotonic()
+    try:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=_messages(full_name, custom_prompt),
+            max_tokens=300,
+            stream=True,
+            timeout=timeout,
+        )
+        parts = []
+        last_update = None
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            now = time.monotonic()
+            # timeout у httpx — ожидание одного фрагмента, а не всего ответа: медленно текущий
+            # поток обрывается здесь, когда общий бюджет исчерпан
+            if now - started > timeout:
+                stream.close()
+                logger.warning(f"OpenAI: потоковый ответ не уложился в {timeout:.0f} с, обрываем")
+                breaker.record_failure()
+                return "", False
+            if last_update is None or now - last_update >= min_interval:
+                last_update = now
+                on_partial("".join(parts).strip())
+        client_manager.report_success()
+        breaker.record_success(time.monotonic() - started)
+        text = "".join(parts).strip()
+        return text, bool(text)
+    except Exception as e:
+        logger.warning(f"OpenAI: потоковая генерация не удалась, повторяем обычным запросом: {e}")
+        if _is_service_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_neutral()
+        if _is_transport_error(e):
+            client_manager.report_transport_failure()
+        return "", False
+
+
+def generate_congratulation(full_name: str, custom_prompt: Optional[str] = None, use_cache: bool = True,
+                            on_partial: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Сгенерировать текст поздравления с днём рождения через OpenAI.
+
+    Удачные ответы сохраняются в кеш (congratulation_cache) по ключу (модель, имя, промпт),
+    повторный запрос с теми же параметрами отвечается из кеша без обращения к OpenAI.
+
+    Args:
+        full_name: Имя именинника
+        custom_prompt: Дополнительные пожелания (стиль, тон и т.д.), опционально
+        use_cache: False — не брать текст из кеша («Другой вариант»); новый текст всё равно сохраняется
+        on_partial: Если задан (и CONGRATS_STREAMING включён) — потоковый режим: функция получает
+            промежуточный текст по мере генерации. При ошибке потока делается обычный запрос
+
+    Returns:
+        Текст поздравления или сообщение об ошибке
+    """
+    model = _model()
+    cache_key = congratulation_cache_key(model, full_name, custom_prompt)
+    if use_cache:
+        cached = database.get_cached_congratulation(cache_key, CONGRATS_CACHE_TTL)
+        if cached:
+            return cached
+
+    client = client_manager.get()
+    if not client:
+        return "Сервис генерации недоступен. Задайте OPENAI_API_KEY в openai.env (локально) или в переменных окружения (на сервере)."
+
+    if not breaker.allow():
+        return UNAVAILABLE_TEXT
+    # Один бюджет на всю генерацию: обычный запрос после неудачного потока получает только остаток
+    deadline = time.monotonic() + breaker.latency_budget
+    ok = False
+    if on_partial is not None and CONGRATS_STREAMING:
+        text, ok = _stream_congratulation(client, model, full_name, custom_prompt, on_partial,
+                                          CONGRATS_STREAM_EDIT_INTERVAL, breaker.latency_budget)
+        if not ok and (deadline - time.monotonic() < 1 or not breaker.allow()):
+            return UNAVAILABLE_TEXT
+    if not ok:
+        text, ok = _request_congratulation(client, model, full_name, custom_prompt, deadline - time.monotonic())
+    if ok:
+        database.put_cached_congratulation(cache_key, model, text, CONGRATS_CACHE_MAX_ENTRIES)
+    return text
+
+
+def pregenerate_congratulations(full_names: Iterable[str],
+                                concurrency: int = CONGRATS_PREGENERATE_CONCURRENCY) -> int:
+    """
+    Заранее сгенерировать поздравления по умолчанию (без промпта) и положить их в кеш.
+
+    Имена, для которых в кеше уже есть свежий текст, пропускаются. Запросы идут в отдельном
+    пуле из concurrency потоков, пул интерактивной генерации не занимается.
+
+    Returns:
+        Количество новых поздравлений в кеше
+    """
+    if client_manager.get() is None:
+        logger.info("Предгенерация поздравлений пропущена: OpenAI не настроен")
+        return 0
+    model = _model()
+    names = []
+    for full_name in dict.fromkeys(full_names):
+        if not database.get_cached_congratulation(congratulation_cache_key(model, full_name), CONGRATS_CACHE_TTL):
+            names.append(full_name)
+    if not names:
+        return 0
+
+    def generate(full_name: str) -> bool:
+        client = client_manager.get()
+        if client is None or not breaker.allow():
+            return False
+        text, ok = _request_congratulation(client, model, full_name, None, breaker.latency_budget)
+        if ok:
+            database.put_cached_congratulation(congratulation_cache_key(model, full_name), model, text,
+                                               CONGRATS_CACHE_MAX_ENTRIES)
+        return ok
+
+    pending = iter(names)
+    pending_lock = threading.Lock()
+
+    def worker() -> int:
+        # Поток живёт одну предгенерацию: берёт имена из общей очереди, а в конце закрывает
+        # своё соединение с БД, иначе каждый ночной запуск оставлял бы открытые соединения
+        done = 0
+        try:
+            while True:
+                with pending_lock:
+                    full_name = next(pending, None)
+                if full_name is None:
+                    return done
+                done += generate(full_name)
+        finally:
+            database.close_connection()
+
+    workers = min(max(1, concurrency), len(names))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pregenerate') as executor:
+        generated = sum(executor.map(lambda _: worker(), range(workers)))
+    logger.info(f"Предгенерация поздравлений: {generated} из {len(names)}")
+    return generated
+
+
+class GenerationPool:
+    """
+    Ограниченный пул генерации поздравлений.
+
+    Запросы к OpenAI выполняются в отдельных потоках (не больше workers одновременно),
+    поэтому потоки диспетчера Telegram не блокируются на время генерации. Всего в работе
+    и в очереди не больше workers + queue_size задач, у одного пользователя — не больше
+    per_user_limit. Готовый текст передаётся в callback(text) из потока пула.
+
+    generate — функция (full_name, custom_prompt, use_cache=..., on_partial=...) -> str, по умолчанию generate_congratulation.
+    """
+
+    def __init__(self, workers: int = OPENAI_WORKERS, queue_size: int = OPENAI_QUEUE_SIZE,
+                 per_user_limit: int = OPENAI_PER_USER_LIMIT, generate: Callable = None):
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, queue_size)
+        self.per_user_limit = max(1, per_user_limit)
+        self._generate = generate or generate_congratulation
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='congratulate')
+        self._lock = threading.Lock()
+        self._total = 0
+        self._per_user = {}
+
+    def submit(self, user_id: int, full_name: str, custom_prompt: Optional[str],
+               callback: Callable[[str], None], use_cache: bool = True,
+               on_partial: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Поставить генерацию в очередь. use_cache=False — сгенерировать новый вариант в обход кеша,
+        on_partial — получать промежуточный текст (потоковый режим).
+
+        Returns:
+            ACCEPTED, USER_BUSY (у пользователя уже есть генерация в работе) или QUEUE_FULL
+        """
+        with self._lock:
+            if self._per_user.get(user_id, 0) >= self.per_user_limit:
+                return USER_BUSY
+            if self._total >= self.capacity:
+                logger.warning(f"Очередь генерации заполнена ({self._total}), запрос пользователя {user_id} отклонён")
+                return QUEUE_FULL
+            self._total += 1
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            self._executor.submit(self._run, user_id, full_name, custom_prompt, callback, use_cache, on_partial)
+        except RuntimeError:
+            # Пул уже остановлен
+            self._release(user_id)
+            return QUEUE_FULL
+        return ACCEPTED
+
+    def _run(self, user_id: int, full_name: str, custom_prompt: Optional[str], callback: Callable[[str], None],
+             use_cache: bool, on_partial: Optional[Callable[[str], None]]) -> None:
+        try:
+            text = self._generate(full_name, custom_prompt, use_cache=use_cache, on_partial=on_partial)
+        except Exception as e:
+            logger.error(f"Ошибка при генерации поздравления для пользователя {user_id}: {e}")
+            text = "Ошибка при генерации. Попробуйте позже."
+        finally:
+            self._release(user_id)
+        try:
+            callback(text)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке поздравления пользователю {user_id}: {e}")
+
+    def _release(self, user_id: int) -> None:
+        with self._lock:
+            self._total -= 1
+            left = self._per_user.get(user_id, 0) - 1
+            if left > 0:
+                self._per_user[user_id] = left
+            else:
+                self._per_user.pop(user_id, None)
+
+    @property
+    def pending(self) -> int:
+        """Задач в работе и в очереди."""
+        with self._lock:
+            return self._total
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Остановить пул, дождавшись начатых генераций."""
+        self._executor.shutdown(wait=wait)
+
+
+# Общий пул бота; потоки создаются при первой задаче
+generation_pool = GenerationPool()
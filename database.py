@@ -1,8 +1,15 @@
 import sqlite3
 import logging
 import os
-from datetime import datetime
-from typing import List, Optional, Tuple
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import calendar
+from datetime import date, datetime
+from typing import Iterator, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -10,55 +17,169 @@ logger = logging.getLogger(__name__)
 DB_DIR = os.getenv('DB_DIR', '.')
 DB_NAME = os.path.join(DB_DIR, 'birthdays.db')
 
+# Настройки соединений SQLite (можно переопределить переменными окружения)
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '8192'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+
+# Кеш записей пользователей в памяти (get_all_birthdays): сколько пользователей и байт держать
+USER_CACHE_MAX_USERS = int(os.getenv('USER_CACHE_MAX_USERS', '1000'))
+USER_CACHE_MAX_BYTES = int(os.getenv('USER_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Соединения живут по одному на поток (воркеры dispatcher, планировщик),
+# чтобы не платить за connect и загрузку схемы на каждый запрос
+_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    """Открыть новое соединение с WAL и настроенными PRAGMA."""
+    # isolation_level=None: транзакциями управляем сами через transaction().
+    # check_same_thread=False только чтобы close_all_connections() мог закрыть соединения
+    # других потоков при остановке; запросы по-прежнему идут из потока-владельца.
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.create_function('next_occurrence', 3, _next_occurrence_ordinal, deterministic=True)
+    with _connections_lock:
+        _connections.add(conn)
+    logger.debug(f"Открыто соединение с БД {DB_NAME} (поток {threading.current_thread().name})")
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Получить соединение текущего потока (создаётся при первом обращении).
+    
+    Если путь к БД изменился (DB_NAME переопределён), соединение пересоздаётся.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'db_name', None) == DB_NAME:
+        return conn
+    if conn is not None:
+        _close(conn)
+    conn = _connect()
+    _local.conn = conn
+    _local.db_name = DB_NAME
+    return conn
+
+
+def _close(conn: sqlite3.Connection) -> None:
+    with _connections_lock:
+        _connections.discard(conn)
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Ошибка при закрытии соединения с БД: {e}")
+
+
+def close_connection() -> None:
+    """Закрыть соединение текущего потока."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _close(conn)
+        _local.conn = None
+
+
+def close_all_connections() -> None:
+    """Закрыть все открытые соединения (при остановке бота)."""
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии соединения с БД: {e}")
+    _local.conn = None
+
+
+@contextmanager
+def transaction(write: bool = False):
+    """
+    Контекстный менеджер транзакции на соединении текущего потока.
+    
+    Args:
+        write: True для пишущих транзакций (BEGIN IMMEDIATE — блокировка записи берётся сразу,
+               без риска SQLITE_BUSY при повышении уровня блокировки)
+    
+    Yields:
+        Курсор; при выходе без исключения транзакция фиксируется, иначе откатывается.
+        Вложенные вызовы выполняются в рамках внешней транзакции.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
 
 def init_db():
     """Инициализация базы данных и создание таблицы birthdays."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS birthdays (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                full_name TEXT NOT NULL,
-                birth_date TEXT NOT NULL,
-                telegram_username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with transaction(write=True) as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS birthdays (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    full_name TEXT NOT NULL,
+                    birth_date TEXT NOT NULL,
+                    telegram_username TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         logger.info("База данных инициализирована успешно")
         
         # Выполняем миграции для существующих баз
         migrate_add_username()
         migrate_add_event_fields()
         migrate_add_remind_days()
+        migrate_add_month_day()
+        migrate_add_remind_mask()
+        migrate_add_remind_masks_table()
+        migrate_add_next_occurrence()
+        migrate_add_indexes()
+        migrate_add_notification_outbox()
+        migrate_add_congratulation_cache()
+        migrate_add_row_version()
+        migrate_add_bot_state()
+        migrate_add_fulltext_search()
         
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         raise
 
 
+def _table_columns(cursor, table: str) -> List[str]:
+    """Список колонок таблицы."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in cursor.fetchall()]
+
+
 def migrate_add_username():
     """Миграция: добавить колонку telegram_username если её нет."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Проверяем существует ли колонка telegram_username
-        cursor.execute("PRAGMA table_info(birthdays)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'telegram_username' not in columns:
-            logger.info("Выполняется миграция: добавление колонки telegram_username")
-            cursor.execute('ALTER TABLE birthdays ADD COLUMN telegram_username TEXT')
-            conn.commit()
-            logger.info("Миграция успешно выполнена")
-        
-        conn.close()
+        with transaction(write=True) as cursor:
+            # Проверяем существует ли колонка telegram_username
+            columns = _table_columns(cursor, 'birthdays')
+            
+            if 'telegram_username' not in columns:
+                logger.info("Выполняется миграция: добавление колонки telegram_username")
+                cursor.execute('ALTER TABLE birthdays ADD COLUMN telegram_username TEXT')
+                logger.info("Миграция успешно выполнена")
     except Exception as e:
         logger.error(f"Ошибка при миграции базы данных: {e}")
         raise
@@ -67,30 +188,23 @@ def migrate_add_username():
 def migrate_add_event_fields():
     """Миграция: добавить колонки event_type и event_name если их нет."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Проверяем существующие колонки
-        cursor.execute("PRAGMA table_info(birthdays)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        # Добавляем event_type если его нет
-        if 'event_type' not in columns:
-            logger.info("Выполняется миграция: добавление колонки event_type")
-            cursor.execute("ALTER TABLE birthdays ADD COLUMN event_type TEXT DEFAULT 'birthday'")
-            # Устанавливаем 'birthday' для существующих записей
-            cursor.execute("UPDATE birthdays SET event_type = 'birthday' WHERE event_type IS NULL")
-            conn.commit()
-            logger.info("Колонка event_type добавлена успешно")
-        
-        # Добавляем event_name если его нет
-        if 'event_name' not in columns:
-            logger.info("Выполняется миграция: добавление колонки event_name")
-            cursor.execute("ALTER TABLE birthdays ADD COLUMN event_name TEXT")
-            conn.commit()
-            logger.info("Колонка event_name добавлена успешно")
-        
-        conn.close()
+        with transaction(write=True) as cursor:
+            # Проверяем существующие колонки
+            columns = _table_columns(cursor, 'birthdays')
+            
+            # Добавляем event_type если его нет
+            if 'event_type' not in columns:
+                logger.info("Выполняется миграция: добавление колонки event_type")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN event_type TEXT DEFAULT 'birthday'")
+                # Устанавливаем 'birthday' для существующих записей
+                cursor.execute("UPDATE birthdays SET event_type = 'birthday' WHERE event_type IS NULL")
+                logger.info("Колонка event_type добавлена успешно")
+            
+            # Добавляем event_name если его нет
+            if 'event_name' not in columns:
+                logger.info("Выполняется миграция: добавление колонки event_name")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN event_name TEXT")
+                logger.info("Колонка event_name добавлена успешно")
     except Exception as e:
         logger.error(f"Ошибка при миграции базы данных (event fields): {e}")
         raise
@@ -99,24 +213,520 @@ def migrate_add_event_fields():
 def migrate_add_remind_days():
     """Миграция: добавить колонку remind_days (за сколько дней напоминать)."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(birthdays)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'remind_days' not in columns:
-            logger.info("Выполняется миграция: добавление колонки remind_days")
-            cursor.execute("ALTER TABLE birthdays ADD COLUMN remind_days TEXT DEFAULT '0,1,3,7'")
-            cursor.execute("UPDATE birthdays SET remind_days = '0,1,3,7' WHERE remind_days IS NULL")
-            conn.commit()
-            logger.info("Колонка remind_days добавлена")
-        conn.close()
+        with transaction(write=True) as cursor:
+            columns = _table_columns(cursor, 'birthdays')
+            if 'remind_days' not in columns:
+                logger.info("Выполняется миграция: добавление колонки remind_days")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN remind_days TEXT DEFAULT '0,1,3,7'")
+                cursor.execute("UPDATE birthdays SET remind_days = '0,1,3,7' WHERE remind_days IS NULL")
+                logger.info("Колонка remind_days добавлена")
     except Exception as e:
         logger.error(f"Ошибка при миграции remind_days: {e}")
         raise
 
 
+def migrate_add_month_day():
+    """
+    Миграция: добавить колонки birth_month и birth_day.
+    
+    По ним в SQL считается дата следующего события, без разбора birth_date каждой строки.
+    """
+    try:
+        with transaction(write=True) as cursor:
+            columns = _table_columns(cursor, 'birthdays')
+            if 'birth_month' not in columns:
+                logger.info("Выполняется миграция: добавление колонок birth_month и birth_day")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN birth_month INTEGER")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN birth_day INTEGER")
+                cursor.execute(
+                    "UPDATE birthdays SET birth_month = CAST(substr(birth_date, 6, 2) AS INTEGER), "
+                    "birth_day = CAST(substr(birth_date, 9, 2) AS INTEGER)"
+                )
+                logger.info("Колонки birth_month и birth_day добавлены")
+    except Exception as e:
+        logger.error(f"Ошибка при миграции birth_month/birth_day: {e}")
+        raise
+
+
+def migrate_add_remind_mask():
+    """
+    Миграция: добавить битовые маски дней напоминаний remind_mask_0..remind_mask_5.
+    
+    Бит N слова W означает «напоминать за W * 63 + N дней». Маски заполняются из текстового remind_days
+    (по одному UPDATE на каждое различное значение).
+    """
+    try:
+        with transaction(write=True) as cursor:
+            columns = _table_columns(cursor, 'birthdays')
+            if REMIND_MASK_COLUMNS[0] not in columns:
+                logger.info("Выполняется миграция: добавление колонок remind_mask")
+                default_mask = encode_remind_mask(DEFAULT_REMIND_DAYS)
+                for column, default in zip(REMIND_MASK_COLUMNS, default_mask):
+                    cursor.execute(f"ALTER TABLE birthdays ADD COLUMN {column} INTEGER NOT NULL DEFAULT {default}")
+                cursor.execute('SELECT DISTINCT remind_days FROM birthdays')
+                assignments = ', '.join(f'{column} = ?' for column in REMIND_MASK_COLUMNS)
+                for (remind_days,) in cursor.fetchall():
+                    cursor.execute(
+                        f'UPDATE birthdays SET {assignments} WHERE remind_days IS ?',
+                        encode_remind_mask(remind_days) + (remind_days,)
+                    )
+                logger.info("Колонки remind_mask добавлены")
+            cursor.execute("DROP INDEX IF EXISTS idx_birthdays_remind_days")
+    except Exception as e:
+        logger.error(f"Ошибка при миграции remind_mask: {e}")
+        raise
+
+
+def migrate_add_remind_masks_table():
+    """
+    Миграция: таблица remind_masks — различные маски дней напоминаний и число записей с каждой.
+    
+    Поддерживается триггерами на birthdays; строка удаляется, когда маской больше никто не пользуется.
+    Вместо DISTINCT по всем записям get_active_remind_offsets читает эту таблицу из единиц строк,
+    поэтому индекс idx_birthdays_remind_mask больше не нужен.
+    """
+    columns = ', '.join(REMIND_MASK_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in REMIND_MASK_COLUMNS)
+    old_match = ' AND '.join(f'{column} = old.{column}' for column in REMIND_MASK_COLUMNS)
+    increment = (
+        f"INSERT INTO remind_masks ({columns}, rows) VALUES ({new_values}, 1) "
+        f"ON CONFLICT ({columns}) DO UPDATE SET rows = rows + 1;"
+    )
+    decrement = (
+        f"UPDATE remind_masks SET rows = rows - 1 WHERE {old_match}; "
+        f"DELETE FROM remind_masks WHERE {old_match} AND rows <= 0;"
+    )
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'remind_masks'")
+            if cursor.fetchone() is None:
+                logger.info("Выполняется миграция: создание таблицы remind_masks")
+                mask_columns = ', '.join(f'{column} INTEGER NOT NULL' for column in REMIND_MASK_COLUMNS)
+                cursor.execute(
+                    f"CREATE TABLE remind_masks ({mask_columns}, rows INTEGER NOT NULL, "
+                    f"PRIMARY KEY ({columns})) WITHOUT ROWID"
+                )
+                cursor.execute(
+                    f"INSERT INTO remind_masks ({columns}, rows) "
+                    f"SELECT {columns}, COUNT(*) FROM birthdays GROUP BY {columns}"
+                )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS birthdays_remind_masks_insert AFTER INSERT ON birthdays BEGIN {increment} END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS birthdays_remind_masks_delete AFTER DELETE ON birthdays BEGIN {decrement} END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS birthdays_remind_masks_update AFTER UPDATE OF {columns} ON birthdays "
+                f"WHEN {' OR '.join(f'new.{column} != old.{column}' for column in REMIND_MASK_COLUMNS)} "
+                f"BEGIN {decrement} {increment} END"
+            )
+            cursor.execute("DROP INDEX IF EXISTS idx_birthdays_remind_mask")
+    except Exception as e:
+        logger.error(f"Ошибка при создании таблицы remind_masks: {e}")
+        raise
+
+
+def migrate_add_next_occurrence():
+    """
+    Миграция: добавить колонку next_occurrence (ordinal ближайшей даты события) с индексами.
+    
+    Значение пересчитывается при добавлении/изменении записи и сдвигается на год вперёд
+    функцией roll_next_occurrences() только у записей, чья дата уже прошла.
+    """
+    try:
+        with transaction(write=True) as cursor:
+            columns = _table_columns(cursor, 'birthdays')
+            if 'next_occurrence' not in columns:
+                logger.info("Выполняется миграция: добавление колонки next_occurrence")
+                cursor.execute("ALTER TABLE birthdays ADD COLUMN next_occurrence INTEGER")
+                cursor.execute(
+                    "UPDATE birthdays SET next_occurrence = next_occurrence(birth_month, birth_day, ?)",
+                    (date.today().toordinal(),)
+                )
+                logger.info("Колонка next_occurrence добавлена")
+            # Выборка по дате события теперь идёт через next_occurrence
+            cursor.execute("DROP INDEX IF EXISTS idx_birthdays_month_day")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_next_occurrence ON birthdays (next_occurrence)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_user_next_occurrence ON birthdays (user_id, next_occurrence)")
+    except Exception as e:
+        logger.error(f"Ошибка при миграции next_occurrence: {e}")
+        raise
+
+
+def migrate_add_indexes():
+    """
+    Миграция: индексы для выборок по пользователю.
+    
+    get_all_birthdays фильтрует по user_id и сортирует по birth_date — индекс (user_id, birth_date)
+    убирает полный проход и сортировку. Выборки по (id, user_id) идут по первичному ключу (rowid).
+    Проверка планов запросов: python check_query_plans.py
+    """
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_user_birth_date ON birthdays (user_id, birth_date)")
+    except Exception as e:
+        logger.error(f"Ошибка при создании индексов: {e}")
+        raise
+
+
+def migrate_add_notification_outbox():
+    """
+    Миграция: таблица notification_outbox — очередь напоминаний на отправку.
+    
+    Уникальный ключ (birthday_id, occurrence, days_until) не даёт поставить одно и то же
+    напоминание дважды (повторный запуск проверки, /check, перезапуск посреди рассылки).
+    """
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    birthday_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    occurrence INTEGER NOT NULL,
+                    days_until INTEGER NOT NULL,
+                    notify_date INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    buttons INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP,
+                    UNIQUE (birthday_id, occurrence, days_until)
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_notify_date ON notification_outbox (notify_date)")
+            # Для дайджестов очередь разбирается по пользователям
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_notify_date_user ON notification_outbox (notify_date, user_id)")
+    except Exception as e:
+        logger.error(f"Ошибка при создании таблицы notification_outbox: {e}")
+        raise
+
+
+def migrate_add_row_version():
+    """
+    Миграция: колонка version — номер правки записи.
+    
+    update_birthday увеличивает её на 1; по паре (id, version) inline-режим строит постоянные
+    id результатов, так что Telegram может кешировать ответы, а изменённая запись получает новый id.
+    """
+    try:
+        with transaction(write=True) as cursor:
+            if 'version' not in _table_columns(cursor, 'birthdays'):
+                logger.info("Выполняется миграция: добавление колонки version")
+                cursor.execute('ALTER TABLE birthdays ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    except Exception as e:
+        logger.error(f"Ошибка при миграции version: {e}")
+        raise
+
+
+def migrate_add_congratulation_cache():
+    """
+    Миграция: таблица congratulation_cache — сгенерированные поздравления.
+    
+    Ключ — хеш (модель, имя, промпт); created_at ограничивает срок жизни записи,
+    last_used_at задаёт порядок вытеснения давно не использованных (LRU). Время — unix-секунды.
+    """
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS congratulation_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    last_used_at INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_congratulation_cache_created ON congratulation_cache (created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_congratulation_cache_last_used ON congratulation_cache (last_used_at)")
+    except Exception as e:
+        logger.error(f"Ошибка при создании таблицы congratulation_cache: {e}")
+        raise
+
+
+def migrate_add_bot_state():
+    """
+    Миграция: таблица bot_state — состояние диалогов, user_data и bot_data (см. persistence.py).
+    
+    Одна строка на запись: (kind, name, key) — вид данных, имя диалога или ключ bot_data
+    и ключ внутри него; value — JSON. updated_at (unix-секунды) нужен для удаления брошенных записей.
+    """
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at INTEGER NOT NULL,
+                    PRIMARY KEY (kind, name, key)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_state_updated ON bot_state (updated_at)")
+    except Exception as e:
+        logger.error(f"Ошибка при создании таблицы bot_state: {e}")
+        raise
+
+
+# Полнотекстовый поиск (FTS5): False, если SQLite собран без FTS5 — тогда поиск идёт только в памяти
+FTS_AVAILABLE = False
+# Колонки birthdays в индексе; user_id — чтобы MATCH сразу отбирал записи одного пользователя
+FTS_COLUMNS = ('full_name', 'event_name', 'telegram_username', 'user_id')
+# Веса колонок для bm25: имя важнее названия события и username, user_id в ранжировании не участвует
+FTS_WEIGHTS = (10.0, 5.0, 2.0, 0.0)
+_FTS_TERM_RE = re.compile(r'\w+')
+
+
+def _fts_values(prefix: str) -> str:
+    """Значения колонок индекса для триггеров и загрузки: ё заменяется на е (unicode61 считает их разными буквами)."""
+    return ', '.join(
+        f"replace(replace({prefix}{column}, 'ё', 'е'), 'Ё', 'Е')" if column != 'user_id' else f'{prefix}{column}'
+        for column in FTS_COLUMNS
+    )
+
+
+def migrate_add_fulltext_search():
+    """
+    Миграция: таблица birthdays_fts (FTS5) для поиска по имени, названию события и username.
+    
+    Таблица без собственного содержимого (content=''): текст хранится только в birthdays,
+    индекс поддерживают триггеры. Триггер обновления срабатывает только при изменении
+    индексируемых колонок, так что ночной сдвиг next_occurrence индекс не трогает.
+    При создании таблицы в неё загружаются уже существующие записи.
+    """
+    global FTS_AVAILABLE
+    columns = ', '.join(FTS_COLUMNS)
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'birthdays_fts'")
+            if cursor.fetchone() is None:
+                logger.info("Выполняется миграция: создание полнотекстового индекса birthdays_fts")
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE birthdays_fts USING fts5({columns}, content='', "
+                    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+                )
+                cursor.execute(f"INSERT INTO birthdays_fts (rowid, {columns}) SELECT id, {_fts_values('')} FROM birthdays")
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS birthdays_fts_insert AFTER INSERT ON birthdays BEGIN "
+                f"INSERT INTO birthdays_fts (rowid, {columns}) VALUES (new.id, {_fts_values('new.')}); END"
+            )
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS birthdays_fts_delete AFTER DELETE ON birthdays BEGIN "
+                f"INSERT INTO birthdays_fts (birthdays_fts, rowid, {columns}) VALUES ('delete', old.id, {_fts_values('old.')}); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS birthdays_fts_update AFTER UPDATE OF {columns} ON birthdays BEGIN "
+                f"INSERT INTO birthdays_fts (birthdays_fts, rowid, {columns}) VALUES ('delete', old.id, {_fts_values('old.')}); "
+                f"INSERT INTO birthdays_fts (rowid, {columns}) VALUES (new.id, {_fts_values('new.')}); END"
+            )
+        FTS_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            logger.error(f"Ошибка при создании полнотекстового индекса: {e}")
+            raise
+        logger.warning(f"SQLite собран без FTS5, поиск будет работать только по индексу в памяти: {e}")
+
+
+def next_occurrence(month: int, day: int, today: Optional[date] = None) -> date:
+    """
+    Ближайшая дата события (сегодня или позже) по месяцу и дню.
+    
+    29 февраля в невисокосный год отмечается 28 февраля.
+    """
+    if today is None:
+        today = date.today()
+    
+    def occurrence(year: int) -> date:
+        if (month, day) == (2, 29) and not calendar.isleap(year):
+            return date(year, 2, 28)
+        return date(year, month, day)
+    
+    result = occurrence(today.year)
+    if result < today:
+        result = occurrence(today.year + 1)
+    return result
+
+
+def _next_occurrence_ordinal(month: int, day: int, today_ordinal: int) -> Optional[int]:
+    """SQL-функция next_occurrence(month, day, today_ordinal) -> ordinal ближайшей даты."""
+    try:
+        return next_occurrence(month, day, date.fromordinal(today_ordinal)).toordinal()
+    except Exception:
+        return None
+
+
+# День, на который next_occurrence уже сдвинуты (в пределах процесса)
+_next_occurrence_rolled_on = None
+
+
+def roll_next_occurrences(today: Optional[date] = None) -> int:
+    """
+    Сдвинуть next_occurrence вперёд у записей, чья дата уже прошла.
+    
+    Затрагивает только строки с next_occurrence < today (диапазон по индексу),
+    повторный вызов в тот же день ничего не делает.
+    
+    Returns:
+        Количество обновлённых записей
+    """
+    global _next_occurrence_rolled_on
+    if today is None:
+        today = date.today()
+    if _next_occurrence_rolled_on == today:
+        return 0
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute(
+                'UPDATE birthdays SET next_occurrence = next_occurrence(birth_month, birth_day, ?) '
+                'WHERE next_occurrence < ? OR next_occurrence IS NULL',
+                (today.toordinal(), today.toordinal())
+            )
+            rolled = cursor.rowcount
+        _next_occurrence_rolled_on = today
+        if rolled:
+            logger.info(f"Обновлена дата следующего события у {rolled} записей")
+        return rolled
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении next_occurrence: {e}")
+        return 0
+
+
+def _month_day(birth_date: str) -> Tuple[int, int]:
+    """Месяц и день из даты в формате YYYY-MM-DD."""
+    return int(birth_date[5:7]), int(birth_date[8:10])
+
+
 DEFAULT_REMIND_DAYS = '0,1,3,7'
 
+# Дни напоминаний хранятся битовой маской из нескольких 63-битных слов (знаковый INTEGER SQLite),
+# чтобы проверка «напоминать ли сегодня» была одним целочисленным выражением в SQL
+MAX_REMIND_DAYS = 365
+REMIND_MASK_BITS = 63
+REMIND_MASK_WORDS = MAX_REMIND_DAYS // REMIND_MASK_BITS + 1
+REMIND_MASK_COLUMNS = tuple(f'remind_mask_{word}' for word in range(REMIND_MASK_WORDS))
+
+
+def _remind_offsets(remind_days: Optional[str]) -> Set[int]:
+    """Разобрать строку дней напоминаний ('0,1,3,7') в множество. Пустое значение — только в день события."""
+    offsets = {int(x.strip()) for x in (remind_days or DEFAULT_REMIND_DAYS).split(",") if x.strip().isdigit()}
+    offsets = {offset for offset in offsets if offset <= MAX_REMIND_DAYS}
+    return offsets or {0}
+
+
+def encode_remind_mask(remind_days: Optional[str]) -> Tuple[int, ...]:
+    """Строка дней напоминаний ('0,1,3,7') -> кортеж слов маски (по одному на колонку remind_mask_N)."""
+    words = [0] * REMIND_MASK_WORDS
+    for offset in _remind_offsets(remind_days):
+        words[offset // REMIND_MASK_BITS] |= 1 << (offset % REMIND_MASK_BITS)
+    return tuple(words)
+
+
+def decode_remind_mask(words) -> Set[int]:
+    """Кортеж слов маски -> множество дней напоминаний."""
+    offsets = set()
+    for word_index, word in enumerate(words):
+        bit = 0
+        while word:
+            if word & 1:
+                offsets.add(word_index * REMIND_MASK_BITS + bit)
+            word >>= 1
+            bit += 1
+    return offsets
+
+
+class UserRowsCache:
+    """
+    LRU-кеш записей пользователей (результатов get_all_birthdays) в памяти процесса.
+
+    Ограничен числом пользователей и примерным объёмом в байтах. Версия строк хранится
+    только рядом с закешированными строками: у пользователя вне кеша версия — общий счётчик
+    записей, который растёт при каждой записи в БД (add_birthday, update_birthday,
+    delete_birthday, add_birthdays_bulk). Поэтому после записи версия пользователя всегда
+    новая, а память не растёт с числом пользователей. Строки, прочитанные до записи,
+    в кеш не попадают: put сохраняет их, только если версия не изменилась с начала чтения.
+    """
+
+    def __init__(self, max_users: int, max_bytes: int):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (version, rows, size)
+        self._writes = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, user_id: int) -> int:
+        """Текущая версия строк пользователя (меняется при каждой его записи)."""
+        with self._lock:
+            return self._version(user_id)
+
+    def get(self, user_id: int) -> Optional[tuple]:
+        """Строки пользователя из кеша или None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: int, version: int, rows: tuple) -> None:
+        """Сохранить строки, прочитанные при версии version (устаревшие не сохраняются)."""
+        size = _rows_size(rows)
+        if self.max_users <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if self._version(user_id) != version:
+                return
+            self._discard(user_id)
+            self._entries[user_id] = (version, rows, size)
+            self._bytes += size
+            while len(self._entries) > self.max_users or self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, user_id: int) -> None:
+        """Сменить версию пользователя и выбросить его строки."""
+        with self._lock:
+            self._writes += 1
+            self._discard(user_id)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        """Счётчики для логов и диагностики."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "users": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _version(self, user_id: int) -> int:
+        entry = self._entries.get(user_id)
+        return entry[0] if entry is not None else self._writes
+
+    def _discard(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+
+def _rows_size(rows) -> int:
+    """Примерный объём строк в памяти: кортежи плюс их значения."""
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows
+    )
+
+
+user_rows_cache = UserRowsCache(USER_CACHE_MAX_USERS, USER_CACHE_MAX_BYTES)
+
 
 def add_birthday(user_id: int, full_name: str, birth_date: str, telegram_username: Optional[str] = None,
                  event_type: str = 'birthday', event_name: Optional[str] = None, remind_days: Optional[str] = None) -> bool:
@@ -138,16 +748,17 @@ def add_birthday(user_id: int, full_name: str, birth_date: str, telegram_usernam
     if remind_days is None:
         remind_days = DEFAULT_REMIND_DAYS
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'INSERT INTO birthdays (user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days)
-        )
+        birth_month, birth_day = _month_day(birth_date)
+        occurrence = next_occurrence(birth_month, birth_day).toordinal()
+        with transaction(write=True) as cursor:
+            cursor.execute(
+                'INSERT INTO birthdays (user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days, birth_month, birth_day, '
+                f'next_occurrence, {", ".join(REMIND_MASK_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?{", ?" * REMIND_MASK_WORDS})',
+                (user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days, birth_month, birth_day, occurrence)
+                + encode_remind_mask(remind_days)
+            )
+        user_rows_cache.invalidate(user_id)
         
-        conn.commit()
-        conn.close()
         username_info = f" (@{telegram_username})" if telegram_username else ""
         event_info = f" [{event_type}]" if event_type != 'birthday' else ""
         logger.info(f"Добавлен день рождения: {full_name}{username_info} ({birth_date}){event_info} для пользователя {user_id}")
@@ -157,30 +768,140 @@ def add_birthday(user_id: int, full_name: str, birth_date: str, telegram_usernam
         return False
 
 
-def get_all_birthdays(user_id: int) -> List[Tuple[int, str, str, Optional[str], str, Optional[str], str]]:
+# Результаты add_birthdays_bulk по каждой записи
+BULK_ADDED = 'added'
+BULK_DUPLICATE = 'duplicate'
+BULK_INVALID = 'invalid'
+
+
+def add_birthdays_bulk(user_id: int, records, dedupe: bool = False) -> List[str]:
+    """
+    Добавить много событий одной транзакцией (один executemany, один commit).
+    
+    Args:
+        user_id: Telegram ID пользователя
+        records: Итерируемое из кортежей (full_name, birth_date, telegram_username, event_type, event_name)
+        dedupe: Пропускать записи, у которых (full_name, birth_date) уже есть у пользователя или раньше в records
+    
+    Returns:
+        Список результатов по порядку records: BULK_ADDED, BULK_DUPLICATE или BULK_INVALID
+        (при ошибке БД все записи, которые должны были добавиться, — BULK_INVALID)
+    """
+    outcomes = []
+    rows = []
+    added_indexes = []
+    try:
+        with transaction(write=True) as cursor:
+            seen = set()
+            if dedupe:
+                cursor.execute('SELECT full_name, birth_date FROM birthdays WHERE user_id = ?', (user_id,))
+                seen = set(cursor.fetchall())
+            for full_name, birth_date, telegram_username, event_type, event_name in records:
+                try:
+                    birth_month, birth_day = _month_day(birth_date)
+                    occurrence = next_occurrence(birth_month, birth_day).toordinal()
+                except (TypeError, ValueError):
+                    outcomes.append(BULK_INVALID)
+                    continue
+                if dedupe:
+                    if (full_name, birth_date) in seen:
+                        outcomes.append(BULK_DUPLICATE)
+                        continue
+                    seen.add((full_name, birth_date))
+                added_indexes.append(len(outcomes))
+                outcomes.append(BULK_ADDED)
+                rows.append(
+                    (user_id, full_name, birth_date, telegram_username, event_type or 'birthday', event_name,
+                     DEFAULT_REMIND_DAYS, birth_month, birth_day, occurrence)
+                    + encode_remind_mask(DEFAULT_REMIND_DAYS)
+                )
+            if rows:
+                cursor.executemany(
+                    'INSERT INTO birthdays (user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days, birth_month, birth_day, '
+                    f'next_occurrence, {", ".join(REMIND_MASK_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?{", ?" * REMIND_MASK_WORDS})',
+                    rows
+                )
+        if rows:
+            user_rows_cache.invalidate(user_id)
+        logger.info(f"Импорт для пользователя {user_id}: добавлено {len(rows)} из {len(outcomes)}")
+        return outcomes
+    except Exception as e:
+        logger.error(f"Ошибка при массовом добавлении событий: {e}")
+        for index in added_indexes:
+            outcomes[index] = BULK_INVALID
+        return outcomes
+
+
+def get_all_birthdays(user_id: int) -> List[Tuple[int, str, str, Optional[str], str, Optional[str], str, int]]:
     """
     Получить все дни рождения для пользователя.
     
     Returns:
-        Список кортежей (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days)
+        Список кортежей (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days, version)
+    
+    Повторные вызовы отдаются из user_rows_cache, пока у пользователя не было записей в БД.
     """
+    rows = user_rows_cache.get(user_id)
+    if rows is not None:
+        return list(rows)
+    version = user_rows_cache.version(user_id)
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?) FROM birthdays WHERE user_id = ? ORDER BY birth_date',
-            (DEFAULT_REMIND_DAYS, user_id)
-        )
-        
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        with transaction() as cursor:
+            cursor.execute(
+                'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?), version '
+                'FROM birthdays WHERE user_id = ? ORDER BY birth_date',
+                (DEFAULT_REMIND_DAYS, user_id)
+            )
+            rows = cursor.fetchall()
+        user_rows_cache.put(user_id, version, tuple(rows))
+        return rows
     except Exception as e:
         logger.error(f"Ошибка при получении дней рождения: {e}")
         return []
 
 
+def search_birthdays(user_id: int, query: str, limit: int = 50, offset: int = 0,
+                     with_username: bool = False) -> List[Tuple[int, str, str, Optional[str], str, Optional[str], str, int]]:
+    """
+    Полнотекстовый поиск событий пользователя (FTS5) по началу слов имени, названия и username.
+    
+    Каждое слово запроса ищется как префикс, все слова должны найтись; результаты
+    упорядочены по bm25 с весами FTS_WEIGHTS.
+    
+    Args:
+        user_id: Telegram ID пользователя
+        query: Текст запроса
+        limit: Размер страницы
+        offset: Сколько результатов пропустить (для next_offset inline-режима)
+        with_username: Только записи с telegram_username
+    
+    Returns:
+        Список кортежей (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days, version);
+        пустой, если в запросе нет слов или FTS5 недоступен
+    """
+    terms = _FTS_TERM_RE.findall((query or '').replace('ё', 'е').replace('Ё', 'Е'))
+    if not terms or not FTS_AVAILABLE:
+        return []
+    # Слова запроса ищутся только в текстовых колонках: иначе запрос «1» совпал бы с user_id
+    match = (f'user_id:"{int(user_id)}" AND {{full_name event_name telegram_username}} : ('
+             + ' '.join(f'"{term}"*' for term in terms) + ')')
+    sql = (
+        'SELECT b.id, b.full_name, b.birth_date, b.telegram_username, b.event_type, b.event_name, COALESCE(b.remind_days, ?), b.version '
+        'FROM birthdays_fts JOIN birthdays b ON b.id = birthdays_fts.rowid '
+        'WHERE birthdays_fts MATCH ? AND b.user_id = ?'
+    )
+    if with_username:
+        sql += " AND b.telegram_username IS NOT NULL AND b.telegram_username != ''"
+    sql += f' ORDER BY bm25(birthdays_fts, {", ".join(map(str, FTS_WEIGHTS))}), b.full_name, b.id LIMIT ? OFFSET ?'
+    try:
+        with transaction() as cursor:
+            cursor.execute(sql, (DEFAULT_REMIND_DAYS, match, user_id, limit, offset))
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при полнотекстовом поиске: {e}")
+        return []
+
+
 def delete_birthday(birthday_id: int, user_id: int) -> bool:
     """
     Удалить день рождения.
@@ -193,19 +914,15 @@ def delete_birthday(birthday_id: int, user_id: int) -> bool:
         True если успешно удалено, False в случае ошибки
     """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'DELETE FROM birthdays WHERE id = ? AND user_id = ?',
-            (birthday_id, user_id)
-        )
-        
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        with transaction(write=True) as cursor:
+            cursor.execute(
+                'DELETE FROM birthdays WHERE id = ? AND user_id = ?',
+                (birthday_id, user_id)
+            )
+            deleted = cursor.rowcount > 0
         
         if deleted:
+            user_rows_cache.invalidate(user_id)
             logger.info(f"Удален день рождения с ID {birthday_id} для пользователя {user_id}")
         return deleted
     except Exception as e:
@@ -225,24 +942,27 @@ def update_birthday(birthday_id: int, user_id: int, full_name: str, birth_date:
         True если успешно обновлено, False в случае ошибки
     """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        if remind_days is not None:
-            cursor.execute(
-                'UPDATE birthdays SET full_name = ?, birth_date = ?, telegram_username = ?, event_type = ?, event_name = ?, remind_days = ? WHERE id = ? AND user_id = ?',
-                (full_name, birth_date, telegram_username, event_type, event_name, remind_days, birthday_id, user_id)
-            )
-        else:
-            cursor.execute(
-                'UPDATE birthdays SET full_name = ?, birth_date = ?, telegram_username = ?, event_type = ?, event_name = ? WHERE id = ? AND user_id = ?',
-                (full_name, birth_date, telegram_username, event_type, event_name, birthday_id, user_id)
-            )
-        
-        updated = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        birth_month, birth_day = _month_day(birth_date)
+        occurrence = next_occurrence(birth_month, birth_day).toordinal()
+        with transaction(write=True) as cursor:
+            if remind_days is not None:
+                mask_assignments = ', '.join(f'{column} = ?' for column in REMIND_MASK_COLUMNS)
+                cursor.execute(
+                    'UPDATE birthdays SET full_name = ?, birth_date = ?, telegram_username = ?, event_type = ?, event_name = ?, remind_days = ?, '
+                    f'birth_month = ?, birth_day = ?, next_occurrence = ?, {mask_assignments}, version = version + 1 WHERE id = ? AND user_id = ?',
+                    (full_name, birth_date, telegram_username, event_type, event_name, remind_days, birth_month, birth_day, occurrence)
+                    + encode_remind_mask(remind_days) + (birthday_id, user_id)
+                )
+            else:
+                cursor.execute(
+                    'UPDATE birthdays SET full_name = ?, birth_date = ?, telegram_username = ?, event_type = ?, event_name = ?, '
+                    'birth_month = ?, birth_day = ?, next_occurrence = ?, version = version + 1 WHERE id = ? AND user_id = ?',
+                    (full_name, birth_date, telegram_username, event_type, event_name, birth_month, birth_day, occurrence, birthday_id, user_id)
+                )
+            updated = cursor.rowcount > 0
         
         if updated:
+            user_rows_cache.invalidate(user_id)
             logger.info(f"Обновлен день рождения с ID {birthday_id} для пользователя {user_id}")
         return updated
     except Exception as e:
@@ -250,24 +970,173 @@ def update_birthday(birthday_id: int, user_id: int, full_name: str, birth_date:
         return False
 
 
-def get_all_birthdays_for_notifications() -> List[Tuple[int, int, str, str, Optional[str], str, Optional[str], str]]:
+def get_active_remind_offsets(user_id: Optional[int] = None) -> Set[int]:
     """
-    Получить все дни рождения для отправки уведомлений.
+    Получить все дни напоминаний, которые встречаются хотя бы у одной записи.
     
+    Для всех записей маски читаются из remind_masks (строка на различный набор дней, их единицы),
+    для одного пользователя — из его записей по индексу user_id.
+    
+    Args:
+        user_id: Только записи этого пользователя (None — все)
+    """
+    try:
+        with transaction() as cursor:
+            if user_id is None:
+                cursor.execute(f'SELECT {", ".join(REMIND_MASK_COLUMNS)} FROM remind_masks')
+            else:
+                cursor.execute(f'SELECT DISTINCT {", ".join(REMIND_MASK_COLUMNS)} FROM birthdays WHERE user_id = ?', (user_id,))
+            offsets = set()
+            for words in cursor.fetchall():
+                offsets |= decode_remind_mask(words)
+            return offsets
+    except Exception as e:
+        logger.error(f"Ошибка при получении дней напоминаний: {e}")
+        return set()
+
+
+def iter_user_birthdays(user_id: int, batch_size: int = 500,
+                        today: Optional[date] = None) -> Iterator[Tuple[int, str, str, Optional[str], str, Optional[str], str]]:
+    """
+    Все события пользователя в порядке наступления, порциями по batch_size строк.
+    
+    Каждая порция — отдельный запрос по индексу (user_id, next_occurrence) с продолжением
+    после последней строки (next_occurrence, id), так что в памяти не больше одной порции
+    и транзакция не держится открытой, пока потребитель обрабатывает строки.
+    
+    Yields:
+        Кортежи (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days)
+    """
+    if today is None:
+        today = date.today()
+    roll_next_occurrences(today)
+    after = None
+    while True:
+        query = (
+            'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?), next_occurrence '
+            'FROM birthdays WHERE user_id = ?'
+        )
+        params = [DEFAULT_REMIND_DAYS, user_id]
+        if after is not None:
+            query += ' AND (next_occurrence, id) > (?, ?)'
+            params.extend(after)
+        query += ' ORDER BY next_occurrence, id LIMIT ?'
+        params.append(batch_size)
+        try:
+            with transaction() as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при выгрузке событий пользователя: {e}")
+            return
+        for row in rows:
+            yield row[:7]
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][7], rows[-1][0])
+
+
+def get_birthdays_page(user_id: int, after: Optional[Tuple[int, int]] = None,
+                       before: Optional[Tuple[int, int]] = None, limit: int = 10,
+                       today: Optional[date] = None) -> Tuple[List[Tuple[int, str, str, Optional[str], str, Optional[str], int, int]], bool, bool]:
+    """
+    Одна страница событий пользователя в порядке наступления (keyset-пагинация без OFFSET).
+
+    Страница начинается сразу после курсора after или заканчивается перед курсором before —
+    курсор это (next_occurrence, id) крайней строки соседней страницы. Запрос идёт по индексу
+    (user_id, next_occurrence) и читает не больше limit + 1 строк, на какой бы странице ни был пользователь.
+
+    Args:
+        user_id: Telegram ID пользователя
+        after: Курсор для следующей страницы (None — с начала)
+        before: Курсор для предыдущей страницы (приоритетнее after)
+        limit: Размер страницы
+        today: Дата отсчёта (по умолчанию сегодня)
+
     Returns:
-        Список кортежей (id, user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days)
+        (строки, есть_предыдущая, есть_следующая); строки — кортежи
+        (id, full_name, birth_date, telegram_username, event_type, event_name, days_until, next_occurrence)
     """
+    if today is None:
+        today = date.today()
+    roll_next_occurrences(today)
+    query = (
+        'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, next_occurrence - ?, next_occurrence '
+        'FROM birthdays WHERE user_id = ?'
+    )
+    params = [today.toordinal(), user_id]
+    if before is not None:
+        query += ' AND (next_occurrence, id) < (?, ?) ORDER BY next_occurrence DESC, id DESC LIMIT ?'
+        params.extend(before)
+    else:
+        if after is not None:
+            query += ' AND (next_occurrence, id) > (?, ?)'
+            params.extend(after)
+        query += ' ORDER BY next_occurrence, id LIMIT ?'
+    params.append(limit + 1)
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id, user_id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?) FROM birthdays', (DEFAULT_REMIND_DAYS,))
+        with transaction() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы событий: {e}")
+        return [], False, False
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, after is not None, has_more
+
+
+def get_notification_candidates(today: Optional[date] = None, user_id: Optional[int] = None,
+                                days_ahead: int = 0) -> List[Tuple[int, int, str, str, Optional[str], str, Optional[str], int]]:
+    """
+    Получить только те записи, по которым сегодня нужно напомнить.
+    
+    Для каждого используемого дня напоминаний N по индексу next_occurrence выбираются события
+    на дату today + N, у которых в маске remind_mask установлен бит N.
+    
+    Args:
+        today: Дата проверки (по умолчанию сегодня)
+        user_id: Только записи этого пользователя (по индексу (user_id, next_occurrence)); None — все
+        days_ahead: Выбрать напоминания, которые придут через столько дней (даты событий сдвигаются,
+            а next_occurrence обновляется по настоящему today)
+    
+    Returns:
+        Список кортежей (id, user_id, full_name, birth_date, telegram_username, event_type, event_name, days_until)
+    """
+    if today is None:
+        today = date.today()
+    roll_next_occurrences(today)
+    try:
+        targets = []
+        for offset in sorted(get_active_remind_offsets(user_id)):
+            word, bit = divmod(offset, REMIND_MASK_BITS)
+            targets.append((offset, today.toordinal() + days_ahead + offset, word, bit))
+        if not targets:
+            return []
         
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        values = ', '.join('(?, ?, ?, ?)' for _ in targets)
+        params = [value for target in targets for value in target]
+        mask_word = 'CASE t.word ' + ' '.join(
+            f'WHEN {word} THEN b.{column}' for word, column in enumerate(REMIND_MASK_COLUMNS)
+        ) + ' END'
+        user_filter = ''
+        if user_id is not None:
+            user_filter = ' AND b.user_id = ?'
+            params.append(user_id)
+        with transaction() as cursor:
+            cursor.execute(
+                f'WITH targets(days_until, occurrence, word, bit) AS (VALUES {values}) '
+                'SELECT b.id, b.user_id, b.full_name, b.birth_date, b.telegram_username, b.event_type, b.event_name, t.days_until '
+                f'FROM targets t JOIN birthdays b ON b.next_occurrence = t.occurrence{user_filter} '
+                f'WHERE ({mask_word} >> t.bit) & 1 ORDER BY t.days_until, b.id',
+                params
+            )
+            return cursor.fetchall()
     except Exception as e:
-        logger.error(f"Ошибка при получении дней рождения для уведомлений: {e}")
+        logger.error(f"Ошибка при выборке записей для уведомлений: {e}")
         return []
 
 
@@ -279,17 +1148,299 @@ def get_birthday_by_id(birthday_id: int, user_id: int) -> Optional[Tuple[int, st
         Кортеж (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days) или None
     """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?) FROM birthdays WHERE id = ? AND user_id = ?',
-            (DEFAULT_REMIND_DAYS, birthday_id, user_id)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        return row
+        with transaction() as cursor:
+            cursor.execute(
+                'SELECT id, full_name, birth_date, telegram_username, event_type, event_name, COALESCE(remind_days, ?) FROM birthdays WHERE id = ? AND user_id = ?',
+                (DEFAULT_REMIND_DAYS, birthday_id, user_id)
+            )
+            return cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка при получении дня рождения по id: {e}")
         return None
 
 
+def enqueue_notifications(notifications, notify_date: Optional[date] = None) -> int:
+    """
+    Поставить напоминания в очередь notification_outbox (одной транзакцией).
+    
+    Уже поставленные напоминания (тот же birthday_id, дата события и days_until) пропускаются.
+    
+    Args:
+        notifications: Итерируемое из кортежей (birthday_id, user_id, days_until, message, buttons)
+        notify_date: День отправки (по умолчанию сегодня)
+    
+    Returns:
+        Количество новых строк в очереди
+    """
+    if notify_date is None:
+        notify_date = date.today()
+    notify_ordinal = notify_date.toordinal()
+    rows = [
+        (birthday_id, user_id, notify_ordinal + days_until, days_until, notify_ordinal, message, int(bool(buttons)))
+        for birthday_id, user_id, days_until, message, buttons in notifications
+    ]
+    if not rows:
+        return 0
+    try:
+        with transaction(write=True) as cursor:
+            cursor.executemany(
+                'INSERT OR IGNORE INTO notification_outbox (birthday_id, user_id, occurrence, days_until, notify_date, message, buttons) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            inserted = cursor.rowcount
+        logger.info(f"В очередь уведомлений добавлено: {inserted} (из {len(rows)})")
+        return inserted
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении уведомлений в очередь: {e}")
+        return 0
+
+
+def get_pending_notifications(notify_date: Optional[date] = None, limit: int = 100,
+                              after_id: int = 0) -> List[Tuple[int, int, int, str, int]]:
+    """
+    Получить очередную пачку неотправленных напоминаний на день notify_date.
+    
+    Returns:
+        Список кортежей (id, birthday_id, user_id, message, buttons) в порядке постановки в очередь
+    """
+    if notify_date is None:
+        notify_date = date.today()
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "SELECT id, birthday_id, user_id, message, buttons FROM notification_outbox "
+                "WHERE status = 'pending' AND notify_date = ? AND id > ? ORDER BY id LIMIT ?",
+                (notify_date.toordinal(), after_id, limit)
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении очереди уведомлений: {e}")
+        return []
+
+
+def get_pending_notification_users(notify_date: Optional[date] = None, limit: int = 100,
+                                   after_user_id: int = 0) -> List[int]:
+    """Получить очередную пачку пользователей, у которых есть неотправленные напоминания на день notify_date."""
+    if notify_date is None:
+        notify_date = date.today()
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT user_id FROM notification_outbox "
+                "WHERE notify_date = ? AND user_id > ? AND status = 'pending' ORDER BY user_id LIMIT ?",
+                (notify_date.toordinal(), after_user_id, limit)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователей из очереди уведомлений: {e}")
+        return []
+
+
+def get_pending_notifications_for_users(user_ids: List[int], notify_date: Optional[date] = None
+                                        ) -> List[Tuple[int, int, int, str, int, Optional[str]]]:
+    """
+    Получить все неотправленные напоминания указанных пользователей на день notify_date.
+    
+    Returns:
+        Список кортежей (id, birthday_id, user_id, message, buttons, full_name), сгруппированных по пользователю
+    """
+    if not user_ids:
+        return []
+    if notify_date is None:
+        notify_date = date.today()
+    placeholders = ', '.join('?' for _ in user_ids)
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "SELECT o.id, o.birthday_id, o.user_id, o.message, o.buttons, b.full_name "
+                "FROM notification_outbox o LEFT JOIN birthdays b ON b.id = o.birthday_id "
+                f"WHERE o.notify_date = ? AND o.user_id IN ({placeholders}) AND o.status = 'pending' "
+                "ORDER BY o.user_id, o.days_until, o.id",
+                [notify_date.toordinal()] + list(user_ids)
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении очереди уведомлений: {e}")
+        return []
+
+
+def mark_notifications_sent(outbox_ids: List[int]) -> None:
+    """Отметить напоминания отправленными."""
+    if not outbox_ids:
+        return
+    try:
+        with transaction(write=True) as cursor:
+            cursor.executemany(
+                "UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(outbox_id,) for outbox_id in outbox_ids]
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при отметке отправленных уведомлений: {e}")
+
+
+def mark_notifications_failed(outbox_ids: List[int], max_attempts: int = 3) -> None:
+    """Учесть неудачную попытку; после max_attempts попыток напоминание больше не отправляется."""
+    if not outbox_ids:
+        return
+    try:
+        with transaction(write=True) as cursor:
+            cursor.executemany(
+                "UPDATE notification_outbox SET attempts = attempts + 1, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE id = ?",
+                [(max_attempts, outbox_id) for outbox_id in outbox_ids]
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при отметке неотправленных уведомлений: {e}")
+
+
+def purge_notification_outbox(before: date) -> int:
+    """Удалить из очереди записи за дни раньше before. Возвращает количество удалённых строк."""
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute('DELETE FROM notification_outbox WHERE notify_date < ?', (before.toordinal(),))
+            return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Ошибка при очистке очереди уведомлений: {e}")
+        return 0
+
+
+def get_cached_congratulation(cache_key: str, max_age: int, now: Optional[int] = None) -> Optional[str]:
+    """
+    Получить поздравление из кеша, если оно моложе max_age секунд (и отметить использование).
+    
+    Returns:
+        Текст поздравления или None
+    """
+    if now is None:
+        now = int(time.time())
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute(
+                'SELECT text FROM congratulation_cache WHERE cache_key = ? AND created_at >= ?',
+                (cache_key, now - max_age)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('UPDATE congratulation_cache SET last_used_at = ? WHERE cache_key = ?', (now, cache_key))
+            return row[0]
+    except Exception as e:
+        logger.error(f"Ошибка при чтении кеша поздравлений: {e}")
+        return None
+
+
+def put_cached_congratulation(cache_key: str, model: str, text: str, max_entries: int,
+                              now: Optional[int] = None) -> bool:
+    """
+    Сохранить поздравление в кеш (заменяя прежнее с тем же ключом).
+    
+    Если записей больше max_entries, вытесняются давно не использованные.
+    
+    Returns:
+        True если успешно сохранено, False в случае ошибки
+    """
+    if now is None:
+        now = int(time.time())
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO congratulation_cache (cache_key, model, text, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)',
+                (cache_key, model, text, now, now)
+            )
+            cursor.execute('SELECT COUNT(*) FROM congratulation_cache')
+            excess = cursor.fetchone()[0] - max_entries
+            if excess > 0:
+                # Самые давние записи берутся из индекса last_used_at (в нём есть rowid)
+                cursor.execute(
+                    'DELETE FROM congratulation_cache WHERE rowid IN '
+                    '(SELECT rowid FROM congratulation_cache ORDER BY last_used_at LIMIT ?)',
+                    (excess,)
+                )
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при записи в кеш поздравлений: {e}")
+        return False
+
+
+def purge_congratulation_cache(max_age: int, now: Optional[int] = None) -> int:
+    """Удалить из кеша поздравления старше max_age секунд. Возвращает количество удалённых строк."""
+    if now is None:
+        now = int(time.time())
+    try:
+        with transaction(write=True) as cursor:
+            cursor.execute('DELETE FROM congratulation_cache WHERE created_at < ?', (now - max_age,))
+            return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Ошибка при очистке кеша поздравлений: {e}")
+        return 0
+
+
+def load_bot_state(kind: str, name: Optional[str] = None) -> List[Tuple[str, str, str]]:
+    """
+    Сохранённое состояние бота одного вида.
+    
+    Args:
+        kind: Вид данных (persistence.KIND_*)
+        name: Только записи с этим именем (например, имя диалога); None — все
+    
+    Returns:
+        Список кортежей (name, key, value)
+    """
+    query = 'SELECT name, key, value FROM bot_state WHERE kind = ?'
+    params = [kind]
+    if name is not None:
+        query += ' AND name = ?'
+        params.append(name)
+    try:
+        with transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке состояния бота: {e}")
+        return []
+
+
+def save_bot_state(upserts, deletes=(), now: Optional[int] = None) -> bool:
+    """
+    Записать изменения состояния бота одной транзакцией.
+    
+    Args:
+        upserts: Кортежи (kind, name, key, value) — новые и изменённые записи
+        deletes: Кортежи (kind, name, key) — записи для удаления
+        now: Время изменения (unix-секунды, по умолчанию текущее)
+    
+    Returns:
+        True если успешно, False в случае ошибки
+    """
+    if now is None:
+        now = int(time.time())
+    upserts = [(kind, name, key, value, now) for kind, name, key, value in upserts]
+    deletes = list(deletes)
+    if not upserts and not deletes:
+        return True
+    try:
+        with transaction(write=True) as cursor:
+            if upserts:
+                cursor.executemany(
+                    'INSERT INTO bot_state (kind, name, key, value, updated_at) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (kind, name, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                    upserts
+                )
+            if deletes:
+                cursor.executemany('DELETE FROM bot_state WHERE kind = ? AND name = ? AND key = ?', deletes)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния бота: {e}")
+        return False
+
+
+def get_idle_bot_state(before: int) -> List[Tuple[str, str, str]]:
+    """Записи состояния бота, не менявшиеся с момента before (unix-секунды): кортежи (kind, name, key)."""
+    try:
+        with transaction() as cursor:
+            cursor.execute('SELECT kind, name, key FROM bot_state WHERE updated_at < ?', (before,))
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске устаревшего состояния бота: {e}")
+        return []
@@ -0,0 +1,568 @@
+import csv
+import io
+import itertools
+import logging
+import os
+import quopri
+import re
+from datetime import datetime
+from typing import IO, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Запись импорта: (full_name, date_str YYYY-MM-DD, username, event_type, event_name)
+ImportRecord = Tuple[str, str, Optional[str], str, Optional[str]]
+
+# Формат списка бота: «N. 🎂 Имя (@username)» и на следующей строке «📅 ДД.ММ[.ГГГГ] ...»
+_ENTRY_RE = re.compile(r'^\d+\.\s*(🎂|🎊|📅)\s*(.*)$')
+_USERNAME_RE = re.compile(r'\s*\(@([^)]+)\)')
+_DATE_RE = re.compile(r'📅\s*(\d{2}\.\d{2}(?:\.\d{4})?)')
+
+_EVENT_TYPES = {'🎂': 'birthday', '🎊': 'holiday', '📅': 'other'}
+
+
+def _parse_entry_date(date_str: str) -> str:
+    """ДД.ММ.ГГГГ или ДД.ММ -> YYYY-MM-DD (без года — 1900). ValueError, если даты нет в календаре."""
+    if len(date_str) == 10:
+        date_obj = datetime.strptime(date_str, '%d.%m.%Y')
+    else:
+        # Для праздников и других событий используем год 1900
+        date_obj = datetime.strptime(date_str + '.1900', '%d.%m.%Y')
+    return date_obj.strftime('%Y-%m-%d')
+
+
+def iter_bulk_import(lines: Iterable[str]) -> Iterator[Tuple[Optional[ImportRecord], Optional[str]]]:
+    """
+    Однопроходный разбор списка событий в формате бота.
+
+    Формат:
+    1. 🎂 Имя (@username)
+       📅 ДД.ММ.ГГГГ (описание...)
+
+    Строки читаются по одной, поэтому источником может быть и текст сообщения, и файл любого размера.
+
+    Yields:
+        (запись, None) для распознанной записи или (None, текст ошибки)
+    """
+    pending = None  # (event_type, full_name, username) — ждём строку с датой
+    for raw_line in lines:
+        line = raw_line.strip()
+        if pending is not None:
+            event_type, full_name, username = pending
+            pending = None
+            date_match = _DATE_RE.search(line)
+            if not date_match:
+                # Строку без даты ниже проверяем как начало следующей записи
+                yield None, f"Не найдена дата для '{full_name}'"
+            else:
+                date_str = date_match.group(1)
+                try:
+                    db_date = _parse_entry_date(date_str)
+                except ValueError as e:
+                    logger.warning(f"Ошибка парсинга даты: {date_str} - {e}")
+                    yield None, f"Ошибка парсинга даты для '{full_name}': {e}"
+                    continue
+                # Для праздников и других событий event_name = full_name
+                event_name = full_name if event_type in ('holiday', 'other') else None
+                yield (full_name, db_date, username, event_type, event_name), None
+                continue
+
+        entry_match = _ENTRY_RE.match(line)
+        if not entry_match:
+            continue
+        name_part = entry_match.group(2)
+        username_match = _USERNAME_RE.search(name_part)
+        username = username_match.group(1) if username_match else None
+        full_name = _USERNAME_RE.sub('', name_part).strip()
+        pending = (_EVENT_TYPES[entry_match.group(1)], full_name, username)
+
+    if pending is not None:
+        yield None, f"Не найдена строка с датой для '{pending[1]}'"
+
+
+def parse_bulk_import(text: str) -> Tuple[List[ImportRecord], List[str]]:
+    """
+    Парсинг списка событий из текста сообщения.
+
+    Returns:
+        Tuple[List, List]: (успешно распарсенные записи, ошибки)
+        Запись: (full_name, date_str, username, event_type, event_name)
+    """
+    records = []
+    errors = []
+    for record, error in iter_bulk_import(text.splitlines()):
+        if record is not None:
+            records.append(record)
+        else:
+            errors.append(error)
+    return records, errors
+
+
+def iter_text_lines(binary: IO[bytes]) -> Iterator[str]:
+    """
+    Строки загруженного файла (UTF-8, с BOM или без). Файл читается буферизованно, целиком в память не загружается.
+
+    binary — файл, открытый в двоичном режиме (например tempfile.TemporaryFile); закрывает его вызывающий.
+    """
+    text = io.TextIOWrapper(binary, encoding='utf-8-sig', errors='replace')
+    try:
+        yield from text
+    finally:
+        text.detach()
+
+
+# Даты в стандартных форматах: YYYY-MM-DD, YYYYMMDD, --MM-DD / --MMDD (без года), ДД.ММ[.ГГГГ]
+_ISO_DATE_RE = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})(?:T.*)?$')
+_NO_YEAR_DATE_RE = re.compile(r'^--(\d{2})-?(\d{2})$')
+_DOTTED_DATE_RE = re.compile(r'^(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?$')
+
+
+def parse_date(value: str) -> str:
+    """
+    Дата из файла импорта -> YYYY-MM-DD (без года — 1900).
+
+    Raises:
+        ValueError: формат не распознан или такой даты нет в календаре
+    """
+    value = (value or '').strip()
+    match = _ISO_DATE_RE.match(value)
+    if match:
+        year, month, day = match.groups()
+    else:
+        match = _NO_YEAR_DATE_RE.match(value)
+        if match:
+            year, (month, day) = '1900', match.groups()
+        else:
+            match = _DOTTED_DATE_RE.match(value)
+            if not match:
+                raise ValueError(f"неизвестный формат даты '{value}'")
+            day, month, year = match.groups()
+            year = year or '1900'
+    # vCard/ICS допускают год 1604 как «год неизвестен» (Apple) — приводим к соглашению бота
+    if year in ('0000', '1604'):
+        year = '1900'
+    return datetime(int(year), int(month), int(day)).strftime('%Y-%m-%d')
+
+
+# --- CSV ---
+
+# Названия колонок (в нижнем регистре) -> поле записи
+_CSV_COLUMNS = {
+    'full_name': ('full_name', 'name', 'имя', 'фио', 'contact', 'контакт'),
+    'date': ('date', 'birth_date', 'birthday', 'bday', 'дата', 'дата рождения', 'день рождения'),
+    'username': ('username', 'telegram', 'telegram_username', 'ник'),
+    'event_type': ('event_type', 'type', 'тип'),
+    'event_name': ('event_name', 'event', 'title', 'событие', 'название'),
+}
+_CSV_EVENT_TYPES = {
+    'birthday': 'birthday', 'день рождения': 'birthday', 'др': 'birthday',
+    'holiday': 'holiday', 'праздник': 'holiday',
+    'other': 'other', 'другое': 'other', 'событие': 'other',
+}
+
+
+def _csv_column_map(header: List[str]) -> Optional[dict]:
+    """Номера колонок по заголовку или None, если это не заголовок (нет колонок имени и даты)."""
+    names = [cell.strip().lower() for cell in header]
+    columns = {}
+    for field, aliases in _CSV_COLUMNS.items():
+        for index, name in enumerate(names):
+            if name in aliases:
+                columns[field] = index
+                break
+    if 'full_name' in columns and 'date' in columns:
+        return columns
+    return None
+
+
+def iter_csv_import(lines: Iterable[str]) -> Iterator[Tuple[Optional[ImportRecord], Optional[str]]]:
+    """
+    Потоковый разбор CSV. Разделитель (, ; или табуляция) определяется по первой строке.
+
+    Заголовок с колонками name/имя и date/дата (плюс необязательные username, type, event_name)
+    задаёт порядок колонок; без заголовка колонки читаются как «имя, дата[, username]».
+    """
+    lines = iter(lines)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+    delimiter = max((';', ',', '\t'), key=first_line.count)
+    reader = csv.reader(itertools.chain([first_line], lines), delimiter=delimiter)
+
+    columns = None
+    for row_number, row in enumerate(reader, 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if row_number == 1:
+            columns = _csv_column_map(row)
+            if columns is not None:
+                continue
+            columns = {'full_name': 0, 'date': 1, 'username': 2}
+
+        def cell(field: str) -> str:
+            index = columns.get(field)
+            return row[index].strip() if index is not None and index < len(row) else ''
+
+        full_name = cell('full_name')
+        if not full_name:
+            yield None, f"Строка {row_number}: не указано имя"
+            continue
+        try:
+            db_date = parse_date(cell('date'))
+        except ValueError as e:
+            yield None, f"Строка {row_number} ('{full_name}'): {e}"
+            continue
+        event_type = _CSV_EVENT_TYPES.get(cell('event_type').lower(), 'birthday')
+        event_name = cell('event_name') or (full_name if event_type != 'birthday' else None)
+        username = cell('username').lstrip('@') or None
+        yield (full_name, db_date, username, event_type, event_name), None
+
+
+# --- vCard / iCalendar: общие строки контента (RFC 6350 / RFC 5545) ---
+
+_ESCAPE_RE = re.compile(r'\\(.)')
+
+def _unfold(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Склеить перенесённые строки: продолжение начинается с пробела или табуляции,
+    а в quoted-printable (vCard 2.1) строка, оканчивающаяся на '=', продолжается следующей.
+    """
+    current = None
+    for raw_line in lines:
+        line = raw_line.rstrip('\r\n')
+        if current is not None and line[:1] in (' ', '\t'):
+            current += line[1:]
+            continue
+        if current is not None and current.endswith('=') and 'QUOTED-PRINTABLE' in current.split(':', 1)[0].upper():
+            current = current[:-1] + line
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _content_line(line: str) -> Tuple[str, dict, str]:
+    """«item1.NAME;PARAM=X:value» -> ('NAME', {'PARAM': 'X'}, value)."""
+    head, _, value = line.partition(':')
+    name, *params = head.split(';')
+    name = name.rsplit('.', 1)[-1].upper()
+    parameters = {}
+    for param in params:
+        key, _, param_value = param.partition('=')
+        # vCard 2.1 допускает параметры без имени: «;QUOTED-PRINTABLE»
+        if param_value:
+            parameters[key.upper()] = param_value
+        else:
+            parameters.setdefault('TYPE', key)
+            if key.upper() == 'QUOTED-PRINTABLE':
+                parameters['ENCODING'] = key
+    return name, parameters, value
+
+
+def _text_value(value: str, parameters: dict) -> str:
+    """Значение текстового свойства: quoted-printable и экранирование (\\n, \\, \\; \\\\)."""
+    if parameters.get('ENCODING', '').upper() == 'QUOTED-PRINTABLE':
+        raw = quopri.decodestring(value.encode('ascii', 'replace'))
+        try:
+            value = raw.decode(parameters.get('CHARSET', 'utf-8'), 'replace')
+        except LookupError:
+            value = raw.decode('utf-8', 'replace')
+    return _ESCAPE_RE.sub(lambda match: ' ' if match.group(1) in 'nN' else match.group(1), value).strip()
+
+
+def _iter_components(lines: Iterable[str], component: str) -> Iterator[List[Tuple[str, dict, str]]]:
+    """Свойства каждого BEGIN:<component> … END:<component> (вложенные компоненты пропускаются)."""
+    properties = None
+    depth = 0
+    for line in _unfold(lines):
+        if not line:
+            continue
+        name, parameters, value = _content_line(line)
+        if name == 'BEGIN':
+            if value.strip().upper() == component:
+                properties = []
+                depth = 0
+            elif properties is not None:
+                depth += 1
+            continue
+        if name == 'END' and properties is not None:
+            if depth:
+                depth -= 1
+            elif value.strip().upper() == component:
+                yield properties
+                properties = None
+            continue
+        if properties is not None and not depth:
+            properties.append((name, parameters, value))
+
+
+_TELEGRAM_URL_RE = re.compile(r'(?:https?://)?t(?:elegram)?\.me/([A-Za-z0-9_]{4,})', re.IGNORECASE)
+
+
+def _telegram_username(name: str, value: str) -> Optional[str]:
+    """Telegram username из X-TELEGRAM, IMPP:telegram:… или ссылки t.me/…"""
+    value = value.strip()
+    if name in ('X-TELEGRAM', 'X-TELEGRAM-USERNAME'):
+        return value.lstrip('@') or None
+    if name == 'IMPP' and value.lower().startswith(('telegram:', 'tg:', 'x-apple:')):
+        return value.split(':', 1)[1].lstrip('/@') or None
+    match = _TELEGRAM_URL_RE.search(value) if name in ('URL', 'IMPP') else None
+    return match.group(1) if match else None
+
+
+def iter_vcard_import(lines: Iterable[str]) -> Iterator[Tuple[Optional[ImportRecord], Optional[str]]]:
+    """
+    Потоковый разбор vCard (экспорт контактов телефона): из каждой карточки с BDAY —
+    день рождения с именем из FN (или N) и Telegram username, если он указан. Карточки без BDAY пропускаются.
+    """
+    for properties in _iter_components(lines, 'VCARD'):
+        full_name = structured_name = birthday = username = None
+        for name, parameters, value in properties:
+            if name == 'FN':
+                full_name = _text_value(value, parameters)
+            elif name == 'N':
+                parts = [part.strip() for part in _text_value(value, parameters).split(';')]
+                # N: Фамилия;Имя;Отчество;…
+                structured_name = ' '.join(part for part in (parts[1:2] + parts[2:3] + parts[:1]) if part)
+            elif name == 'BDAY':
+                birthday = value.strip()
+            elif username is None:
+                username = _telegram_username(name, value)
+        if birthday is None:
+            continue
+        full_name = full_name or structured_name
+        if not full_name:
+            yield None, f"Контакт без имени с датой {birthday}"
+            continue
+        try:
+            db_date = parse_date(birthday)
+        except ValueError as e:
+            yield None, f"Контакт '{full_name}': {e}"
+            continue
+        yield (full_name, db_date, username, 'birthday', None), None
+
+
+# «Имя — день рождения», «Birthday: Имя», «Имя's birthday»
+_BIRTHDAY_SUMMARY_RE = re.compile(
+    r"^\s*(?:день рождения|birthday|др)(?:\s*[:\-–—]\s*|\s+)(?P<a>.+?)\s*$"
+    r"|^\s*(?P<b>.+?)(?:'s)?(?:\s*[:\-–—]\s*|\s+)(?:день рождения|birthday|др)\s*$",
+    re.IGNORECASE,
+)
+_EVENT_EMOJI_RE = re.compile(r'^\s*(🎂|🎊|📅)\s*')
+_ICS_CATEGORIES = {'BIRTHDAY': 'birthday', 'HOLIDAY': 'holiday', 'OTHER': 'other'}
+
+
+def iter_ics_import(lines: Iterable[str]) -> Iterator[Tuple[Optional[ImportRecord], Optional[str]]]:
+    """
+    Потоковый разбор iCalendar: берутся ежегодные события (RRULE с FREQ=YEARLY).
+
+    Тип события — из CATEGORIES (BIRTHDAY/HOLIDAY/OTHER, как в /export) или по названию
+    («… день рождения», «Birthday: …»); остальные ежегодные события — «другое» без года.
+    """
+    for properties in _iter_components(lines, 'VEVENT'):
+        summary = start = categories = username = None
+        yearly = False
+        for name, parameters, value in properties:
+            if name == 'SUMMARY':
+                summary = _text_value(value, parameters)
+            elif name == 'DTSTART':
+                start = value.strip()
+            elif name == 'RRULE':
+                yearly = 'FREQ=YEARLY' in value.upper()
+            elif name == 'CATEGORIES':
+                categories = value.strip().upper()
+            elif name == 'X-TELEGRAM-USERNAME':
+                username = value.strip().lstrip('@') or None
+        if not yearly or not start:
+            continue
+        title = _EVENT_EMOJI_RE.sub('', summary or '').strip()
+        if not title:
+            yield None, f"Событие без названия с датой {start}"
+            continue
+        event_type = None
+        for category in (categories or '').split(','):
+            event_type = event_type or _ICS_CATEGORIES.get(category.strip())
+        if event_type is None:
+            match = _BIRTHDAY_SUMMARY_RE.match(title)
+            if match:
+                event_type = 'birthday'
+                title = (match.group('a') or match.group('b')).strip()
+            else:
+                event_type = 'other'
+        try:
+            db_date = parse_date(start)
+        except ValueError as e:
+            yield None, f"Событие '{title}': {e}"
+            continue
+        if event_type == 'birthday':
+            yield (title, db_date, username, 'birthday', None), None
+        else:
+            # У ежегодных праздников и событий год не важен
+            yield (title, '1900' + db_date[4:], username, event_type, title), None
+
+
+# Расширения файлов, которые принимает /import, и их разборщики
+_IMPORT_PARSERS = {
+    '.txt': iter_bulk_import,
+    '.csv': iter_csv_import,
+    '.vcf': iter_vcard_import,
+    '.vcard': iter_vcard_import,
+    '.ics': iter_ics_import,
+}
+IMPORT_FILE_EXTENSIONS = tuple(_IMPORT_PARSERS)
+
+
+def is_supported_import_file(file_name: Optional[str]) -> bool:
+    """Можно ли импортировать файл с таким именем."""
+    return (file_name or '').lower().endswith(IMPORT_FILE_EXTENSIONS)
+
+
+def iter_import_file(file_name: str, binary: IO[bytes]) -> Iterator[Tuple[Optional[ImportRecord], Optional[str]]]:
+    """
+    Потоковый разбор загруженного файла по его расширению.
+
+    Yields:
+        (запись, None) или (None, текст ошибки), как iter_bulk_import
+    """
+    extension = os.path.splitext((file_name or '').lower())[1]
+    parser = _IMPORT_PARSERS.get(extension)
+    if parser is None:
+        raise ValueError(f"Неподдерживаемый формат файла: {file_name}")
+    return parser(iter_text_lines(binary))
+
+
+# --- Экспорт ---
+
+# Строка выгрузки: (id, full_name, birth_date, telegram_username, event_type, event_name, remind_days)
+EXPORT_FORMATS = ('ics', 'csv')
+
+_EVENT_EMOJI = {'birthday': '🎂', 'holiday': '🎊', 'other': '📅'}
+_CSV_TYPE_NAMES = {'birthday': 'день рождения', 'holiday': 'праздник', 'other': 'другое'}
+
+
+def _display_name(full_name: str, event_type: str, event_name: Optional[str]) -> str:
+    return full_name if event_type == 'birthday' else (event_name or full_name)
+
+
+def _display_date(birth_date: str) -> str:
+    """YYYY-MM-DD -> ДД.ММ.ГГГГ, без года (1900) -> ДД.ММ."""
+    year, month, day = birth_date.split('-')
+    return f"{day}.{month}" if year == '1900' else f"{day}.{month}.{year}"
+
+
+def iter_csv_export(rows: Iterable[tuple]) -> Iterator[str]:
+    """
+    CSV построчно (разделитель ';', как ждёт Excel в русской локали).
+
+    Колонки совпадают с теми, что понимает импорт, поэтому файл можно загрузить обратно.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';', lineterminator='\r\n')
+    writer.writerow(['Имя', 'Дата', 'Telegram', 'Тип', 'Название', 'Напоминания'])
+    yield buffer.getvalue()
+    for _, full_name, birth_date, username, event_type, event_name, remind_days in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        event_type = event_type or 'birthday'
+        writer.writerow([
+            full_name,
+            _display_date(birth_date),
+            f"@{username}" if username else '',
+            _CSV_TYPE_NAMES.get(event_type, event_type),
+            event_name or '',
+            remind_days or '',
+        ])
+        yield buffer.getvalue()
+
+
+def _ics_escape(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _ics_fold(line: str) -> str:
+    """Перенос строки длиннее 75 байт (RFC 5545 3.1), не разрывая символы UTF-8."""
+    if len(line.encode('utf-8')) <= 75:
+        return line + '\r\n'
+    parts = []
+    current = ''
+    current_size = 0
+    for char in line:
+        size = len(char.encode('utf-8'))
+        if current_size + size > 75:
+            parts.append(current)
+            # Строка продолжения начинается с пробела, он входит в 75 байт
+            current = ' '
+            current_size = 1
+        current += char
+        current_size += size
+    parts.append(current)
+    return '\r\n'.join(parts) + '\r\n'
+
+
+def iter_ics_export(rows: Iterable[tuple], stamp: Optional[datetime] = None) -> Iterator[str]:
+    """
+    iCalendar построчно: ежегодное событие (RRULE:FREQ=YEARLY) на каждую запись и VALARM
+    на каждый день напоминания. 29 февраля повторяется в последний день февраля, как и в боте.
+    """
+    stamp = (stamp or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield 'PRODID:-//birthdaysbot//RU\r\n'
+    yield 'CALSCALE:GREGORIAN\r\n'
+    for birthday_id, full_name, birth_date, username, event_type, event_name, remind_days in rows:
+        event_type = event_type or 'birthday'
+        title = _display_name(full_name, event_type, event_name)
+        rule = 'FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=-1' if birth_date.endswith('-02-29') else 'FREQ=YEARLY'
+        lines = [
+            'BEGIN:VEVENT',
+            f'UID:birthday-{birthday_id}@birthdaysbot',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART;VALUE=DATE:{birth_date.replace("-", "")}',
+            f'RRULE:{rule}',
+            f'SUMMARY:{_ics_escape(_EVENT_EMOJI.get(event_type, "📅") + " " + title)}',
+            f'CATEGORIES:{event_type.upper()}',
+            'TRANSP:TRANSPARENT',
+        ]
+        if username:
+            lines.append(f'X-TELEGRAM-USERNAME:{_ics_escape(username)}')
+        offsets = sorted({int(x) for x in (remind_days or '0').split(',') if x.strip().isdigit()})
+        for offset in offsets:
+            lines += [
+                'BEGIN:VALARM',
+                'ACTION:DISPLAY',
+                f'TRIGGER:-P{offset}D' if offset else 'TRIGGER:PT0S',
+                f'DESCRIPTION:{_ics_escape(title)}',
+                'END:VALARM',
+            ]
+        lines.append('END:VEVENT')
+        yield ''.join(_ics_fold(line) for line in lines)
+    yield 'END:VCALENDAR\r\n'
+
+
+def write_export(rows: Iterable[tuple], export_format: str, binary: IO[bytes]) -> int:
+    """
+    Записать выгрузку в файл (двоичный режим) по мере чтения строк.
+
+    Returns:
+        Количество выгруженных записей
+    """
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    if export_format == 'ics':
+        lines = iter_ics_export(counted())
+    else:
+        # BOM, чтобы Excel открыл файл в UTF-8
+        binary.write('\ufeff'.encode('utf-8'))
+        lines = iter_csv_export(counted())
+    for chunk in lines:
+        binary.write(chunk.encode('utf-8'))
+    return count
@@ -0,0 +1,275 @@
+"""
+Хранение состояния бота в SQLite: шаги диалогов (ConversationHandler), context.user_data
+и context.bot_data переживают перезапуск.
+
+Каждая запись — отдельная строка таблицы bot_state с JSON-значением. После каждого
+обновления Telegram dispatcher вызывает update_*; в БД уходят только изменившиеся записи
+(сравнение с последним сохранённым JSON), а не весь набор данных целиком.
+Записи, которые не менялись дольше TTL, удаляет expire_idle — и из БД, и из памяти бота.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, ConversationHandler
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Виды записей в bot_state
+KIND_USER = 'user'
+KIND_BOT = 'bot'
+KIND_CONVERSATION = 'conversation'
+
+# Сколько хранить брошенные диалоги и данные пользователей (часов без изменений) и как часто проверять
+PERSISTENCE_TTL = int(float(os.getenv('PERSISTENCE_TTL_HOURS', '24')) * 3600)
+PERSISTENCE_EXPIRE_INTERVAL = int(os.getenv('PERSISTENCE_EXPIRE_INTERVAL', '3600'))
+
+
+def _encode_key(key) -> str:
+    """Ключ словаря в строку: числа и кортежи (chat_id, message_id) — через JSON."""
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def _decode_key(text: str):
+    key = json.loads(text)
+    return tuple(key) if isinstance(key, list) else key
+
+
+def _fingerprint(value) -> Optional[int]:
+    """hash неизменяемого значения (кортеж, строка, число); None — значение изменяемое, сверять по JSON."""
+    try:
+        return hash(value)
+    except TypeError:
+        return None
+
+
+def _decode_value(value):
+    """JSON не различает списки и кортежи; кортежи в данных бота только распаковываются, поэтому списка достаточно."""
+    return json.loads(value)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    BasePersistence поверх таблицы bot_state.
+
+    user_data хранится строкой на пользователя, каждый диалог — строкой на ключ (chat_id, user_id),
+    bot_data — строкой на элемент вложенного словаря (bot_data["prompt_wait_user"][user_id] и т.п.),
+    чтобы изменение одного ожидания промпта не переписывало остальные. chat_data бот не использует.
+    """
+
+    def __init__(self, ttl: int = PERSISTENCE_TTL):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Последний записанный JSON: (kind, name) -> {key: JSON}, чтобы не писать неизменившееся
+        # и проверять одну запись без обхода всех сохранённых
+        self._saved: Dict[Tuple[str, str], Dict[str, str]] = {}
+        # Элементы bot_data, уже сверенные с БД: (name, key) -> (объект, hash); тот же неизменяемый
+        # объект повторно в JSON не переводится
+        self._bot_seen: Dict[Tuple[str, str], Tuple[object, Optional[int]]] = {}
+        # Когда пользователь последний раз присылал обновление: активных не выселяем,
+        # даже если их данные давно не менялись
+        self._user_seen: Dict[int, float] = {}
+        # Пустые user_data, найденные прошлым expire_idle (удаляются только при повторной встрече)
+        self._empty_users: Set[int] = set()
+
+    # --- Загрузка при старте ---
+
+    def _load(self, kind: str, name: Optional[str] = None):
+        rows = database.load_bot_state(kind, name)
+        for row_name, key, value in rows:
+            self._saved.setdefault((kind, row_name), {})[key] = value
+        return rows
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for _, key, value in self._load(KIND_USER):
+            user_data[int(key)] = _decode_value(value)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        bot_data = {}
+        for name, key, value in self._load(KIND_BOT):
+            if key == '':
+                bot_data[name] = _decode_value(value)
+            else:
+                bot_data.setdefault(name, {})[_decode_key(key)] = _decode_value(value)
+        return bot_data
+
+    def get_conversations(self, name: str):
+        return {
+            _decode_key(key): _decode_value(value)
+            for _, key, value in self._load(KIND_CONVERSATION, name)
+        }
+
+    # --- Сохранение изменений ---
+
+    def _dump(self, value) -> Optional[str]:
+        try:
+            return json.dumps(value, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Состояние бота не сохранено (не сериализуется в JSON), сохранённая запись удалена: {e}")
+            return None
+
+    def _change(self, kind: str, name: str, key: str, value, upserts: list, deletes: list) -> None:
+        """Добавить в upserts/deletes изменение одной записи; value None — удалить запись."""
+        saved = self._saved.get((kind, name), {}).get(key)
+        dumped = None if value is None else self._dump(value)
+        if dumped is None:
+            # Несериализуемое значение тоже удаляет строку: иначе после перезапуска
+            # восстановилось бы устаревшее состояние
+            if saved is not None:
+                deletes.append((kind, name, key))
+        elif dumped != saved:
+            upserts.append((kind, name, key, dumped))
+
+    def _write(self, upserts: list, deletes: list) -> bool:
+        """Записать изменения в БД и запомнить их. Вызывается под self._lock."""
+        if not upserts and not deletes:
+            return True
+        if not database.save_bot_state(upserts, deletes):
+            return False
+        for kind, name, key, dumped in upserts:
+            self._saved.setdefault((kind, name), {})[key] = dumped
+        for kind, name, key in deletes:
+            scope = self._saved.get((kind, name))
+            if scope is not None:
+                scope.pop(key, None)
+                if not scope:
+                    del self._saved[(kind, name)]
+            if kind == KIND_BOT:
+                self._bot_seen.pop((name, key), None)
+        return True
+
+    def update_user_data(self, user_id: int, data) -> None:
+        self._user_seen[user_id] = time.time()
+        upserts, deletes = [], []
+        with self._lock:
+            self._change(KIND_USER, '', str(user_id), data or None, upserts, deletes)
+            self._write(upserts, deletes)
+
+    def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        upserts, deletes, seen = [], [], {}
+        with self._lock:
+            for name, value in data.items():
+                items = (((_encode_key(item_key), item) for item_key, item in value.items())
+                         if isinstance(value, dict) else (('', value),))
+                keys = set()
+                for key, item in items:
+                    keys.add(key)
+                    fingerprint = _fingerprint(item)
+                    previous = self._bot_seen.get((name, key))
+                    if previous is not None and previous[0] is item and fingerprint is not None \
+                            and previous[1] == fingerprint:
+                        continue
+                    seen[(name, key)] = (item, fingerprint)
+                    self._change(KIND_BOT, name, key, item, upserts, deletes)
+                deletes.extend((KIND_BOT, name, key) for key in self._saved.get((KIND_BOT, name), {})
+                               if key not in keys)
+            for kind, name in list(self._saved):
+                if kind == KIND_BOT and name not in data:
+                    deletes.extend((kind, name, key) for key in self._saved[(kind, name)])
+            if self._write(upserts, deletes):
+                self._bot_seen.update(seen)
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        # ConversationHandler вызывает это под своей блокировкой; отметка активности видна expire_idle
+        self._user_seen[key[-1]] = time.time()
+        upserts, deletes = [], []
+        with self._lock:
+            self._change(KIND_CONVERSATION, name, _encode_key(tuple(key)), new_state, upserts, deletes)
+            self._write(upserts, deletes)
+
+    def flush(self) -> None:
+        # Изменения записываются сразу в update_*, при остановке дописывать нечего
+        logger.info(f"Состояние бота сохранено в БД ({sum(map(len, self._saved.values()))} записей)")
+
+    # --- Удаление брошенных записей ---
+
+    def expire_idle(self, dispatcher, now: Optional[float] = None) -> int:
+        """
+        Удалить записи, не менявшиеся дольше ttl, из БД и из памяти dispatcher.
+
+        Записи пользователей, которые присылали обновления за последние ttl секунд, не трогаются.
+        Диалоги удаляются под блокировкой своего ConversationHandler, под которой воркеры
+        dispatcher меняют состояние, так что вернувшийся в диалог пользователь его не теряет.
+        Заодно из dispatcher.user_data убираются пустые словари, которые dispatcher
+        заводит для каждого написавшего пользователя (если они были пустыми и при прошлой проверке).
+
+        Returns:
+            Количество удалённых записей
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.ttl
+        conversation_handlers = {
+            handler.name: handler
+            for handlers in dispatcher.handlers.values()
+            for handler in handlers
+            if isinstance(handler, ConversationHandler) and handler.persistent and handler.name
+        }
+
+        def idle(user_id) -> bool:
+            return user_id is None or self._user_seen.get(user_id, 0) < cutoff
+
+        expired = []
+        conversations = {}
+        for kind, name, key in database.get_idle_bot_state(int(cutoff)):
+            decoded = _decode_key(key) if key else None
+            if kind == KIND_CONVERSATION and name in conversation_handlers:
+                conversations.setdefault(name, []).append((key, decoded))
+            elif kind == KIND_USER:
+                if idle(decoded):
+                    dispatcher.user_data.pop(decoded, None)
+                    expired.append((kind, name, key))
+            elif kind == KIND_BOT:
+                if decoded is None:
+                    dispatcher.bot_data.pop(name, None)
+                else:
+                    (dispatcher.bot_data.get(name) or {}).pop(decoded, None)
+                expired.append((kind, name, key))
+            elif kind == KIND_CONVERSATION and idle(decoded[-1]):
+                expired.append((kind, name, key))
+
+        removed = 0
+        for name, entries in conversations.items():
+            handler = conversation_handlers[name]
+            with handler._conversations_lock:
+                deletes = []
+                for key, decoded in entries:
+                    if idle(decoded[-1]):
+                        handler.conversations.pop(decoded, None)
+                        deletes.append((KIND_CONVERSATION, name, key))
+                with self._lock:
+                    if self._write([], deletes):
+                        removed += len(deletes)
+
+        with self._lock:
+            if self._write([], expired):
+                removed += len(expired)
+            for user_id, seen in list(self._user_seen.items()):
+                if seen < cutoff:
+                    del self._user_seen[user_id]
+        # Пустой словарь мог только что появиться для нового обновления, поэтому удаляется
+        # лишь тот, что был пустым и при прошлой проверке
+        empty_users = {user_id for user_id, data in list(dispatcher.user_data.items()) if not data}
+        for user_id in empty_users & self._empty_users:
+            if not dispatcher.user_data.get(user_id, True):
+                dispatcher.user_data.pop(user_id, None)
+        self._empty_users = empty_users - self._empty_users
+
+        if removed:
+            logger.info(f"Удалено брошенных диалогов и данных пользователей: {removed}")
+        return removed
@@ -1,44 +1,35 @@
 import logging
-from datetime import datetime, date
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import List, Optional
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import congratulations
 import database
+from sender import NotificationSender, OutgoingMessage, SendStats
 
 logger = logging.getLogger(__name__)
 
 # Часовой пояс для планировщика
 TIMEZONE = pytz.timezone('Europe/Moscow')
 
+# Час ежедневной проверки (MSK) и сколько секунд можно опоздать с запуском задачи
+# (бот был занят или перезапускался), прежде чем APScheduler её пропустит
+NOTIFY_HOUR = 9
+SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', '3600'))
 
-def calculate_days_until_birthday(birth_date_str: str) -> int:
-    """
-    Вычислить количество дней до ближайшего дня рождения.
-    
-    Args:
-        birth_date_str: Дата рождения в формате YYYY-MM-DD
-    
-    Returns:
-        Количество дней до дня рождения (0-365)
-    """
-    try:
-        birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d').date()
-        today = date.today()
-        
-        # Следующий день рождения в этом году
-        next_birthday = date(today.year, birth_date.month, birth_date.day)
-        
-        # Если день рождения уже прошел в этом году, берем следующий год
-        if next_birthday < today:
-            next_birthday = date(today.year + 1, birth_date.month, birth_date.day)
-        
-        # Вычисляем разницу в днях
-        days_until = (next_birthday - today).days
-        return days_until
-    except Exception as e:
-        logger.error(f"Ошибка при вычислении дней до дня рождения: {e}")
-        return -1
+# Размер пачки при разборе очереди уведомлений и срок хранения отправленных записей
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', '200'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '30'))
+
+# Режим дайджеста: все напоминания пользователя за день приходят одним сообщением
+NOTIFY_DIGEST = os.getenv('NOTIFY_DIGEST', '').strip().lower() in ('1', 'true', 'yes')
+TELEGRAM_MESSAGE_LIMIT = 4096
+DIGEST_HEADER = "🔔 Напоминания на сегодня:\n\n"
 
 
 def years_word(n: int) -> str:
@@ -83,11 +74,262 @@ def calculate_age(birth_date_str: str) -> int:
         return -1
 
 
+def congratulate_keyboard(birthday_id: int) -> InlineKeyboardMarkup:
+    """Кнопки генерации поздравления под уведомлением о дне рождения сегодня."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎁 Сгенерировать поздравление", callback_data=f"congratulate:{birthday_id}")],
+        [InlineKeyboardButton("✏️ Свой промпт", callback_data=f"congratulate_prompt:{birthday_id}")],
+    ])
+
+
+def build_notification(birthday_id: int, full_name: str, birth_date: str, telegram_username, event_type, event_name, days_until: int):
+    """
+    Сформировать текст уведомления и кнопки для одного события.
+    
+    Returns:
+        Кортеж (message, reply_markup); reply_markup есть только у дня рождения сегодня
+    """
+    # Форматируем дату для отображения
+    birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
+    formatted_date = birth_date_obj.strftime('%d.%m.%Y')
+    
+    # Формируем имя с username (только для дней рождения)
+    name_with_username = f"{full_name} (@{telegram_username})" if telegram_username else full_name
+    
+    # Определяем тип события (по умолчанию день рождения для обратной совместимости)
+    if not event_type:
+        event_type = 'birthday'
+    
+    reply_markup = None
+    # Формируем текст уведомления в зависимости от типа события и дней до события
+    if event_type == 'birthday':
+        # Вычисляем возраст на сегодня (если указан год)
+        current_age = calculate_age(birth_date)
+    
+        # Возраст, который исполняется: сегодня уже current_age, в будущем — current_age + 1
+        if days_until == 0:
+            age_turning = current_age  # сегодня день рождения — возраст уже этот
+        else:
+            age_turning = current_age + 1  # в будущем — исполнится на 1 больше
+    
+        if days_until == 0:
+            if current_age >= 0:
+                yw = years_word(age_turning)
+                age_text = f"\nИсполняется {age_turning} {yw}! "
+                message = f"🎉 СЕГОДНЯ день рождения у {name_with_username} ({formatted_date})!{age_text}Не забудь поздравить! 🎂🎁"
+            else:
+                message = f"🎉 СЕГОДНЯ день рождения у {name_with_username}!\nНе забудь поздравить! 🎂🎁"
+            # Кнопки генерации поздравления только для типа «день рождения», не для праздников/других
+            reply_markup = congratulate_keyboard(birthday_id)
+        elif days_until == 1:
+            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
+            message = f"🎂 Не забудь поздравить {name_with_username} завтра ({formatted_date}){age_will_be}!"
+        elif days_until == 3:
+            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
+            message = f"🎂 Не забудь поздравить {name_with_username} через 3 дня ({formatted_date}){age_will_be}!"
+        else:  # 7 дней
+            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
+            message = f"🎂 Не забудь поздравить {name_with_username} через 7 дней ({formatted_date}){age_will_be}!"
+    
+    elif event_type == 'holiday':
+        # Для праздников используем название события
+        holiday_name = event_name if event_name else full_name
+        if days_until == 0:
+            message = f"🎊 СЕГОДНЯ {holiday_name}!\nНе забудь поздравить! 🎉"
+        elif days_until == 1:
+            message = f"🎊 Завтра {holiday_name} ({formatted_date})!\nНе забудь поздравить!"
+        elif days_until == 3:
+            message = f"🎊 Через 3 дня {holiday_name} ({formatted_date})!\nНе забудь поздравить!"
+        else:  # 7 дней
+            message = f"🎊 Через 7 дней {holiday_name} ({formatted_date})!"
+    
+    else:  # 'other'
+        # Для других событий
+        event_title = event_name if event_name else full_name
+        if days_until == 0:
+            message = f"📅 СЕГОДНЯ не забудь про {event_title}!"
+        elif days_until == 1:
+            message = f"📅 Завтра не забудь про {event_title} ({formatted_date})!"
+        elif days_until == 3:
+            message = f"📅 Через 3 дня не забудь про {event_title} ({formatted_date})!"
+        else:  # 7 дней
+            message = f"📅 Через 7 дней: {event_title} ({formatted_date})"
+        
+    return message, reply_markup
+
+
+def build_digest(items) -> List[tuple]:
+    """
+    Собрать напоминания одного пользователя в дайджест.
+    
+    Args:
+        items: Кортежи (key, birthday_id, full_name, message, buttons) в порядке показа
+    
+    Returns:
+        Список сообщений (text, reply_markup, keys): текст делится по лимиту Telegram в 4096 символов,
+        под каждым сообщением — кнопки поздравления для попавших в него сегодняшних дней рождения
+    """
+    digests = []
+    text, keys, rows = DIGEST_HEADER, [], []
+    
+    def flush():
+        digests.append((text.rstrip(), InlineKeyboardMarkup(rows) if rows else None, keys))
+    
+    for key, birthday_id, full_name, message, buttons in items:
+        part = message + "\n\n"
+        if keys and len(text) + len(part) > TELEGRAM_MESSAGE_LIMIT:
+            flush()
+            text, keys, rows = DIGEST_HEADER, [], []
+        text += part[:TELEGRAM_MESSAGE_LIMIT - len(text)]
+        keys.append(key)
+        if buttons:
+            rows.append([
+                InlineKeyboardButton(f"🎁 {full_name or 'Поздравление'}", callback_data=f"congratulate:{birthday_id}"),
+                InlineKeyboardButton("✏️ Свой промпт", callback_data=f"congratulate_prompt:{birthday_id}"),
+            ])
+    if keys:
+        flush()
+    return digests
+
+
+def preview_user_notifications(user_id: int, today: Optional[date] = None, digest: Optional[bool] = None):
+    """
+    Сегодняшние напоминания одного пользователя — без отправки и без постановки в очередь.
+    
+    Проверяются только записи пользователя (по индексу), чужие напоминания не затрагиваются.
+    
+    Args:
+        digest: Собрать напоминания в дайджест (по умолчанию — как в рассылке, NOTIFY_DIGEST)
+    
+    Returns:
+        Список кортежей (message, reply_markup)
+    """
+    if today is None:
+        today = date.today()
+    if digest is None:
+        digest = NOTIFY_DIGEST
+    items = []
+    for birthday_id, _, full_name, birth_date, telegram_username, event_type, event_name, days_until in \
+            database.get_notification_candidates(today, user_id=user_id):
+        try:
+            message, reply_markup = build_notification(
+                birthday_id, full_name, birth_date, telegram_username, event_type, event_name, days_until
+            )
+            items.append((birthday_id, birthday_id, full_name, message, reply_markup))
+        except Exception as e:
+            logger.error(f"Ошибка при формировании уведомления для пользователя {user_id}: {e}")
+    if digest:
+        return [(text, reply_markup) for text, reply_markup, _ in build_digest(items)]
+    return [(message, reply_markup) for _, _, _, message, reply_markup in items]
+
+
+def enqueue_due_notifications(today: Optional[date] = None) -> int:
+    """
+    Выбрать сегодняшние напоминания и поставить их в очередь notification_outbox.
+    
+    Повторный вызов в тот же день ничего не дублирует.
+    
+    Returns:
+        Количество новых напоминаний в очереди
+    """
+    if today is None:
+        today = date.today()
+    # Выбираем в БД только записи, по которым сегодня есть напоминание
+    birthdays = database.get_notification_candidates(today)
+    if not birthdays:
+        logger.info("Нет событий для уведомлений на сегодня")
+        return 0
+    
+    notifications = []
+    for birthday_id, user_id, full_name, birth_date, telegram_username, event_type, event_name, days_until in birthdays:
+        try:
+            message, reply_markup = build_notification(
+                birthday_id, full_name, birth_date, telegram_username, event_type, event_name, days_until
+            )
+            notifications.append((birthday_id, user_id, days_until, message, reply_markup is not None))
+        except Exception as e:
+            logger.error(f"Ошибка при формировании уведомления для пользователя {user_id}: {e}")
+    return database.enqueue_notifications(notifications, today)
+
+
+# Одновременно очередь разбирает только один поток (планировщик или /check)
+_drain_lock = threading.Lock()
+
+
+def _outbox_messages(batch) -> List[OutgoingMessage]:
+    """Строки очереди -> по сообщению на напоминание."""
+    return [
+        OutgoingMessage(user_id, message, congratulate_keyboard(birthday_id) if buttons else None, (outbox_id,))
+        for outbox_id, birthday_id, user_id, message, buttons in batch
+    ]
+
+
+def _outbox_digests(batch) -> List[OutgoingMessage]:
+    """Строки очереди (сгруппированные по пользователю) -> дайджест на пользователя."""
+    by_user = {}
+    for outbox_id, birthday_id, user_id, message, buttons, full_name in batch:
+        by_user.setdefault(user_id, []).append((outbox_id, birthday_id, full_name, message, buttons))
+    messages = []
+    for user_id, items in by_user.items():
+        for text, reply_markup, keys in build_digest(items):
+            messages.append(OutgoingMessage(user_id, text, reply_markup, tuple(keys)))
+    return messages
+
+
+def drain_notification_outbox(bot, today: Optional[date] = None, digest: Optional[bool] = None) -> SendStats:
+    """
+    Отправить неотправленные напоминания из очереди пачками по NOTIFY_BATCH_SIZE.
+    
+    После каждой пачки строки отмечаются отправленными, поэтому прерванная рассылка
+    продолжается со следующего вызова без повторов (кроме пачки, на которой процесс упал).
+    В режиме дайджеста пачка — это NOTIFY_BATCH_SIZE пользователей, каждому уходит одно
+    сообщение со всеми его напоминаниями.
+    
+    Args:
+        digest: Режим дайджеста (по умолчанию NOTIFY_DIGEST)
+    
+    Returns:
+        Суммарная статистика отправки (sent — число сообщений)
+    """
+    if today is None:
+        today = date.today()
+    if digest is None:
+        digest = NOTIFY_DIGEST
+    total = SendStats()
+    with _drain_lock:
+        started = time.monotonic()
+        sender = NotificationSender(bot)
+        after = 0
+        while True:
+            if digest:
+                user_ids = database.get_pending_notification_users(today, limit=NOTIFY_BATCH_SIZE, after_user_id=after)
+                if not user_ids:
+                    break
+                after = user_ids[-1]
+                messages = _outbox_digests(database.get_pending_notifications_for_users(user_ids, today))
+            else:
+                batch = database.get_pending_notifications(today, limit=NOTIFY_BATCH_SIZE, after_id=after)
+                if not batch:
+                    break
+                after = batch[-1][0]
+                messages = _outbox_messages(batch)
+            stats = sender.send_all(messages)
+            database.mark_notifications_sent([outbox_id for keys in stats.sent_keys for outbox_id in keys])
+            database.mark_notifications_failed([outbox_id for keys in stats.failed_keys for outbox_id in keys])
+            total.sent += stats.sent
+            total.failed += stats.failed
+            total.retries += stats.retries
+        total.elapsed = time.monotonic() - started
+    return total
+
+
 def check_and_send_notifications(bot):
     """
     Проверить все дни рождения и отправить уведомления.
     
-    Отправляет уведомления за 7, 3 и 1 день до дня рождения.
+    Отправляет уведомления в дни, указанные в remind_days каждой записи (по умолчанию за 7, 3, 1 день и в день события).
+    Напоминания сначала ставятся в очередь notification_outbox, затем очередь разбирается —
+    повторный запуск в тот же день отправит только то, что ещё не отправлено.
     
     Args:
         bot: Экземпляр бота для отправки сообщений
@@ -95,111 +337,68 @@ def check_and_send_notifications(bot):
     logger.info("Запуск проверки дней рождения...")
     
     try:
-        # Получаем все дни рождения из базы данных
-        birthdays = database.get_all_birthdays_for_notifications()
-        
-        if not birthdays:
-            logger.info("Нет дней рождения в базе данных")
-            return
-        
-        notifications_sent = 0
-        
-        for birthday_id, user_id, full_name, birth_date, telegram_username, event_type, event_name, remind_days_str in birthdays:
-            days_until = calculate_days_until_birthday(birth_date)
-            # Парсим дни напоминаний для этого события (например "0,1,3,7" -> {0,1,3,7})
-            try:
-                remind_days_set = {int(x.strip()) for x in (remind_days_str or "0,1,3,7").split(",") if x.strip().isdigit()}
-            except Exception:
-                remind_days_set = {0, 1, 3, 7}
-            if not remind_days_set:
-                remind_days_set = {0}
-            
-            # Проверяем нужно ли отправить уведомление (в день события напоминаем по умолчанию)
-            if days_until in remind_days_set:
-                try:
-                    # Форматируем дату для отображения
-                    birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
-                    formatted_date = birth_date_obj.strftime('%d.%m.%Y')
-                    
-                    # Формируем имя с username (только для дней рождения)
-                    name_with_username = f"{full_name} (@{telegram_username})" if telegram_username else full_name
-                    
-                    # Определяем тип события (по умолчанию день рождения для обратной совместимости)
-                    if not event_type:
-                        event_type = 'birthday'
-                    
-                    reply_markup = None
-                    # Формируем текст уведомления в зависимости от типа события и дней до события
-                    if event_type == 'birthday':
-                        # Вычисляем возраст на сегодня (если указан год)
-                        current_age = calculate_age(birth_date)
-
-                        # Возраст, который исполняется: сегодня уже current_age, в будущем — current_age + 1
-                        if days_until == 0:
-                            age_turning = current_age  # сегодня день рождения — возраст уже этот
-                        else:
-                            age_turning = current_age + 1  # в будущем — исполнится на 1 больше
-
-                        if days_until == 0:
-                            if current_age >= 0:
-                                yw = years_word(age_turning)
-                                age_text = f"\nИсполняется {age_turning} {yw}! "
-                                message = f"🎉 СЕГОДНЯ день рождения у {name_with_username} ({formatted_date})!{age_text}Не забудь поздравить! 🎂🎁"
-                            else:
-                                message = f"🎉 СЕГОДНЯ день рождения у {name_with_username}!\nНе забудь поздравить! 🎂🎁"
-                            # Кнопки генерации поздравления только для типа «день рождения», не для праздников/других
-                            reply_markup = InlineKeyboardMarkup([
-                                [InlineKeyboardButton("🎁 Сгенерировать поздравление", callback_data=f"congratulate:{birthday_id}")],
-                                [InlineKeyboardButton("✏️ Свой промпт", callback_data=f"congratulate_prompt:{birthday_id}")],
-                            ])
-                        elif days_until == 1:
-                            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
-                            message = f"🎂 Не забудь поздравить {name_with_username} завтра ({formatted_date}){age_will_be}!"
-                        elif days_until == 3:
-                            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
-                            message = f"🎂 Не забудь поздравить {name_with_username} через 3 дня ({formatted_date}){age_will_be}!"
-                        else:  # 7 дней
-                            age_will_be = f" (исполнится {age_turning} {years_word(age_turning)})" if current_age >= 0 else ""
-                            message = f"🎂 Не забудь поздравить {name_with_username} через 7 дней ({formatted_date}){age_will_be}!"
-                    
-                    elif event_type == 'holiday':
-                        # Для праздников используем название события
-                        holiday_name = event_name if event_name else full_name
-                        if days_until == 0:
-                            message = f"🎊 СЕГОДНЯ {holiday_name}!\nНе забудь поздравить! 🎉"
-                        elif days_until == 1:
-                            message = f"🎊 Завтра {holiday_name} ({formatted_date})!\nНе забудь поздравить!"
-                        elif days_until == 3:
-                            message = f"🎊 Через 3 дня {holiday_name} ({formatted_date})!\nНе забудь поздравить!"
-                        else:  # 7 дней
-                            message = f"🎊 Через 7 дней {holiday_name} ({formatted_date})!"
-                    
-                    else:  # 'other'
-                        # Для других событий
-                        event_title = event_name if event_name else full_name
-                        if days_until == 0:
-                            message = f"📅 СЕГОДНЯ не забудь про {event_title}!"
-                        elif days_until == 1:
-                            message = f"📅 Завтра не забудь про {event_title} ({formatted_date})!"
-                        elif days_until == 3:
-                            message = f"📅 Через 3 дня не забудь про {event_title} ({formatted_date})!"
-                        else:  # 7 дней
-                            message = f"📅 Через 7 дней: {event_title} ({formatted_date})"
-                    
-                    # Отправляем уведомление (с кнопками для дня рождения сегодня)
-                    bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
-                    notifications_sent += 1
-                    logger.info(f"Отправлено уведомление пользователю {user_id}: {full_name} [{event_type}] через {days_until} дней")
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-        
-        logger.info(f"Проверка завершена. Отправлено уведомлений: {notifications_sent}")
+        today = date.today()
+        enqueue_due_notifications(today)
+        # Отправляем параллельно с учётом лимитов Telegram (кнопки — для дня рождения сегодня)
+        stats = drain_notification_outbox(bot, today)
+        logger.info(f"Проверка завершена. Отправлено уведомлений: {stats.sent}, ошибок: {stats.failed}, "
+                    f"скорость: {stats.throughput:.1f} сообщ./с")
     
     except Exception as e:
         logger.error(f"Ошибка при проверке дней рождения: {e}")
 
 
+def resume_notifications(bot):
+    """
+    Продолжить сегодняшнюю рассылку после перезапуска.
+    
+    Если время ежедневной проверки уже прошло, напоминания на сегодня ставятся в очередь
+    заново (процесс мог быть остановлен в 09:00 или упасть до записи очереди; повторная
+    постановка ничего не дублирует), затем очередь досылается.
+    """
+    if datetime.now(TIMEZONE).hour >= NOTIFY_HOUR:
+        check_and_send_notifications(bot)
+    else:
+        drain_notification_outbox(bot)
+
+
+def nightly_maintenance():
+    """Ночное обслуживание: сдвиг next_occurrence, очистка старых записей очереди уведомлений и кеша поздравлений, статистика кеша записей."""
+    today = date.today()
+    database.roll_next_occurrences(today)
+    purged = database.purge_notification_outbox(today - timedelta(days=OUTBOX_RETENTION_DAYS))
+    if purged:
+        logger.info(f"Удалено старых записей из очереди уведомлений: {purged}")
+    expired = database.purge_congratulation_cache(congratulations.CONGRATS_CACHE_TTL)
+    if expired:
+        logger.info(f"Удалено устаревших поздравлений из кеша: {expired}")
+    logger.info(f"Кеш записей пользователей: {database.user_rows_cache.stats()}")
+
+
+def pregenerate_upcoming_congratulations(today: Optional[date] = None) -> int:
+    """
+    Ночью заготовить поздравления для сегодняшних и завтрашних дней рождения, чтобы кнопка
+    «Сгенерировать поздравление» под утренним уведомлением отвечала сразу из кеша.
+    
+    Сегодняшние дни рождения обычно уже заготовлены прошлой ночью (они пропускаются),
+    но после первого запуска или пропущенной ночи кеш для них пуст. Срок жизни кеша
+    (CONGRATS_CACHE_TTL_HOURS) должен покрывать эти сутки с небольшим.
+    """
+    if today is None:
+        today = date.today()
+    names = []
+    for days_ahead in (0, 1):
+        candidates = database.get_notification_candidates(today, days_ahead=days_ahead)
+        names.extend(
+            full_name
+            for _, _, full_name, _, _, event_type, _, days_until in candidates
+            if days_until == 0 and (event_type or 'birthday') == 'birthday'
+        )
+    if not names:
+        return 0
+    return congratulations.pregenerate_congratulations(names)
+
+
 def start_scheduler(bot):
     """
     Запустить планировщик для ежедневной проверки дней рождения.
@@ -215,9 +414,37 @@ def start_scheduler(bot):
         # Добавляем задачу: проверка каждый день в 09:00
         scheduler.add_job(
             func=lambda: check_and_send_notifications(bot),
-            trigger=CronTrigger(hour=9, minute=0, timezone=TIMEZONE),
+            trigger=CronTrigger(hour=NOTIFY_HOUR, minute=0, timezone=TIMEZONE),
             id='birthday_check',
             name='Проверка дней рождения',
+            misfire_grace_time=SCHEDULER_MISFIRE_GRACE,
+            coalesce=True,
+            replace_existing=True
+        )
+        
+        # Ночной проход: сдвигаем next_occurrence у событий, дата которых уже прошла
+        scheduler.add_job(
+            func=nightly_maintenance,
+            trigger=CronTrigger(hour=0, minute=5, timezone=TIMEZONE),
+            id='next_occurrence_roll',
+            name='Обновление дат следующих событий',
+            replace_existing=True
+        )
+        
+        # Вне пиковых часов заготавливаем поздравления для сегодняшних и завтрашних дней рождения
+        scheduler.add_job(
+            func=pregenerate_upcoming_congratulations,
+            trigger=CronTrigger(hour=3, minute=30, timezone=TIMEZONE),
+            id='congratulations_pregenerate',
+            name='Предгенерация поздравлений на сегодня и завтра',
+            replace_existing=True
+        )
+        
+        # После перезапуска доставляем сегодняшнюю рассылку: ставим в очередь, если 09:00 уже прошло, и досылаем
+        scheduler.add_job(
+            func=lambda: resume_notifications(bot),
+            id='outbox_resume',
+            name='Досылка уведомлений из очереди',
             replace_existing=True
         )
         
@@ -0,0 +1,260 @@
+"""
+Поиск по событиям пользователя: inline-режим и команда /find.
+
+Сначала запрос идёт в полнотекстовый индекс SQLite (database.search_birthdays, FTS5):
+он общий для всех процессов, страница выбирается в SQL и записи не нужно держать в памяти.
+Если FTS5 недоступен или нашёл меньше страницы (запрос латиницей по кириллическому имени,
+середина слова), страница добирается из индекса в памяти с транслитерацией и триграммами.
+
+Индекс в памяти строится лениво из get_all_birthdays и привязан к версии строк пользователя
+в database.user_rows_cache: после любой записи в БД версия меняется, и индекс
+перестраивается при следующем запросе.
+"""
+import heapq
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Кириллица -> латиница: «Иван» и «ivan» приводятся к одному ключу
+_TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+# Латинские варианты одного звука, которые пишут по-разному (kh/h, x/ks, j/i, w/v, q/k)
+_LATIN_VARIANTS = (('kh', 'h'), ('x', 'ks'), ('j', 'i'), ('w', 'v'), ('q', 'k'))
+
+# Ранги совпадений: начало имени, начало слова, подстрока
+RANK_PREFIX, RANK_WORD_PREFIX, RANK_SUBSTRING = 0, 1, 2
+
+# Сколько индексов пользователей держать в памяти (как и кеш строк)
+SEARCH_INDEX_MAX_USERS = database.USER_CACHE_MAX_USERS
+
+
+def normalize(text: str) -> str:
+    """Строка для поиска: нижний регистр, ё -> е, транслит в латиницу, лишние символы -> пробел."""
+    result = []
+    for char in (text or '').lower():
+        if char in _TRANSLIT:
+            result.append(_TRANSLIT[char])
+        elif char.isalnum():
+            result.append(char)
+        else:
+            result.append(' ')
+    normalized = ' '.join(''.join(result).split())
+    for variant, canonical in _LATIN_VARIANTS:
+        normalized = normalized.replace(variant, canonical)
+    return normalized
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchEntry(NamedTuple):
+    """Событие с заранее подготовленными полями для показа."""
+    birthday_id: int
+    full_name: str
+    display_name: str
+    telegram_username: Optional[str]
+    event_type: str
+    emoji: str
+    formatted_date: str
+    version: int
+
+    @property
+    def result_id(self) -> str:
+        """Постоянный id inline-результата: меняется только при правке записи."""
+        return f"{self.birthday_id}.{self.version}"
+
+
+def _entry(row) -> SearchEntry:
+    birthday_id, full_name, birth_date, telegram_username, event_type, event_name, _, version = row
+    event_type = event_type or 'birthday'
+    birth_date_obj = datetime.strptime(birth_date, '%Y-%m-%d')
+    if event_type == 'holiday':
+        emoji, display_name = "🎊", event_name or full_name
+    elif event_type == 'other':
+        emoji, display_name = "📅", event_name or full_name
+    else:
+        emoji, display_name = "🎂", full_name
+    formatted_date = birth_date_obj.strftime('%d.%m.%Y' if event_type == 'birthday' else '%d.%m')
+    return SearchEntry(birthday_id, full_name, display_name, telegram_username, event_type, emoji, formatted_date, version)
+
+
+class UserSearchIndex:
+    """
+    Индекс событий одного пользователя.
+
+    Ключ записи — нормализованные имя, название события и username. Начала слов лежат
+    в отсортированном списке (поиск по префиксу — бинарный), подстроки ищутся через
+    пересечение списков триграмм и проверку найденных кандидатов.
+    """
+
+    def __init__(self, rows):
+        self.entries: List[SearchEntry] = []
+        self._keys: List[str] = []
+        self._words: List[tuple] = []
+        self._trigrams: Dict[str, Set[int]] = {}
+        for row in rows:
+            try:
+                entry = _entry(row)
+            except (TypeError, ValueError):
+                continue
+            index = len(self.entries)
+            key = normalize(' '.join(filter(None, (entry.display_name, entry.full_name, entry.telegram_username))))
+            self.entries.append(entry)
+            self._keys.append(key)
+            for word in set(key.split()):
+                self._words.append((word, index))
+            for trigram in _trigrams(key):
+                self._trigrams.setdefault(trigram, set()).add(index)
+        self._words.sort()
+        self._names = [entry.display_name.lower() for entry in self.entries]
+        self._by_name = sorted(range(len(self.entries)), key=self._names.__getitem__)
+        self._by_name_with_username = [i for i in self._by_name if self.entries[i].telegram_username]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def search(self, query: str, limit: Optional[int] = None, offset: int = 0,
+               with_username: bool = False) -> List[SearchEntry]:
+        """
+        События по запросу с offset по offset + limit, лучшие совпадения первыми
+        (пустой запрос — все события по имени).
+
+        Ранг: имя начинается с запроса, затем слово начинается с запроса, затем подстрока.
+        Сортируются только первые offset + limit совпадений, а подстроки не ищутся,
+        если совпадений по началу слов уже хватает на страницу.
+        """
+        wanted = None if limit is None else offset + limit
+        query = normalize(query)
+        if not query:
+            order = self._by_name_with_username if with_username else self._by_name
+            return [self.entries[i] for i in order[offset:wanted]]
+
+        ranks = {}
+        # Префиксы слов: все слова от bisect до первого, что не начинается с первого слова запроса
+        first_word = query.split()[0]
+        position = bisect_left(self._words, (first_word,))
+        while position < len(self._words) and self._words[position][0].startswith(first_word):
+            index = self._words[position][1]
+            position += 1
+            if with_username and not self.entries[index].telegram_username:
+                continue
+            if self._keys[index].startswith(query):
+                ranks[index] = RANK_PREFIX
+            elif (' ' + query) in (' ' + self._keys[index]):
+                ranks.setdefault(index, RANK_WORD_PREFIX)
+
+        # Подстроки: кандидаты из пересечения триграмм (короткие запросы — только префиксы)
+        if len(query) >= 3 and (wanted is None or len(ranks) < wanted):
+            postings = sorted((self._trigrams.get(t, set()) for t in _trigrams(query)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+            for index in candidates:
+                if with_username and not self.entries[index].telegram_username:
+                    continue
+                if index not in ranks and query in self._keys[index]:
+                    ranks[index] = RANK_SUBSTRING
+
+        def rank(i: int):
+            return ranks[i], self._names[i]
+
+        found = sorted(ranks, key=rank) if wanted is None else heapq.nsmallest(wanted, ranks, key=rank)
+        return [self.entries[i] for i in found[offset:]]
+
+
+class SearchIndexCache:
+    """LRU индексов по пользователям; индекс пересобирается, если версия строк пользователя изменилась."""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()  # user_id -> (version, UserSearchIndex)
+
+    def get(self, user_id: int) -> UserSearchIndex:
+        version = database.user_rows_cache.version(user_id)
+        with self._lock:
+            cached = self._indexes.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._indexes.move_to_end(user_id)
+                return cached[1]
+        index = UserSearchIndex(database.get_all_birthdays(user_id))
+        with self._lock:
+            self._indexes[user_id] = (version, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        logger.debug(f"Построен поисковый индекс пользователя {user_id}: {len(index)} событий")
+        return index
+
+
+search_indexes = SearchIndexCache(SEARCH_INDEX_MAX_USERS)
+
+
+# Источники результатов в next_offset: полнотекстовый индекс БД или индекс в памяти
+SOURCE_FTS, SOURCE_MEMORY = 'f', 'm'
+
+
+def _entries(rows) -> List[SearchEntry]:
+    entries = []
+    for row in rows:
+        try:
+            entries.append(_entry(row))
+        except (TypeError, ValueError):
+            continue
+    return entries
+
+
+def search_page(user_id: int, query: str, offset: str = '', limit: int = 50,
+                with_username: bool = False) -> Tuple[List[SearchEntry], str]:
+    """
+    Страница результатов поиска для inline-режима и /find.
+
+    Основной путь — FTS5: страница выбирается в SQL (LIMIT/OFFSET, порядок bm25), индекс
+    в памяти не нужен. Если FTS5 недоступен, запрос пустой или FTS5 нашёл меньше одной
+    страницы, страница добирается из индекса в памяти (транслитерация, середина слова)
+    без повторов уже показанных событий.
+
+    offset — строка из предыдущего ответа ('' для первой страницы): источник и номер первого
+    результата в нём, например 'f50' или 'm20'.
+
+    Returns:
+        (события, offset следующей страницы или '', если страниц больше нет)
+    """
+    source, position = SOURCE_FTS, 0
+    if offset and offset[0] in (SOURCE_FTS, SOURCE_MEMORY) and offset[1:].isdigit():
+        source, position = offset[0], int(offset[1:])
+
+    shown = []
+    exclude = set()
+    if database.FTS_AVAILABLE and normalize(query):
+        if source == SOURCE_FTS:
+            rows = database.search_birthdays(user_id, query, limit + 1, position, with_username)
+            shown = _entries(rows[:limit])
+            if len(rows) > limit:
+                return shown, f"{SOURCE_FTS}{position + limit}"
+            if position:
+                # FTS5 уже отдал хотя бы одну полную страницу — добирать из памяти нечего
+                return shown, ''
+        else:
+            # Страницы добора: FTS5 нашёл меньше страницы, эти события уже были на первой
+            shown_before = _entries(database.search_birthdays(user_id, query, limit, 0, with_username))
+            exclude = {entry.birthday_id for entry in shown_before}
+        exclude |= {entry.birthday_id for entry in shown}
+
+    # Из памяти берутся только первые position + room + 1 событий (плюс уже показанные FTS5)
+    room = limit - len(shown)
+    found = search_indexes.get(user_id).search(query, position + room + len(exclude) + 1,
+                                               with_username=with_username)
+    found = [entry for entry in found if entry.birthday_id not in exclude]
+    next_offset = f"{SOURCE_MEMORY}{position + room}" if len(found) > position + room else ''
+    return shown + found[position:position + room], next_offset
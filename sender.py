@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и не чаще 1 сообщения в секунду в один чат
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '8'))
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '30'))
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv('NOTIFY_PER_CHAT_INTERVAL', '1.0'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '3'))
+
+# Сообщение к отправке; key — произвольный идентификатор для отчёта (например id строки outbox)
+OutgoingMessage = namedtuple('OutgoingMessage', ['chat_id', 'text', 'reply_markup', 'key'])
+OutgoingMessage.__new__.__defaults__ = (None, None)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: не больше rate операций в секунду с запасом capacity.
+
+    pause() останавливает выдачу токенов всем потокам (например при flood control от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = 0.0
+
+    def acquire(self) -> None:
+        """Дождаться и забрать один токен."""
+        while True:
+            with self._lock:
+                now = self._clock()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class SendStats:
+    """Итоги рассылки: сколько отправлено, сколько ошибок и повторов, скорость."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self.sent_keys = []
+        self.failed_keys = []
+        self._lock = threading.Lock()
+
+    def record(self, message: OutgoingMessage, ok: bool, retries: int) -> None:
+        with self._lock:
+            self.retries += retries
+            if ok:
+                self.sent += 1
+                self.sent_keys.append(message.key)
+            else:
+                self.failed += 1
+                self.failed_keys.append(message.key)
+
+    @property
+    def throughput(self) -> float:
+        """Сообщений в секунду."""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (f"SendStats(sent={self.sent}, failed={self.failed}, retries={self.retries}, "
+                f"elapsed={self.elapsed:.2f}s, throughput={self.throughput:.1f} msg/s)")
+
+
+class NotificationSender:
+    """
+    Параллельная рассылка сообщений с учётом лимитов Telegram.
+
+    Сообщения группируются по чатам: каждый чат обрабатывается одной задачей в пуле потоков
+    (порядок сохраняется, между сообщениями в чат не меньше per_chat_interval секунд),
+    а все отправки проходят через общий token bucket на global_rate сообщений в секунду.
+    RetryAfter от Telegram приостанавливает всю рассылку на указанное время и сообщение повторяется.
+
+    bot — любой объект с методом send_message(chat_id=..., text=..., reply_markup=...),
+    поэтому рассылку можно проверить на фейковом боте, записывающем время вызовов.
+    """
+
+    def __init__(self, bot, workers: int = NOTIFY_WORKERS, global_rate: float = NOTIFY_GLOBAL_RATE,
+                 per_chat_interval: float = NOTIFY_PER_CHAT_INTERVAL, max_retries: int = NOTIFY_MAX_RETRIES,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._clock = clock
+        self._sleep = sleep
+        # capacity=1: сообщения идут равномерно, без всплеска в начале рассылки
+        self.bucket = TokenBucket(global_rate, capacity=1, clock=clock, sleep=sleep)
+
+    def send_all(self, messages: Iterable[OutgoingMessage]) -> SendStats:
+        """Отправить все сообщения и дождаться завершения."""
+        by_chat = OrderedDict()
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+
+        stats = SendStats()
+        if not by_chat:
+            return stats
+
+        started = self._clock()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(by_chat)), thread_name_prefix='notify') as executor:
+            for chat_messages in by_chat.values():
+                executor.submit(self._send_chat, chat_messages, stats)
+        stats.elapsed = self._clock() - started
+        logger.info(f"Рассылка завершена: {stats}")
+        return stats
+
+    def _send_chat(self, chat_messages: List[OutgoingMessage], stats: SendStats) -> None:
+        """Отправить сообщения одного чата по порядку с интервалом per_chat_interval."""
+        last_sent = None
+        for message in chat_messages:
+            if last_sent is not None:
+                wait = last_sent + self.per_chat_interval - self._clock()
+                if wait > 0:
+                    self._sleep(wait)
+            ok, retries = self._send_one(message)
+            last_sent = self._clock()
+            stats.record(message, ok, retries)
+
+    def _send_one(self, message: OutgoingMessage):
+        """Отправить одно сообщение с повторами при flood control. Возвращает (ok, retries)."""
+        retries = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                self.bot.send_message(chat_id=message.chat_id, text=message.text, reply_markup=message.reply_markup)
+                return True, retries
+            except RetryAfter as e:
+                if retries >= self.max_retries:
+                    logger.error(f"Flood control: не удалось отправить сообщение в чат {message.chat_id} после {retries} повторов")
+                    return False, retries
+                retries += 1
+                logger.warning(f"Flood control: пауза {e.retry_after} с (чат {message.chat_id})")
+                self.bucket.pause(float(e.retry_after))
+            except Exception as e:
+                logger.error(f"Ошибка при отправке сообщения в чат {message.chat_id}: {e}")
+                return False, retries